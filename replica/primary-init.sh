@@ -0,0 +1,4 @@
+#!/bin/bash
+# Runs once when the primary's data directory is first initialized: allow the replica to stream WAL
+set -e
+echo "host replication all all md5" >> "$PGDATA/pg_hba.conf"
@@ -0,0 +1,14 @@
+#!/bin/bash
+# Clone the primary into an empty data directory, then start as a hot standby
+set -e
+export PGPASSWORD="$POSTGRES_PASSWORD"
+if [ ! -s "$PGDATA/PG_VERSION" ]; then
+  until pg_isready -h "$POSTGRES_HOST" -p "$POSTGRES_PORT"; do
+    sleep 1
+  done
+  mkdir -p "$PGDATA"
+  chown postgres:postgres "$PGDATA"
+  chmod 700 "$PGDATA"
+  gosu postgres pg_basebackup -h "$POSTGRES_HOST" -p "$POSTGRES_PORT" -U "$POSTGRES_USER" -D "$PGDATA" -R -X stream
+fi
+exec gosu postgres postgres -c hot_standby=on
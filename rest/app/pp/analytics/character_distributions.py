@@ -0,0 +1,149 @@
+from django.db import connections
+from django.db.models import CharField, F, Value
+
+PERCENTILES = [0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95]
+METRICS = ["damage_score", "class_probability"]
+
+# Fields characters may be grouped by
+GROUP_FIELDS = {
+    "book": "created_by_run__book_id",
+    "character_class": "character_class_id",
+    "printer": "created_by_run__book__pp_printer",
+}
+
+DISTRIBUTION_SQL = """
+WITH filtered AS (
+    SELECT * FROM ({filtered}) AS f (grp, damage_score, class_probability)
+),
+bounds AS (
+    SELECT
+        min(damage_score) AS damage_score_lower,
+        max(damage_score) AS damage_score_upper,
+        min(class_probability) AS class_probability_lower,
+        max(class_probability) AS class_probability_upper
+    FROM filtered
+),
+summary AS (
+    SELECT
+        grp,
+        count(*) AS n,
+        {summaries}
+    FROM filtered
+    GROUP BY grp
+),
+{histograms}
+SELECT summary.*, {histogram_columns}, bounds.*
+FROM summary CROSS JOIN bounds
+ORDER BY summary.grp
+"""
+
+SUMMARY_SQL = """
+        count({metric}) AS {metric}_count,
+        avg({metric}) AS {metric}_mean,
+        min({metric}) AS {metric}_min,
+        max({metric}) AS {metric}_max,
+        percentile_cont(%s::float8[]) WITHIN GROUP (ORDER BY {metric}) AS {metric}_percentiles"""
+
+HISTOGRAM_SQL = """
+{metric}_histogram AS (
+    SELECT
+        grp,
+        CASE
+            WHEN {metric}_upper > {metric}_lower
+            THEN LEAST(width_bucket({metric}, {metric}_lower, {metric}_upper, %s), %s)
+            ELSE 1
+        END AS bucket,
+        count(*) AS n
+    FROM filtered CROSS JOIN bounds
+    WHERE {metric} IS NOT NULL
+    GROUP BY grp, bucket
+)"""
+
+HISTOGRAM_COLUMN_SQL = """
+    (
+        SELECT json_agg(json_build_array(bucket, n) ORDER BY bucket)
+        FROM {metric}_histogram h
+        WHERE h.grp IS NOT DISTINCT FROM summary.grp
+    ) AS {metric}_histogram"""
+
+
+def _metric_distribution(row, metric, bins):
+    # Histogram buckets span the whole filtered set, so groups are comparable
+    low = row[f"{metric}_lower"]
+    high = row[f"{metric}_upper"]
+    width = (high - low) / bins if low is not None and high > low else 0
+    buckets = {bucket: n for bucket, n in row[f"{metric}_histogram"] or []}
+    percentiles = row[f"{metric}_percentiles"]
+    return {
+        "count": row[f"{metric}_count"],
+        "mean": row[f"{metric}_mean"],
+        "min": row[f"{metric}_min"],
+        "max": row[f"{metric}_max"],
+        "percentiles": {
+            f"p{round(p * 100)}": percentiles[i] if percentiles else None
+            for i, p in enumerate(PERCENTILES)
+        },
+        "histogram": [
+            {
+                "lower": low + (i * width) if low is not None else None,
+                "upper": low + ((i + 1) * width) if low is not None else None,
+                "count": buckets.get(i + 1, 0),
+            }
+            for i in range(bins if width else min(bins, 1))
+        ],
+    }
+
+
+def character_distributions(queryset, group_by=None, bins=20):
+    """
+    Histograms and percentiles of damage_score and class_probability over a Character queryset, optionally grouped by one of GROUP_FIELDS, computed in a single SQL statement
+    """
+    group = (
+        F(GROUP_FIELDS[group_by])
+        if group_by is not None
+        else Value("all", output_field=CharField())
+    )
+    filtered = (
+        queryset.order_by()
+        .annotate(
+            distribution_group=group,
+            distribution_damage_score=F("damage_score"),
+            distribution_class_probability=F("class_probability"),
+        )
+        .values_list(
+            "distribution_group",
+            "distribution_damage_score",
+            "distribution_class_probability",
+        )
+    )
+    filtered_sql, filtered_params = filtered.query.sql_with_params()
+    sql = DISTRIBUTION_SQL.format(
+        filtered=filtered_sql,
+        summaries=",".join(SUMMARY_SQL.format(metric=m) for m in METRICS),
+        histograms=",".join(HISTOGRAM_SQL.format(metric=m) for m in METRICS),
+        histogram_columns=",".join(
+            HISTOGRAM_COLUMN_SQL.format(metric=m) for m in METRICS
+        ),
+    )
+    params = (
+        list(filtered_params)
+        + [PERCENTILES] * len(METRICS)
+        + [bins, bins] * len(METRICS)
+    )
+    # Run on whichever database the queryset was routed to, e.g. a read replica
+    with connections[filtered.db].cursor() as cursor:
+        cursor.execute(sql, params)
+        columns = [col[0] for col in cursor.description]
+        rows = cursor.fetchall()
+
+    results = []
+    for values in rows:
+        row = dict(zip(columns, values))
+        results.append(
+            {
+                "group": row["grp"],
+                "count": row["n"],
+                **{m: _metric_distribution(row, m, bins) for m in METRICS},
+            }
+        )
+    return results
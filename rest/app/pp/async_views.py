@@ -0,0 +1,215 @@
+"""
+Async versions of the API endpoints that spend most of their time waiting on the shared filesystem or the IIIF server.
+
+They are only routed when the app is served over ASGI (see web/asgi.py and web/asgi_urls.py), where a slow request no longer ties up a whole worker. Under WSGI the equivalent actions on BookViewSet and CharacterGroupingViewSet answer the same URLs.
+"""
+import asyncio
+import logging
+import os
+from glob import glob
+from types import SimpleNamespace
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, JsonResponse
+from django.utils.text import slugify
+from rest_framework import exceptions
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
+
+from web.streaming import AsyncStreamingHttpResponse
+
+from . import models, serializers
+from .downloads.character_tar import astream_character_tar
+from .manifest.stored_manifests import aget_manifest, amanifest_window
+from .matches.find_matching_chars import (
+    aget_match_directories,
+    get_csv_index,
+    get_imported_match_set,
+    get_imported_matched_characters,
+    get_matched_characters,
+    matched_characters_options,
+)
+from .views import BASE_PATH, NO_MANIFEST, TOP_K_CSV_SUFFIX, manifest_response
+
+
+def api_response(data, status=200):
+    return JsonResponse(data, status=status, encoder=JSONEncoder, safe=False)
+
+
+def async_api_view(queryset=None, methods=None):
+    """
+    Wrap an async view with the API's default authentication and permission classes, checked against `queryset` the way DjangoModelPermissions checks a viewset's queryset. Views without a queryset are public. If `methods` is given, other HTTP methods are answered with 405, like the methods of a viewset action. The wrapped view receives the DRF Request.
+    """
+
+    def decorator(view):
+        async def wrapped_view(request, *args, **kwargs):
+            if methods is not None and request.method not in methods:
+                response = api_response(
+                    {"detail": f'Method "{request.method}" not allowed.'}, status=405
+                )
+                response["Allow"] = ", ".join(methods)
+                return response
+            drf_request = Request(
+                request,
+                parsers=[parser() for parser in api_settings.DEFAULT_PARSER_CLASSES],
+                authenticators=[
+                    auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES
+                ],
+            )
+            if queryset is not None:
+                try:
+                    allowed = await sync_to_async(has_permission)(drf_request, queryset)
+                except exceptions.APIException as err:
+                    return api_response({"detail": err.detail}, status=403)
+                if not allowed:
+                    return api_response(
+                        {
+                            "detail": "You do not have permission to perform this action."
+                        },
+                        status=403,
+                    )
+            return await view(drf_request, *args, **kwargs)
+
+        # Like APIView, leave CSRF checks to SessionAuthentication
+        wrapped_view.csrf_exempt = True
+        return wrapped_view
+
+    return decorator
+
+
+def has_permission(drf_request, queryset):
+    view = SimpleNamespace(queryset=queryset)
+    return all(
+        permission().has_permission(drf_request, view)
+        for permission in api_settings.DEFAULT_PERMISSION_CLASSES
+    )
+
+
+async def book_images_path(pk, depth):
+    """
+    Directory on the shared filesystem holding the images of a book's pages, or None if it has no pages
+    """
+    one_page = await sync_to_async(
+        models.Page.objects.filter(created_by_run__book=pk, tif__isnull=False).first
+    )()
+    if one_page is None:
+        return None
+    split_parts = one_page.tif.split("/")[0:depth]
+    return os.path.join(BASE_PATH, *split_parts)
+
+
+@async_api_view(queryset=models.Book.objects.all())
+async def matched_directories(request, pk):
+    matches_path = await book_images_path(pk, 4)
+    if matches_path is None:
+        return api_response("No pages in book", status=404)
+    match_directories = await aget_match_directories(matches_path)
+    return api_response({"match_directories": match_directories})
+
+
+@async_api_view(queryset=models.Book.objects.all(), methods=["POST"])
+async def matched_characters(request, pk):
+    limit = int(request.GET.get("limit", 5))
+    offset = int(request.GET.get("offset", 0))
+    try:
+        ordering, max_distance = matched_characters_options(request.GET)
+    except ValueError as err:
+        return api_response({"error": str(err)}, status=400)
+    match_set = await sync_to_async(get_imported_match_set)(
+        pk, request.data["dir"], request.data["character_class"]
+    )
+    if match_set is not None:
+        matched, total_count = await sync_to_async(get_imported_matched_characters)(
+            request, match_set, limit, offset, ordering, max_distance
+        )
+        return api_response({"matched_characters": matched, "total_count": total_count})
+    if ordering != "row" or max_distance is not None:
+        return api_response(
+            {
+                "error": "Matches must be imported with import_topk_matches to be sorted or filtered"
+            },
+            status=400,
+        )
+    matches_path = await book_images_path(pk, 4)
+    if matches_path is None:
+        return api_response("No pages in book", status=404)
+    character_class_dir = os.path.join(
+        matches_path, request.data["dir"], request.data["character_class"]
+    )
+    logging.info({"Character class folder: ", character_class_dir})
+    csv_path = os.path.join(character_class_dir, TOP_K_CSV_SUFFIX)
+    topk_csv_files = await asyncio.to_thread(glob, csv_path)
+    logging.info(topk_csv_files)
+    if len(topk_csv_files) == 0:
+        return api_response({"No matching CSV found:", csv_path})
+    if len(topk_csv_files) > 1:
+        return api_response({"More than one CSV matching:", csv_path})
+    topk_csv_file = topk_csv_files[0]
+    index = await asyncio.to_thread(get_csv_index, topk_csv_file)
+    matched = await sync_to_async(get_matched_characters)(
+        request, topk_csv_file, limit, offset
+    )
+    return api_response({"matched_characters": matched, "total_count": index["n_rows"]})
+
+
+@async_api_view()
+async def generate_manifest(request, pk):
+    book = await sync_to_async(models.Book.objects.filter(pk=pk).first)()
+    if book is None:
+        return api_response({"detail": "Not found."}, status=404)
+    if "start" in request.query_params or "count" in request.query_params:
+        return await partial_manifest(request, book)
+    try:
+        manifest = await aget_manifest(book)
+    except Exception as err:
+        logging.error({"Error generating manifest: ": err})
+        return api_response("Error generating manifest", status=500)
+    if manifest is None:
+        return api_response(NO_MANIFEST)
+    return manifest_response(request, manifest)
+
+
+async def partial_manifest(request, book):
+    params = serializers.ManifestWindowSerializer(data=request.query_params)
+    if not params.is_valid():
+        return api_response(params.errors, status=400)
+    try:
+        pages = await amanifest_window(book, **params.validated_data)
+    except Exception as err:
+        logging.error({"Error generating manifest: ": err})
+        return api_response("Error generating manifest", status=500)
+    if pages is None:
+        return api_response(NO_MANIFEST)
+    if pages.start >= pages.n_pages:
+        return api_response(
+            {"error": f"start must be less than the number of pages, {pages.n_pages}"},
+            status=400,
+        )
+    # Windows are at most MANIFEST_MAX_WINDOW pages, so they are written in one go
+    content = await sync_to_async(lambda: "".join(pages.chunks()))()
+    return HttpResponse(content, content_type="application/json")
+
+
+@async_api_view(queryset=models.CharacterGrouping.objects.all())
+async def download(request, pk):
+    obj = await sync_to_async(models.CharacterGrouping.objects.filter(pk=pk).first)()
+    if obj is None:
+        return api_response({"detail": "Not found."}, status=404)
+    image_objects = await sync_to_async(list)(
+        models.Character.objects.filter(charactergroupings=obj).select_related(
+            "line__page"
+        )
+    )
+    if len(image_objects) < 1:
+        return api_response(
+            [{"error": "This character group has no characters to download"}],
+            status=400,
+        )
+    zip_file_name = f"character_group-{slugify(obj.label)}-{obj.id}.tar.gz"
+
+    response = AsyncStreamingHttpResponse(
+        astream_character_tar(image_objects), content_type="application/gzip"
+    )
+    response["Content-Disposition"] = f"attachment; filename={zip_file_name}"
+    return response
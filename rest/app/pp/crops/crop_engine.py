@@ -0,0 +1,195 @@
+"""
+Cut character and line crops straight out of the page TIFFs mounted at REAL_IMAGE_BASEDIR, instead of asking the IIIF server for each region.
+
+Objects are grouped by page TIFF, so each one is opened and decoded once however many regions are cut from it (pp/crops/crop_scheduler.py spreads the pages over a worker pool). Only the rows or tiles of the TIFF that hold those regions are decoded; uncompressed single-band scans are memory-mapped instead, and compressed scans, which libtiff decodes as one tile, are still decoded whole. Each process keeps one engine per image directory, whose small LRU of decoded pages covers requests that come back to the same part of a page.
+"""
+import io
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from PIL import Image
+
+from .image_sizes import open_scan
+
+
+class CropEngine:
+    # Engines shared by every request of this process, keyed by basedir
+    engines = {}
+    engines_lock = threading.Lock()
+
+    def __init__(self, basedir, max_open_pages=2):
+        self.basedir = basedir
+        self.max_open_pages = max_open_pages
+        # (decoded page, box decoded or None for all of it), keyed by page_path and modification time
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        """
+        This process's engine for REAL_IMAGE_BASEDIR, or None if local crops are switched off or the images are not mounted
+        """
+        basedir = settings.REAL_IMAGE_BASEDIR
+        if settings.CROP_ENGINE != "local" or not os.path.isdir(basedir):
+            return None
+        with cls.engines_lock:
+            if basedir not in cls.engines:
+                cls.engines[basedir] = cls(basedir)
+            return cls.engines[basedir]
+
+    def page_path(self, page):
+        return os.path.join(self.basedir, page.tif.lstrip("/"))
+
+    def has_page(self, page):
+        return bool(page.tif) and os.path.isfile(self.page_path(page))
+
+    def partition(self, objects):
+        """
+        Split cropped objects into those whose page TIFF is available locally, and the rest
+        """
+        available = {}
+        local, remote = [], []
+        for obj in objects:
+            page = obj.root_object
+            if page.tif not in available:
+                available[page.tif] = self.has_page(page)
+            (local if available[page.tif] else remote).append(obj)
+        return local, remote
+
+    @staticmethod
+    def regions_box(objects):
+        """
+        Box around the regions of all of `objects`
+        """
+        coords = [obj.absolute_coords for obj in objects]
+        return (
+            min(ac["x"] for ac in coords),
+            min(ac["y"] for ac in coords),
+            max(ac["x"] + ac["w"] for ac in coords),
+            max(ac["y"] + ac["h"] for ac in coords),
+        )
+
+    @staticmethod
+    def covers(decoded, box):
+        if decoded is None:
+            return True
+        if box is None:
+            return False
+        return (
+            decoded[0] <= box[0]
+            and decoded[1] <= box[1]
+            and decoded[2] >= box[2]
+            and decoded[3] >= box[3]
+        )
+
+    @staticmethod
+    def box_tiles(img, box):
+        """
+        The tiles of `img` that hold part of `box`, so that load() decodes only those. Uncompressed strips, which Pillow reads as one tile, are narrowed to the rows of `box`.
+        """
+        codec, _, _, args = img.tile[0]
+        if (
+            len(img.tile) == 1
+            and codec == "raw"
+            and args[0] == img.mode
+            and img.mode in Image._MAPMODES
+        ):
+            # load() memory-maps these instead of decoding them
+            return img.tile
+        x0, y0, x1, y1 = box
+        # Bits per pixel of uncompressed TIFF rows (1 unless tagged), when samples are interleaved
+        tags = getattr(img, "tag_v2", None)
+        bits = sum(tags.get(258, (1,))) if tags and tags.get(284, 1) == 1 else 0
+        tiles = []
+        for tile in img.tile:
+            codec, (tx0, ty0, tx1, ty1), offset, args = tile
+            if tx0 >= x1 or tx1 <= x0 or ty0 >= y1 or ty1 <= y0:
+                continue
+            if codec == "raw" and bits and args[1:] == (0, 1):
+                row_bytes = ((tx1 - tx0) * bits + 7) // 8
+                top, bottom = max(ty0, y0), min(ty1, y1)
+                offset += (top - ty0) * row_bytes
+                tile = tile._replace(extents=(tx0, top, tx1, bottom), offset=offset)
+            tiles.append(tile)
+        return tiles
+
+    def open_page(self, page, box=None):
+        """
+        Page image with at least `box` decoded (or all of it if None), kept for the next few calls until its file changes
+        """
+        path = self.page_path(page)
+        key = (path, os.stat(path).st_mtime_ns)
+        with self.lock:
+            if key in self.pages and self.covers(self.pages[key][1], box):
+                self.pages.move_to_end(key)
+                return self.pages[key][0]
+        img = open_scan(path)
+        if box is not None:
+            img.tile = self.box_tiles(img, box)
+        img.load()
+        with self.lock:
+            self.pages[key] = (img, box)
+            while len(self.pages) > self.max_open_pages:
+                # Crops already cut from an evicted page are unaffected
+                self.pages.popitem(last=False)
+        return img
+
+    @staticmethod
+    def region(img, obj):
+        # Lines span the whole width of the page (w=9999), so clamp to the image
+        ac = obj.absolute_coords
+        return (
+            max(ac["x"], 0),
+            max(ac["y"], 0),
+            min(ac["x"] + ac["w"], img.width),
+            min(ac["y"] + ac["h"], img.height),
+        )
+
+    @staticmethod
+    def encode(img, image_format="TIFF", size=None):
+        """
+        The crop as `image_format` bytes, or as the image itself if `image_format` is None
+        """
+        if size is not None:
+            img = img.copy()
+            img.thumbnail(size)
+        if image_format is None:
+            return img
+        if image_format == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        buf = io.BytesIO()
+        img.save(buf, format=image_format)
+        return buf.getvalue()
+
+    def crop_page(self, page, objects, image_format="TIFF", size=None):
+        """
+        [(obj, bytes)] for objects that all lie on `page`, with bytes None for any that could not be cut. See `encode` for `image_format` and `size`.
+        """
+        try:
+            img = self.open_page(page, self.regions_box(objects))
+        except (OSError, ValueError) as err:
+            logging.error({f"Could not open {self.page_path(page)}": str(err)})
+            return [(obj, None) for obj in objects]
+        results = []
+        for obj in objects:
+            try:
+                crop = img.crop(self.region(img, obj))
+                results.append((obj, self.encode(crop, image_format, size)))
+            except (OSError, ValueError) as err:
+                logging.error({f"Could not crop {obj.id}": str(err)})
+                results.append((obj, None))
+        return results
+
+    @staticmethod
+    def by_page(objects):
+        """
+        (page, objects) pairs, one per page TIFF, in the order each TIFF is first needed. Pages from different runs that share a TIFF are grouped together.
+        """
+        pages = OrderedDict()
+        for obj in objects:
+            pages.setdefault(obj.root_object.tif, []).append(obj)
+        for page_objects in pages.values():
+            yield page_objects[0].root_object, page_objects
@@ -0,0 +1,58 @@
+"""
+Schedule crops by source page, so that the time to cut a batch grows with the number of distinct page TIFFs rather than the number of crops.
+
+The requested objects are grouped by `line.page.tif`. Every page is handed to a worker pool once, and the worker decodes it and cuts all of its regions. Only as many pages as there are workers are in flight at once, and the next one is submitted as the earliest is consumed, so a slow consumer doesn't make the crops of a whole grouping pile up in memory. Results are put back into the order they were requested in and yielded as soon as the next one in line is ready.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+
+class CropScheduler:
+    def __init__(self, engine, max_workers=None):
+        self.engine = engine
+        self.max_workers = max_workers or settings.CROP_WORKERS
+
+    def crops(self, objects, image_format="TIFF", size=None):
+        """
+        Yield (obj, bytes) for each of `objects`, in order, with bytes None for any that could not be cut
+        """
+        objects = list(objects)
+        # Positions in `objects` of each object, as several may be requested more than once
+        positions = {}
+        for i, obj in enumerate(objects):
+            positions.setdefault(id(obj), []).append(i)
+
+        # Pages in the order they are first needed, so the earliest crops are ready first
+        pages = iter(self.engine.by_page(objects))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = deque()
+
+            def submit_next():
+                page = next(pages, None)
+                if page is not None:
+                    futures.append(
+                        executor.submit(
+                            self.engine.crop_page, *page, image_format, size
+                        )
+                    )
+
+            for _ in range(self.max_workers):
+                submit_next()
+            try:
+                ready = {}
+                next_position = 0
+                while futures:
+                    results = futures.popleft().result()
+                    submit_next()
+                    for obj, content in results:
+                        for i in positions[id(obj)]:
+                            ready[i] = content
+                    while next_position in ready:
+                        yield objects[next_position], ready.pop(next_position)
+                        next_position += 1
+            finally:
+                # The consumer went away: don't decode the remaining pages
+                for future in futures:
+                    future.cancel()
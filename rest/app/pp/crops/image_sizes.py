@@ -0,0 +1,66 @@
+"""
+Read the pixel size of page and spread TIFFs under REAL_IMAGE_BASEDIR from their headers alone, so it can be stored when they are ingested and IIIF manifests don't have to ask the image server for it.
+
+Pillow's Image.open only parses the header; pixels would only be decoded by load(), which is never called here.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from PIL import Image
+
+_pixel_limit_lock = threading.Lock()
+
+
+def open_scan(path):
+    """
+    Image.open for our own page scans, which are larger than Pillow's decompression bomb limit. The limit is only lifted while the header is parsed, so other images opened by the process are still checked.
+    """
+    with _pixel_limit_lock:
+        limit = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = None
+        try:
+            return Image.open(path)
+        finally:
+            Image.MAX_IMAGE_PIXELS = limit
+
+
+def image_path(tif):
+    return os.path.join(settings.REAL_IMAGE_BASEDIR, tif.lstrip("/"))
+
+
+def read_image_size(tif):
+    """
+    (width, height) of the image at `tif`, or None if it can't be read or the images aren't mounted
+    """
+    if not tif or not os.path.isdir(settings.REAL_IMAGE_BASEDIR):
+        return None
+    try:
+        with open_scan(image_path(tif)) as img:
+            return img.size
+    except (OSError, ValueError) as err:
+        logging.info({f"Could not read the size of {tif}": str(err)})
+        return None
+
+
+def read_image_sizes(tifs):
+    """
+    {tif: (width, height) or None} for each of `tifs`, reading IMAGE_SIZE_WORKERS headers at a time
+    """
+    tifs = list(dict.fromkeys(tifs))
+    if not os.path.isdir(settings.REAL_IMAGE_BASEDIR):
+        return {tif: None for tif in tifs}
+    with ThreadPoolExecutor(max_workers=settings.IMAGE_SIZE_WORKERS) as pool:
+        return dict(zip(tifs, pool.map(read_image_size, tifs)))
+
+
+def set_image_sizes(objects):
+    """
+    Set the width and height of Pages or Spreads from their TIFFs, or to None where those can't be read
+    """
+    sizes = read_image_sizes(obj.tif for obj in objects)
+    for obj in objects:
+        obj.width, obj.height = sizes[obj.tif] or (None, None)
+    return objects
@@ -0,0 +1,136 @@
+"""
+Pack the thumbnails of many characters into one sprite image plus an atlas JSON giving each character's offset in it, so a grouping or a page of characters loads in two requests instead of one per thumbnail.
+
+Sprites are stored under SPRITE_DIR and named after a hash of everything that determines their content: the thumbnail size, and each character's page image and region. The hash is keyed with SECRET_KEY, so a name can't be worked out from character IDs without first being handed out by the API. An unchanged set of characters is packed once and then served from disk, and any change to it produces a new name, so stored sprites never need invalidating.
+
+Sprites are packed synchronously, in the request that first asks for them.
+"""
+import hashlib
+import hmac
+import io
+import json
+import logging
+import math
+import os
+import tempfile
+
+from django.conf import settings
+from PIL import Image
+
+from ..downloads.character_tar import fetch_remote_crops
+from .crop_engine import CropEngine
+from .crop_scheduler import CropScheduler
+
+SPRITE_QUALITY = 85
+
+
+def sprite_key(characters, size):
+    """
+    Hex digest identifying the sprite of `characters` at `size`, keyed with SECRET_KEY
+    """
+    content = [size] + [
+        [str(character.id), character.root_object.tif, character.region_string]
+        for character in characters
+    ]
+    return hmac.new(
+        settings.SECRET_KEY.encode(), json.dumps(content).encode(), hashlib.sha1
+    ).hexdigest()
+
+
+def sprite_paths(key):
+    """
+    Paths of the sprite image and its atlas
+    """
+    return (
+        os.path.join(settings.SPRITE_DIR, f"{key}.jpg"),
+        os.path.join(settings.SPRITE_DIR, f"{key}.json"),
+    )
+
+
+def thumbnails(characters, size):
+    """
+    Yield (character, image) for each character, scaled to fit in a `size` square, with image None if it could not be fetched
+    """
+    box = (size, size)
+    engine = CropEngine.from_settings()
+    if engine is not None:
+        characters, remote = engine.partition(characters)
+        yield from CropScheduler(engine).crops(characters, image_format=None, size=box)
+        characters = remote
+    for character, content in fetch_remote_crops(characters, url_attr="thumbnail"):
+        img = None
+        if content is not None:
+            try:
+                img = Image.open(io.BytesIO(content))
+                img.thumbnail(box)
+            except (OSError, ValueError) as err:
+                logging.error({f"Could not read {character.thumbnail}": str(err)})
+                img = None
+        yield character, img
+
+
+def pack(characters, size):
+    """
+    (sprite, atlas) for `characters`, laid out row by row on a square-ish grid of `size` cells
+    """
+    columns = max(1, math.ceil(math.sqrt(len(characters))))
+    rows = max(1, math.ceil(len(characters) / columns))
+    sprite = Image.new("RGB", (columns * size, rows * size), "white")
+    positions = {id(character): i for i, character in enumerate(characters)}
+    frames = [None] * len(characters)
+    for character, img in thumbnails(characters, size):
+        if img is None:
+            continue
+        i = positions[id(character)]
+        x, y = (i % columns) * size, (i // columns) * size
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        sprite.paste(img, (x, y))
+        frames[i] = {"x": x, "y": y, "w": img.width, "h": img.height}
+    atlas = {
+        "size": size,
+        "width": sprite.width,
+        "height": sprite.height,
+        "characters": [
+            {"id": str(character.id), "label": character.label, "frame": frame}
+            for character, frame in zip(characters, frames)
+        ],
+    }
+    return sprite, atlas
+
+
+def _write_atomically(path, write):
+    # Readers only ever see complete files, even with several builds of the same sprite running at once
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def build_sprite(characters, size, force=False):
+    """
+    (key, atlas) for the sprite of `characters`, packing and storing it unless it is already on disk. Characters whose thumbnail could not be fetched have a null frame.
+    """
+    characters = list(characters)
+    key = sprite_key(characters, size)
+    image_path, atlas_path = sprite_paths(key)
+    if not force:
+        try:
+            with open(atlas_path) as f:
+                return key, json.load(f)
+        except FileNotFoundError:
+            pass
+    sprite, atlas = pack(characters, size)
+    os.makedirs(settings.SPRITE_DIR, exist_ok=True)
+    # The atlas goes last, as its presence marks the sprite as built
+    _write_atomically(
+        image_path,
+        lambda f: sprite.save(f, format="JPEG", quality=SPRITE_QUALITY),
+    )
+    _write_atomically(atlas_path, lambda f: f.write(json.dumps(atlas).encode()))
+    return key, atlas
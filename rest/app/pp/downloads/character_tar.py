@@ -0,0 +1,220 @@
+"""
+Stream a tar.gz of character crops to the client while the crops are still being fetched.
+
+Crops are cut locally from the page TIFFs when they are mounted (see pp/crops/crop_engine.py). Any others are requested from the IIIF server through one pooled HTTP client, at most IIIF_MAX_CONNECTIONS in flight. Each crop is added to the archive as soon as it is ready. Nothing is written to disk, and the client starts receiving data after the first crop.
+"""
+import asyncio
+import io
+import logging
+import tarfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+
+import httpx
+from django.conf import settings
+
+from ..crops.crop_engine import CropEngine
+from ..crops.crop_scheduler import CropScheduler
+
+MISSING_FILENAME = "MISSING.txt"
+
+
+class TarBuffer(io.RawIOBase):
+    """
+    Write-only file object that holds the compressed archive until it is drained
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _add_member(tar, filename, content):
+    info = tarfile.TarInfo(name=filename)
+    info.size = len(content)
+    info.mtime = time.time()
+    tar.addfile(info, io.BytesIO(content))
+
+
+def _missing_report(missing):
+    return "\n".join(
+        ["These characters could not be fetched from the image server:", *missing, ""]
+    ).encode()
+
+
+def _http_client_options():
+    return {
+        "verify": settings.CA_CERT_ROUTE,
+        "timeout": settings.IIIF_TIMEOUT,
+        "limits": httpx.Limits(max_connections=settings.IIIF_MAX_CONNECTIONS),
+    }
+
+
+def _fetch(client, character, url_attr="full_tif"):
+    res = client.get(getattr(character, url_attr))
+    res.raise_for_status()
+    return res.content
+
+
+def fetch_crops(characters):
+    """
+    Yield (character, content) as each crop is ready, with content None if it could not be fetched
+    """
+    engine = CropEngine.from_settings()
+    if engine is not None:
+        characters, remote = engine.partition(characters)
+        yield from CropScheduler(engine).crops(characters)
+        characters = remote
+    yield from fetch_remote_crops(characters)
+
+
+def fetch_remote_crops(characters, url_attr="full_tif"):
+    """
+    Yield (character, content) from the IIIF server as each crop arrives, requesting the URL in each character's `url_attr`
+    """
+    n = settings.IIIF_MAX_CONNECTIONS
+    characters = iter(characters)
+    with httpx.Client(**_http_client_options()) as client, ThreadPoolExecutor(
+        max_workers=n
+    ) as executor:
+        pending = {
+            executor.submit(_fetch, client, character, url_attr): character
+            for character in islice(characters, n)
+        }
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    character = pending.pop(future)
+                    try:
+                        content = future.result()
+                    except httpx.HTTPError as err:
+                        url = getattr(character, url_attr)
+                        logging.error({f"Could not fetch {url}": str(err)})
+                        content = None
+                    for next_character in islice(characters, 1):
+                        pending[
+                            executor.submit(_fetch, client, next_character, url_attr)
+                        ] = next_character
+                    yield character, content
+        finally:
+            # The client went away: don't start the remaining fetches
+            for future in pending:
+                future.cancel()
+
+
+async def _afetch(client, character):
+    res = await client.get(character.full_tif)
+    res.raise_for_status()
+    return res.content
+
+
+async def iterate_in_thread(iterator):
+    """
+    Iterate a blocking generator without blocking the event loop
+    """
+    done = object()
+    try:
+        while (item := await asyncio.to_thread(next, iterator, done)) is not done:
+            yield item
+    finally:
+        await asyncio.to_thread(iterator.close)
+
+
+async def afetch_crops(characters):
+    """
+    Async version of fetch_crops
+    """
+    # Both look for the books' images on the shared filesystem
+    engine = await asyncio.to_thread(CropEngine.from_settings)
+    if engine is not None:
+        characters, remote = await asyncio.to_thread(engine.partition, characters)
+        async for crop in iterate_in_thread(CropScheduler(engine).crops(characters)):
+            yield crop
+        characters = remote
+    async for crop in afetch_remote_crops(characters):
+        yield crop
+
+
+async def afetch_remote_crops(characters):
+    """
+    Async version of fetch_remote_crops
+    """
+    n = settings.IIIF_MAX_CONNECTIONS
+    characters = iter(characters)
+    async with httpx.AsyncClient(**_http_client_options()) as client:
+        pending = {
+            asyncio.ensure_future(_afetch(client, character)): character
+            for character in islice(characters, n)
+        }
+        try:
+            while pending:
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    character = pending.pop(task)
+                    try:
+                        content = task.result()
+                    except httpx.HTTPError as err:
+                        logging.error(
+                            {f"Could not fetch {character.full_tif}": str(err)}
+                        )
+                        content = None
+                    for next_character in islice(characters, 1):
+                        pending[
+                            asyncio.ensure_future(_afetch(client, next_character))
+                        ] = next_character
+                    yield character, content
+        finally:
+            # The client went away: stop fetching
+            for task in pending:
+                task.cancel()
+
+
+def stream_character_tar(characters):
+    """
+    Yield a tar.gz of the characters' crops, named after their labels, chunk by chunk
+    """
+    buffer = TarBuffer()
+    missing = []
+    with tarfile.open(fileobj=buffer, mode="w|gz") as tar:
+        for character, content in fetch_crops(characters):
+            if content is None:
+                missing.append(character.label)
+                continue
+            _add_member(tar, f"{character.label}.tif", content)
+            yield buffer.drain()
+        if missing:
+            _add_member(tar, MISSING_FILENAME, _missing_report(missing))
+    yield buffer.drain()
+
+
+async def astream_character_tar(characters):
+    """
+    Async version of stream_character_tar
+    """
+    buffer = TarBuffer()
+    missing = []
+    with tarfile.open(fileobj=buffer, mode="w|gz") as tar:
+        async for character, content in afetch_crops(characters):
+            if content is None:
+                missing.append(character.label)
+                continue
+            _add_member(tar, f"{character.label}.tif", content)
+            yield buffer.drain()
+        if missing:
+            _add_member(tar, MISSING_FILENAME, _missing_report(missing))
+    yield buffer.drain()
@@ -0,0 +1,70 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.utils import load_backend
+from rest_framework.test import APIClient
+from statistics import mean, quantiles
+from tqdm import tqdm
+import time
+from web.pooled_postgresql.base import close_idle_connections
+
+ENGINES = {
+    "unpooled": "django.db.backends.postgresql",
+    "pooled": "web.pooled_postgresql",
+}
+
+
+class Command(BaseCommand):
+    help = "Compare per-request latency of an API endpoint with and without pooled database connections"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-n",
+            "--requests",
+            dest="requests",
+            type=int,
+            default=200,
+            help="Number of requests to time for each engine",
+        )
+        parser.add_argument(
+            "-p",
+            "--path",
+            dest="path",
+            default="/api/books/?limit=1",
+            help="API path to request",
+        )
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(is_superuser=True).first()
+        default = connections["default"]
+        default.close()
+        try:
+            for name, engine in ENGINES.items():
+                self.benchmark(name, engine, user, options["path"], options["requests"])
+        finally:
+            close_idle_connections()
+            connections["default"] = default
+
+    def benchmark(self, name, engine, user, path, n_requests):
+        db = load_backend(engine).DatabaseWrapper(
+            {**settings.DATABASES["default"], "ENGINE": engine}, "default"
+        )
+        connections["default"] = db
+        client = APIClient()
+        client.force_authenticate(user=user)
+        # The test client leaves connections open between requests, so close them the way the request_finished signal does when CONN_MAX_AGE = 0
+        client.get(path)
+        db.close()
+        timings = []
+        for i in tqdm(range(n_requests), desc=name):
+            start = time.perf_counter()
+            res = client.get(path)
+            db.close()
+            timings.append((time.perf_counter() - start) * 1000)
+        if res.status_code != 200:
+            self.stderr.write(f"{path} returned {res.status_code}")
+        percentiles = quantiles(timings, n=100)
+        self.stdout.write(
+            f"{name}: mean {mean(timings):.2f} ms, p50 {percentiles[49]:.2f} ms, p95 {percentiles[94]:.2f} ms"
+        )
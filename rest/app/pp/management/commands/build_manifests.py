@@ -0,0 +1,60 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from pp import models
+from pp.manifest.stored_manifests import build_manifest
+from tqdm import tqdm
+
+
+def _build(page_run):
+    try:
+        return build_manifest(page_run)
+    except Exception as err:
+        logging.error({f"Error generating manifest of page run {page_run.pk}": err})
+        return None
+    finally:
+        # Each worker thread opens its own connection
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = "Generate and store the IIIF manifest of each book's current page run ahead of time, several books at once"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-b",
+            "--book_id",
+            dest="book_id",
+            help="Only build the manifest of this book UUID",
+        )
+        parser.add_argument(
+            "-w",
+            "--workers",
+            dest="workers",
+            type=int,
+            default=4,
+            help="Number of manifests to build at once",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Rebuild manifests that are already stored",
+        )
+
+    def handle(self, *args, **options):
+        books = models.Book.objects.all()
+        if options["book_id"] is not None:
+            books = books.filter(id=options["book_id"])
+        page_runs = models.PageRun.objects.select_related("book").filter(
+            id__in=[book.current_run_id("page") for book in books]
+        )
+        if not options["force"]:
+            page_runs = page_runs.filter(manifest__isnull=True)
+        page_runs = list(page_runs)
+
+        with ThreadPoolExecutor(max_workers=options["workers"]) as pool:
+            manifests = list(tqdm(pool.map(_build, page_runs), total=len(page_runs)))
+        built = sum(manifest is not None for manifest in manifests)
+        self.stdout.write(f"Built {built} of {len(page_runs)} manifests")
@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from pp import models
+from pp.crops.sprites import build_sprite
+from tqdm import tqdm
+
+
+class Command(BaseCommand):
+    help = "Pack the thumbnails of each character grouping into a sprite ahead of time, so the first request for one doesn't have to"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-g",
+            "--grouping_id",
+            dest="grouping_id",
+            help="Only build the sprite of this character grouping ID",
+        )
+        parser.add_argument(
+            "-s",
+            "--size",
+            dest="size",
+            type=int,
+            default=settings.SPRITE_THUMBNAIL_SIZE,
+            help="Largest edge of each thumbnail, in pixels",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Repack sprites that are already built, e.g. after a thumbnail could not be fetched",
+        )
+
+    def handle(self, *args, **options):
+        groupings = models.CharacterGrouping.objects.all()
+        if options["grouping_id"] is not None:
+            groupings = groupings.filter(id=options["grouping_id"])
+
+        for grouping in tqdm(groupings, total=groupings.count()):
+            characters = list(
+                models.Character.objects.filter(
+                    charactergroupings=grouping
+                ).select_related("line__page")
+            )
+            if not 1 <= len(characters) <= settings.SPRITE_MAX_CHARACTERS:
+                continue
+            build_sprite(characters, options["size"], force=options["force"])
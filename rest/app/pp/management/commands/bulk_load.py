@@ -1,13 +1,28 @@
 from pp import models
+from pp.crops.image_sizes import set_image_sizes
+from pp.manifest.stored_manifests import rebuild_manifest_on_commit
+from pp.matches.nn_index import store_features
 from django.core.management.base import BaseCommand
 import json
 import logging
 from uuid import UUID
 from django.db import transaction, DatabaseError
+from django.db.models import F
 
 TIF_ROOT = "/ocean/projects/hum160002p/shared"
 
 
+def unstored(model, objects):
+    """
+    The objects that bulk_create(ignore_conflicts=True) would insert: the first of each ID, where that ID isn't stored yet
+    """
+    by_id = {}
+    for obj in objects:
+        by_id.setdefault(UUID(str(obj.id)), obj)
+    stored = set(model.objects.filter(id__in=list(by_id)).values_list("id", flat=True))
+    return [obj for obj_id, obj in by_id.items() if obj_id not in stored]
+
+
 class Command(BaseCommand):
     help = "Load segmented book components from a directory path"
 
@@ -128,10 +143,17 @@ class BookLoader:
             )
             for page in pages_json
         ]
+        # Pages whose ID is already stored would be skipped
+        page_list = unstored(models.Page, page_list)
+        set_image_sizes(page_list)
         # Bulk save to DB
         models.Page.objects.bulk_create(
             page_list, batch_size=500, ignore_conflicts=True
         )
+        models.BookStats.add_pages(page_run, len(page_list))
+        # The newest run supplies the cover page, from the pages actually stored
+        book.refresh_cover_page()
+        rebuild_manifest_on_commit(page_run)
         return page_list
 
     @staticmethod
@@ -153,10 +175,13 @@ class BookLoader:
             )
             for line in lines_json
         ]
+        # Lines whose ID is already stored would be skipped
+        line_list = unstored(models.Line, line_list)
         # Bulk save to DB
         models.Line.objects.bulk_create(
             line_list, batch_size=500, ignore_conflicts=True
         )
+        models.BookStats.add_lines(line_run, len(line_list))
         return line_list
 
     @staticmethod
@@ -200,12 +225,30 @@ class BookLoader:
             except:
                 logging.error(f"Failing char object at index {i}: {character}")
                 raise
+        # Characters whose ID is already stored are skipped, so only count the new ones. The run may already hold earlier batches.
+        new_characters = unstored(models.Character, character_list)
         # Bulk save to DB
         models.Character.objects.bulk_create(
-            character_list, batch_size=500, ignore_conflicts=True
+            new_characters, batch_size=500, ignore_conflicts=True
         )
-        logging.info({"Saved characters to the database": len(character_list)})
-        return character_list
+        # Feature vectors for similarity search are optional
+        store_features(
+            {
+                character["id"]: character["features"]
+                for character in characters_json
+                if character["character_class"] and character.get("features")
+            }
+        )
+        # Percentiles are left stale until the run is complete
+        models.BookStats.add_characters(
+            character_run,
+            [(c.character_class_id, c.damage_score) for c in new_characters],
+        )
+        models.Book.objects.filter(pk=character_run.book_id).update(
+            n_characters=F("n_characters") + len(new_characters)
+        )
+        logging.info({"Saved characters to the database": len(new_characters)})
+        return new_characters
 
     @transaction.atomic
     def create_pages(self):
@@ -225,6 +268,10 @@ class BookLoader:
         try:
             character_list = BookLoader.create_characters_for_book(self.characters, character_run)
             logging.info({"characters created": len(character_list)})
+            # The whole run is loaded
+            models.BookStats.refresh_stale_percentiles(
+                models.BookStats.objects.filter(character_run=character_run)
+            )
         except DatabaseError as err:
             character_run.delete()
             logging.error(f"No characters created, error creating character run - {str(err)}")
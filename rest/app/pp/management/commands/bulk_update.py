@@ -1,4 +1,7 @@
 from pp import models
+from pp.crops.image_sizes import set_image_sizes
+from pp.manifest.stored_manifests import rebuild_manifest_on_commit
+from pp.matches.nn_index import store_features
 from django.core.management.base import BaseCommand
 import json
 import logging
@@ -127,12 +130,14 @@ class BookLoader:
             )
             for page in pages_json
         ]
+        set_image_sizes(page_list)
         # Bulk save to DB
         models.Page.objects.bulk_update(
             page_list,
             batch_size=500,
-            fields=["sequence", "side", "tif"],
+            fields=["sequence", "side", "tif", "width", "height"],
         )
+        rebuild_manifest_on_commit(page_run)
         return page_list
 
     @staticmethod
@@ -172,6 +177,15 @@ class BookLoader:
             models.CharacterClass.objects.all().values_list("classname", flat=True),
             field_name="classname",
         )
+        # Class and damage score of each character before the update, to move it in the run's stats
+        stored = models.Character.objects.filter(
+            id__in=[character["id"] for character in characters_json]
+        ).values_list("id", "character_class", "damage_score")
+        previous = {
+            str(character_id): (character_class, damage_score)
+            for character_id, character_class, damage_score in stored
+        }
+        current = {}
         logging.info("Updating characters...")
         # Update Characters one at a time
         character_count = 0
@@ -194,26 +208,51 @@ class BookLoader:
                     ],
                 )
                 character_count += 1
+                current[str(UUID(character["id"]))] = (
+                    character_class_objects[character["character_class"]].pk,
+                    character.get("damage_score", None),
+                )
             except Exception as ex:
                 logging.error({f"Failing char object at index {i}: {character}": str(ex)})
                 raise
+        # Feature vectors for similarity search are optional
+        store_features(
+            {
+                character["id"]: character["features"]
+                for character in characters_json
+                if character["character_class"] and character.get("features")
+            }
+        )
         logging.info({"Update complete": character_count})
+        # Characters that weren't stored are neither updated nor counted
+        models.BookStats.add_characters(
+            character_run,
+            [current[character_id] for character_id in previous],
+            removed=list(previous.values()),
+        )
+        models.ClassConfusion.refresh_run(character_run)
         return character_count
 
+    @transaction.atomic
+    def update_pages(self):
+        page_list = BookLoader.update_pages_for_book(self.pages, TIF_ROOT)
+        logging.info({"pages updated": len(page_list)})
 
-@transaction.atomic
-def update_pages(self):
-    page_list = BookLoader.update_pages_for_book(self.pages, TIF_ROOT)
-    logging.info({"pages updated": len(page_list)})
-
-
-@transaction.atomic
-def update_lines(self):
-    line_list = self.update_lines_for_book(self.lines)
-    logging.info({"lines updated": len(line_list)})
-
+    @transaction.atomic
+    def update_lines(self):
+        line_list = BookLoader.update_lines_for_book(self.lines)
+        logging.info({"lines updated": len(line_list)})
 
-@transaction.atomic
-def update_characters(self):
-    character_count = self.update_characters_for_book(self.characters)
-    logging.info({"characters updated": character_count})
+    @transaction.atomic
+    def update_characters(self):
+        character_run = models.CharacterRun.objects.get(
+            characters=self.characters[0]["id"]
+        )
+        character_count = BookLoader.update_characters_for_book(
+            self.characters, character_run
+        )
+        logging.info({"characters updated": character_count})
+        # The whole run is updated
+        models.BookStats.refresh_stale_percentiles(
+            models.BookStats.objects.filter(character_run=character_run)
+        )
@@ -0,0 +1,49 @@
+import os
+
+from django.core.management.base import BaseCommand
+from pp import models
+from pp.matches.import_topk_matches import find_topk_csvs, import_topk_csv
+from pp.views import BASE_PATH, TOP_K_CSV_SUFFIX
+from tqdm import tqdm
+
+
+class Command(BaseCommand):
+    help = "Import the top-k match CSVs of each book into the database, skipping files that haven't changed since their last import"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-b",
+            "--book_id",
+            dest="book_id",
+            help="Only import the matches of this book UUID",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Re-import files even if they are unchanged",
+        )
+
+    def handle(self, *args, **options):
+        books = models.Book.objects.all()
+        if options["book_id"] is not None:
+            books = books.filter(id=options["book_id"])
+
+        for book in tqdm(books, total=books.count()):
+            one_page = models.Page.objects.filter(
+                created_by_run__book=book, tif__isnull=False
+            ).first()
+            if one_page is None:
+                continue
+            matches_path = os.path.join(BASE_PATH, *one_page.tif.split("/")[0:4])
+            if not os.path.isdir(matches_path):
+                continue
+            for matches_dir, character_class, csv_file in find_topk_csvs(
+                matches_path, TOP_K_CSV_SUFFIX
+            ):
+                match_set, imported = import_topk_csv(
+                    book, matches_dir, character_class, csv_file, force=options["force"]
+                )
+                if imported:
+                    self.stdout.write(
+                        f"Imported {match_set.n_queries} queries from {csv_file}"
+                    )
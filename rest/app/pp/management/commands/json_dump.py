@@ -2,6 +2,7 @@ from django.conf import settings
 from django.core.management.base import BaseCommand
 from pp import models
 from pp import static_serializers as serializers
+from web.db_router import replica_reads
 import json
 from tqdm import tqdm
 from uuid import UUID
@@ -47,6 +48,11 @@ class Command(BaseCommand):
     help = "Serialize data to JSON documents"
 
     def handle(self, *args, **options):
+        # Read-only, so it can run against a replica when one is configured
+        with replica_reads():
+            self.dump()
+
+    def dump(self):
         OUTPUT_PATH = "serialized_json"
 
         groupings = models.CharacterGrouping.objects.all()
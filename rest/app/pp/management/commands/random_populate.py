@@ -6,10 +6,25 @@ import string
 from tqdm import tqdm
 from django.core import management
 from django.core.management.base import BaseCommand
+from django.db import connection
 from concurrent.futures import ThreadPoolExecutor
 import os
 
 
+def releases_connection(func):
+    """
+    Close a worker thread's database connection (returning it to the pool, if pooled) once its task is done, as Django does at the end of a request
+    """
+
+    def worker(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            connection.close()
+
+    return worker
+
+
 class Command(BaseCommand):
     help = "Fill database with random images"
 
@@ -73,6 +88,7 @@ class Command(BaseCommand):
 
         print("Generating lines")
 
+        @releases_connection
         def gen_lines(book):
             line_run = models.LineRun.objects.create(book=book)
             for page in tqdm(
@@ -97,6 +113,7 @@ class Command(BaseCommand):
 
         print("Generating linegroups")
 
+        @releases_connection
         def gen_linegroups(book):
             linegroup_run = models.LineGroupRun.objects.create(book=book)
             for page in tqdm(
@@ -127,6 +144,7 @@ class Command(BaseCommand):
 
         print("Generating characters")
 
+        @releases_connection
         def gen_chars(book):
             character_run = models.CharacterRun.objects.create(book=book)
             book_lines = models.Line.objects.filter(page__spread__book=book).all()
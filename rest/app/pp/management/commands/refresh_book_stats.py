@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from pp import models
+from tqdm import tqdm
+
+
+class Command(BaseCommand):
+    help = "Rebuild the precomputed BookStats and ClassConfusion summaries for every run, and the character counts and BookMatchSummary of each Book"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-b",
+            "--book_id",
+            dest="book_id",
+            help="Only rebuild statistics for the runs of this book UUID",
+        )
+
+    def handle(self, *args, **options):
+        book_id = options["book_id"]
+
+        for m in [models.PageRun, models.LineRun, models.CharacterRun]:
+            print(m)
+            qs = m.objects.all()
+            if book_id is not None:
+                qs = qs.filter(book_id=book_id)
+            for run in tqdm(qs, total=qs.count()):
+                models.BookStats.refresh_run(run)
+                if m is models.CharacterRun:
+                    models.ClassConfusion.refresh_run(run)
+
+        books = models.Book.objects.all()
+        if book_id is not None:
+            books = books.filter(id=book_id)
+        models.Book.refresh_character_counts(books.values("id"))
+        models.BookMatchSummary.refresh(
+            None if book_id is None else books.values_list("id", flat=True)
+        )
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from pp import models
+from pp.crops.image_sizes import set_image_sizes
+from tqdm import tqdm
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = "Read the width and height of Page and Spread images from their TIFF headers, for those ingested before sizes were stored"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-b",
+            "--book_id",
+            dest="book_id",
+            help="Only read the images of this book UUID",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Re-read images whose size is already stored",
+        )
+
+    def handle(self, *args, **options):
+        for model, book_field in [
+            (models.Page, "created_by_run__book"),
+            (models.Spread, "book"),
+        ]:
+            objects = model.objects.exclude(tif="").only("id", "tif")
+            if options["book_id"] is not None:
+                objects = objects.filter(**{book_field: options["book_id"]})
+            if not options["force"]:
+                objects = objects.filter(width__isnull=True)
+            ids = list(objects.values_list("id", flat=True))
+            for start in tqdm(range(0, len(ids), BATCH_SIZE)):
+                batch = set_image_sizes(
+                    list(objects.filter(id__in=ids[start : start + BATCH_SIZE]))
+                )
+                model.objects.bulk_update(batch, ["width", "height"])
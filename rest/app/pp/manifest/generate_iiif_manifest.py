@@ -1,12 +1,13 @@
+import asyncio
 import os.path
-from datetime import date
-import ssl
 
+import httpx
 import logging
-from iiif_prezi.factory import ManifestFactory
 
 from django.conf import settings
 
+from .manifest_writer import write_manifest
+
 BASE_PATH = '/ocean/projects/hum160002p/shared/'
 
 
@@ -22,40 +23,88 @@ def _fix_originals_path(input_path):
     return originals_path
 
 
-def generate_iiif_manifest(book, pages, images_dir_path):
+def _manifest_paths(images_dir_path):
+    """
+    Directory on disk holding a book's original images, and its path relative to BASE_PATH
+    """
     page_images = False
     if 'pages_color' in images_dir_path:
         page_images = True
     images_dir_path = _fix_originals_path(images_dir_path)
+    if images_dir_path is None:
+        return None, None, page_images
     images_path = images_dir_path.split(BASE_PATH)[1]
-    if images_path is None or images_dir_path is None:
-        logging.error({ "Image path not found": images_dir_path})
+    return images_dir_path, images_path, page_images
+
+
+def _original_image(tif, page_images):
+    original_image = tif.split('/')[-1]
+    if not page_images:
+        original_image = original_image.split('_page')[0]+'.tif'
+    return original_image
+
+
+def image_key(images_path, image):
+    """
+    Path of a manifest image relative to the image root, comparable to Page.tif and Spread.tif without their leading slash
+    """
+    return f"{images_path}/{image}".lstrip('/')
+
+
+def manifest_location(tif):
+    """
+    (images_path, page_images) for the original images shown by the manifest of a book with a page at `tif`, or None if they can't be found
+    """
+    pages_dir_path = os.path.join(BASE_PATH, *tif.split('/')[0:5])
+    images_dir_path, images_path, page_images = _manifest_paths(pages_dir_path)
+    if images_dir_path is None:
+        logging.error({ "Image path not found": pages_dir_path})
         return None
+    return images_path, page_images
+
+
+def canvas_images(page_rows, images_path, page_images, sizes):
+    """
+    Yield (image, (height, width) or None) for each (tif, height, width) of `page_rows`. A page's own size is used when it is the image the manifest shows; otherwise the size is looked up in `sizes` by image_key.
+    """
+    for tif, height, width in page_rows:
+        image = _original_image(tif, page_images)
+        key = image_key(images_path, image)
+        if tif.lstrip('/') == key and height is not None and width is not None:
+            yield image, (height, width)
+        else:
+            yield image, sizes.get(key)
+
+
+def generate_iiif_manifest(book, page_rows, images_path, page_images, sizes, start=0, stop=None):
+    """
+    Yield the JSON of the manifest of `page_rows`, (tif, height, width) of consecutive pages from page `start`, in pieces. Every image must have a size, see canvas_images. With `stop`, the manifest only covers pages start to stop - 1.
+    """
+    base_uri = settings.IMAGE_BASEURL+images_path
+    images = (
+        (image, height, width)
+        for image, (height, width) in canvas_images(page_rows, images_path, page_images, sizes)
+    )
+    return write_manifest(book.id, base_uri, images, start, stop)
+
+
+async def _fetch_dimensions(client, semaphore, info_url):
+    async with semaphore:
+        res = await client.get(info_url)
+    res.raise_for_status()
+    info = res.json()
+    return int(info['height']), int(info['width'])
+
 
-    logging.info({"Generating manifest for images path : ", images_path})
-    logging.info({"Setting directory on disk for images : ", images_dir_path})
-    factory = ManifestFactory()
-    factory.set_iiif_image_info(2.0, 2) # Version, ComplianceLevel
-    factory.set_base_prezi_uri(settings.IMAGE_BASEURL+images_path)
-    factory.set_base_prezi_dir(images_dir_path)
-    factory.set_base_image_uri(settings.IMAGE_BASEURL+images_path)
-    factory.set_base_image_dir(images_dir_path)
-
-    manifest = factory.manifest(label=f'Manifest for book - {book.id}')
-    manifest.set_metadata({"Date":  str(date.today())})
-    manifest.viewingDirection = "left-to-right"
-    manifest.viewingHint = "paged"
-    manifest.description = "manifest"
-    seq = manifest.sequence(ident="normal", label="Normal Order")
-    ctx = ssl._create_default_https_context
-    ssl._create_default_https_context = ssl._create_unverified_context
-
-    for i, page in enumerate(pages):
-        cvs = seq.canvas(ident="page-%s" % i, label="Page %s" % i)
-        original_image = page.tif.split('/')[-1]
-        if not page_images:
-            original_image = original_image.split('_page')[0]+'.tif'
-        cvs.set_image_annotation(original_image, iiif=True)
-    logging.info("Finished generating manifest")
-    ssl._create_default_https_context = ctx
-    return manifest.toString(compact=True)
+async def afetch_sizes(images_path, images):
+    """
+    {image_key: (height, width)} of `images`, from their info.json on the IIIF server, requested concurrently
+    """
+    semaphore = asyncio.Semaphore(settings.IIIF_MAX_CONNECTIONS)
+    limits = httpx.Limits(max_connections=settings.IIIF_MAX_CONNECTIONS)
+    async with httpx.AsyncClient(verify=settings.CA_CERT_ROUTE, limits=limits, timeout=settings.IIIF_TIMEOUT) as client:
+        sizes = await asyncio.gather(*[
+            _fetch_dimensions(client, semaphore, f"{settings.IMAGE_BASEURL}{images_path}/{image}/info.json")
+            for image in images
+        ])
+    return {image_key(images_path, image): size for image, size in zip(images, sizes)}
@@ -0,0 +1,97 @@
+"""
+Write IIIF Presentation 2 manifests straight to JSON text, one canvas at a time, instead of building the whole iiif_prezi object graph and serializing it at the end. The output is the same as iiif_prezi's, and memory use doesn't grow with the number of pages, so manifests can be streamed.
+
+A manifest may cover a window of a book's pages only. Its canvases then keep the IDs they have in the full manifest, and it gets a range listing them, so viewers can load a long book piece by piece.
+"""
+import json
+from datetime import date
+
+PRESENTATION_CONTEXT = "http://iiif.io/api/presentation/2/context.json"
+IMAGE_CONTEXT = "http://iiif.io/api/image/2/context.json"
+IMAGE_PROFILE = "http://iiif.io/api/image/2/level2.json"
+
+
+def _dumps(obj):
+    return json.dumps(obj, separators=(",", ":"))
+
+
+def manifest_id(base_uri):
+    return f"{base_uri}/manifest.json"
+
+
+def canvas_id(base_uri, index):
+    return f"{base_uri}/canvas/page-{index}.json"
+
+
+def canvas(base_uri, index, image, height, width):
+    """
+    The canvas of the `index`th page, painted with `image`, a IIIF image identifier under base_uri
+    """
+    on = canvas_id(base_uri, index)
+    return {
+        "@id": on,
+        "@type": "sc:Canvas",
+        "label": f"Page {index}",
+        "height": height,
+        "width": width,
+        "images": [
+            {
+                "@type": "oa:Annotation",
+                "motivation": "sc:painting",
+                "resource": {
+                    "@id": f"{base_uri}/{image}/full/full/0/default.jpg",
+                    "@type": "dctypes:Image",
+                    "format": "image/jpeg",
+                    "height": height,
+                    "width": width,
+                    "service": {
+                        "@context": IMAGE_CONTEXT,
+                        "@id": f"{base_uri}/{image}",
+                        "profile": IMAGE_PROFILE,
+                    },
+                },
+                "on": on,
+            }
+        ],
+    }
+
+
+def write_manifest(book_id, base_uri, images, start=0, stop=None):
+    """
+    Yield the JSON of a manifest in pieces. `images` are the (image, height, width) of consecutive pages, the first being page `start`. If `stop` is given, the manifest is a partial one covering pages start to stop - 1, which `images` must list exactly.
+    """
+    header = {
+        "@context": PRESENTATION_CONTEXT,
+        "@id": manifest_id(base_uri),
+        "@type": "sc:Manifest",
+        "label": f"Manifest for book - {book_id}",
+        "metadata": [{"label": "Date", "value": str(date.today())}],
+        "description": "manifest",
+        "viewingDirection": "left-to-right",
+        "viewingHint": "paged",
+    }
+    if stop is not None:
+        header["@id"] = f"{base_uri}/manifest/pages-{start}-{stop - 1}.json"
+        header["within"] = manifest_id(base_uri)
+    sequence = {
+        "@id": f"{base_uri}/sequence/normal.json",
+        "@type": "sc:Sequence",
+        "label": "Normal Order",
+    }
+    # Both objects are left open, for the canvases to be written into
+    yield _dumps(header)[:-1] + ',"sequences":[' + _dumps(sequence)[:-1]
+    yield ',"canvases":['
+    for i, (image, height, width) in enumerate(images):
+        yield ("," if i > 0 else "") + _dumps(
+            canvas(base_uri, start + i, image, height, width)
+        )
+    yield "]}]"
+    if stop is not None:
+        pages = {
+            "@id": f"{base_uri}/range/pages-{start}-{stop - 1}.json",
+            "@type": "sc:Range",
+            "label": f"Pages {start}-{stop - 1}",
+            "canvases": [canvas_id(base_uri, i) for i in range(start, stop)],
+        }
+        yield ',"structures":[' + _dumps(pages) + "]"
+    yield "}"
@@ -0,0 +1,199 @@
+"""
+Generate the IIIF manifest of each page run once and keep it in the Manifest table, so that requests for a book's manifest don't load every page, stat the shared filesystem and ask the IIIF server for every image's size. Images whose size was stored when their Page or Spread was ingested are not asked for at all.
+
+Manifests are written by pp/manifest/manifest_writer.py from a values() query of the pages, so neither generating a whole one nor streaming a window of pages holds every page in memory.
+
+A run's manifest is regenerated when its pages are ingested or updated in bulk. Saving or deleting a single Page drops its run's manifest, and a Spread drops those of its book, to be generated again on their next request. Requests are answered from the manifest of the book's current page run, generating it first if it was never stored.
+"""
+import logging
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.db import transaction
+
+from .. import models
+from .generate_iiif_manifest import (
+    afetch_sizes,
+    canvas_images,
+    generate_iiif_manifest,
+    manifest_location,
+)
+
+
+class ManifestPages:
+    """
+    The pages of a page run, or the window of them from `start` to `stop` - 1, to write into a manifest straight from a values() query
+    """
+
+    def __init__(self, page_run, start=0, stop=None):
+        self.page_run = page_run
+        self.start = start
+        self.stop = stop
+        # (height, width) of manifest images by image_key, besides those stored with their page
+        self.sizes = {}
+        self.missing = []
+
+    @property
+    def pages(self):
+        return self.page_run.pages.filter(tif__isnull=False)
+
+    @property
+    def rows(self):
+        return self.pages.values_list("tif", "height", "width")[self.start : self.stop]
+
+    def prepare(self):
+        """
+        Find the original images of the run and the sizes stored for them, listing in `missing` the images whose size is unknown. False if the run has no pages or their original images can't be found.
+        """
+        self.n_pages = self.pages.count()
+        if self.stop is not None:
+            self.stop = min(self.stop, self.n_pages)
+        first = self.pages.values_list("tif", flat=True).first()
+        location = None if first is None else manifest_location(first)
+        if location is None:
+            return False
+        self.images_path, self.page_images = location
+        spreads = models.Spread.objects.filter(
+            book_id=self.page_run.book_id, width__isnull=False, height__isnull=False
+        ).values_list("tif", "height", "width")
+        self.sizes = {
+            tif.lstrip("/"): (height, width) for tif, height, width in spreads
+        }
+        images = canvas_images(
+            self.rows.iterator(), self.images_path, self.page_images, self.sizes
+        )
+        self.missing = list(dict.fromkeys(i for i, size in images if size is None))
+        return True
+
+    def chunks(self):
+        """
+        Yield the manifest JSON in pieces, reading the pages as it goes
+        """
+        return generate_iiif_manifest(
+            self.page_run.book,
+            self.rows.iterator(),
+            self.images_path,
+            self.page_images,
+            self.sizes,
+            self.start,
+            self.stop,
+        )
+
+
+def prepare_manifest(page_run, start=0, stop=None):
+    """
+    ManifestPages of a page run with the size of every image known, fetching those that aren't stored from the IIIF server. None if the run has no pages or their original images can't be found.
+    """
+    pages = ManifestPages(page_run, start, stop)
+    if not pages.prepare():
+        return None
+    if pages.missing:
+        pages.sizes.update(
+            async_to_sync(afetch_sizes)(pages.images_path, pages.missing)
+        )
+    return pages
+
+
+async def aprepare_manifest(page_run, start=0, stop=None):
+    """
+    Async version of prepare_manifest. `page_run` must have its book loaded.
+    """
+    pages = ManifestPages(page_run, start, stop)
+    if not await sync_to_async(pages.prepare)():
+        return None
+    if pages.missing:
+        pages.sizes.update(await afetch_sizes(pages.images_path, pages.missing))
+    return pages
+
+
+def _store(pages):
+    return models.Manifest.store(pages.page_run, "".join(pages.chunks()))
+
+
+def build_manifest(page_run):
+    """
+    Generate and store the manifest of a page run. Returns None if the run has no pages or its original images can't be found.
+    """
+    pages = prepare_manifest(page_run)
+    if pages is None:
+        return None
+    return _store(pages)
+
+
+async def abuild_manifest(page_run):
+    """
+    Async version of build_manifest. `page_run` must have its book loaded.
+    """
+    pages = await aprepare_manifest(page_run)
+    if pages is None:
+        return None
+    return await sync_to_async(_store)(pages)
+
+
+def _current_page_run(book):
+    return (
+        models.PageRun.objects.select_related("book", "manifest")
+        .filter(pk=book.current_run_id("page"))
+        .first()
+    )
+
+
+def _stored_manifest(page_run):
+    try:
+        return page_run.manifest
+    except models.Manifest.DoesNotExist:
+        return None
+
+
+def get_manifest(book):
+    """
+    The stored manifest of a book's current page run, generating it if needed. None if the book has no pages or their original images can't be found.
+    """
+    page_run = _current_page_run(book)
+    if page_run is None:
+        return None
+    return _stored_manifest(page_run) or build_manifest(page_run)
+
+
+async def aget_manifest(book):
+    """
+    Async version of get_manifest
+    """
+    page_run = await sync_to_async(_current_page_run)(book)
+    if page_run is None:
+        return None
+    return _stored_manifest(page_run) or await abuild_manifest(page_run)
+
+
+def manifest_window(book, start, count):
+    """
+    Prepared ManifestPages of `count` pages of a book's current page run from page `start`, or None if the book has no pages or their original images can't be found
+    """
+    page_run = _current_page_run(book)
+    if page_run is None:
+        return None
+    return prepare_manifest(page_run, start, start + count)
+
+
+async def amanifest_window(book, start, count):
+    """
+    Async version of manifest_window
+    """
+    page_run = await sync_to_async(_current_page_run)(book)
+    if page_run is None:
+        return None
+    return await aprepare_manifest(page_run, start, start + count)
+
+
+def rebuild_manifest_on_commit(page_run):
+    """
+    Regenerate a page run's manifest once the current transaction commits. Failures are logged rather than raised, so that they never fail the ingest; the manifest is then generated on its first request.
+    """
+    models.Manifest.objects.filter(page_run=page_run).delete()
+
+    def rebuild():
+        try:
+            build_manifest(page_run)
+        except Exception as err:
+            logging.error({f"Error generating manifest of page run {page_run.pk}": err})
+
+    transaction.on_commit(rebuild)
@@ -1,10 +1,24 @@
+import asyncio
+import hashlib
 import json
 import logging
 import os
+from itertools import chain, islice
+from uuid import UUID
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache, caches
 
 from .. import serializers, models
 
 JSON_OUTPUT_DIR = '/ocean/projects/hum160002p/shared/ocr_results/json_output'
+# Rows between the byte offsets kept in a CSV index
+CSV_INDEX_INTERVAL = 1000
+CSV_INDEX_CACHE_SECONDS = 60 * 60 * 24
+MATCH_DIRECTORY_PREFIX = 'matching_output_'
+MATCH_DIRECTORIES_CACHE_SECONDS = 60 * 60 * 24
+# Serialized characters recur across the matches of many queries
+CHARACTER_MATCH_CACHE_SECONDS = 60 * 60
 
 
 def _get_immediate_subdirectories(a_dir, starting_with=None):
@@ -19,68 +33,261 @@ def _get_immediate_subdirectories(a_dir, starting_with=None):
     return result
 
 
-def get_match_directories(matches_path):
+def _match_directories_cache_key(matches_path):
+    return f"match_directories:{hashlib.sha1(matches_path.encode()).hexdigest()}"
+
+
+def _match_directory_names(matches_path, registry):
+    """
+    (mtime, names) of the match directories in matches_path, only listing it again if its mtime has changed since `registry` was made
+    """
+    mtime = os.stat(matches_path).st_mtime_ns
+    if registry is not None and registry['mtime'] == mtime:
+        return mtime, list(registry['dirs'])
+    with os.scandir(matches_path) as entries:
+        names = [entry.name for entry in entries
+                 if entry.is_dir() and entry.name.startswith(MATCH_DIRECTORY_PREFIX)]
+    return mtime, names
+
+
+def _match_directory_entry(matches_path, name, registry):
+    """
+    Registry entry for one match directory, only listing its character classes again if its mtime has changed, or None if it is gone
+    """
+    try:
+        mtime = os.stat(os.path.join(matches_path, name)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    previous = None if registry is None else registry['dirs'].get(name)
+    if previous is not None and previous['mtime'] == mtime:
+        return previous
+    return {'mtime': mtime, 'character_classes': _get_immediate_subdirectories(os.path.join(matches_path, name))}
+
+
+def _registry(mtime, names, entries):
+    return {'mtime': mtime, 'dirs': {name: entry for name, entry in zip(names, entries) if entry is not None}}
+
+
+def _match_directories(registry):
     matches = []
-    all_match_directories = _get_immediate_subdirectories(matches_path, "matching_output_")
-    for idx, match_dir in enumerate(all_match_directories):
-        matches.append({})
-        matches[idx]['dir'] = match_dir
-        character_classes = _get_immediate_subdirectories(os.path.join(matches_path, match_dir))
-        if len(character_classes) == 0:
-            continue
-        matches[idx]['character_classes'] = character_classes
+    # Newest first
+    for match_dir, entry in sorted(registry['dirs'].items(), key=lambda item: item[1]['mtime'], reverse=True):
+        match = {'dir': match_dir}
+        if len(entry['character_classes']) > 0:
+            match['character_classes'] = entry['character_classes']
+        matches.append(match)
     return matches
 
 
-def _serialize_char(request, character_id):
-    obj = None
+def get_match_directories(matches_path):
+    """
+    Match directories in matches_path, newest first, with their character class subdirectories. Listings are kept in a registry in the cache, and a directory is only listed again once its mtime changes, so an unchanged book costs one stat of matches_path and one of each match directory.
+    """
+    cache_key = _match_directories_cache_key(matches_path)
+    registry = cache.get(cache_key)
+    mtime, names = _match_directory_names(matches_path, registry)
+    entries = [_match_directory_entry(matches_path, name, registry) for name in names]
+    registry = _registry(mtime, names, entries)
+    cache.set(cache_key, registry, MATCH_DIRECTORIES_CACHE_SECONDS)
+    return _match_directories(registry)
+
+
+async def aget_match_directories(matches_path):
+    """
+    Async version of get_match_directories that checks every match directory concurrently
+    """
+    cache_key = _match_directories_cache_key(matches_path)
+    registry = await sync_to_async(cache.get)(cache_key)
+    mtime, names = await asyncio.to_thread(_match_directory_names, matches_path, registry)
+    entries = await asyncio.gather(*[
+        asyncio.to_thread(_match_directory_entry, matches_path, name, registry)
+        for name in names
+    ])
+    registry = _registry(mtime, names, entries)
+    await sync_to_async(cache.set)(cache_key, registry, MATCH_DIRECTORIES_CACHE_SECONDS)
+    return _match_directories(registry)
+
+
+def _character_match_cache_key(character_id):
+    return f"character_match:{character_id}"
+
+
+def serialize_characters(request, character_ids):
+    """
+    CharacterMatchSerializer data for each of `character_ids`, keyed by ID. Characters serialized recently come from the character_matches LRU cache, and the rest are fetched in one query. IDs that aren't characters are left out.
+    """
+    character_ids = set(str(character_id) for character_id in character_ids)
+    cache_keys = {_character_match_cache_key(character_id): character_id for character_id in character_ids}
+    character_cache = caches['character_matches']
+    result = {cache_keys[key]: data for key, data in character_cache.get_many(cache_keys).items()}
+    uncached = []
+    for character_id in character_ids - result.keys():
+        try:
+            uncached.append(UUID(character_id))
+        except ValueError:
+            logging.error({"Error in finding matched character ": character_id})
+    if uncached:
+        characters = models.Character.objects.select_related('line__page').in_bulk(uncached)
+        serializer = serializers.CharacterMatchSerializer(
+            list(characters.values()), context={'request': request}, many=True
+        )
+        fetched = {str(data['id']): dict(data) for data in serializer.data}
+        character_cache.set_many(
+            {_character_match_cache_key(character_id): data for character_id, data in fetched.items()},
+            CHARACTER_MATCH_CACHE_SECONDS,
+        )
+        for character_id in uncached:
+            if str(character_id) not in fetched:
+                logging.error({"Error in finding matched character ": str(character_id)})
+        result.update(fetched)
+    return result
+
+
+def parse_topk_row(line):
+    """
+    (query, matches, distances) from one line of a top-k CSV, with the distances as floats like those of imported matches
+    """
+    row = line.rstrip('\n').split(',')
+    # rows have [query_uuids] + topk_uuid + dists
+    # e.g., for top 10:
+    # 11 + 10 = 21 -> 11
+    # for top 20:
+    # 21 + 20 = 41 -> 21
+    # for top 5:
+    # 6 + 5 = 11 -> 5
+    last_char_index = len(row) // 2 + 1
+    return row[0], row[1:last_char_index], [float(d) for d in row[last_char_index:]]
+
+
+def build_csv_index(csv_file):
+    """
+    Row count of a top-k CSV, and the byte offset of every CSV_INDEX_INTERVALth row
+    """
+    n_rows = 0
+    position = 0
+    offsets = []
+    with open(csv_file, 'rb') as f:
+        for line in f:
+            if n_rows % CSV_INDEX_INTERVAL == 0:
+                offsets.append(position)
+            position += len(line)
+            n_rows += 1
+    return {'n_rows': n_rows, 'offsets': offsets}
+
+
+def get_csv_index(csv_file):
+    """
+    build_csv_index for a CSV, cached until the file changes. Built on the first request for a file, after which counting its rows and finding any page take constant time.
+    """
+    stat = os.stat(csv_file)
+    file_hash = hashlib.sha1(json.dumps([csv_file, stat.st_mtime_ns, stat.st_size, CSV_INDEX_INTERVAL]).encode()).hexdigest()
+    cache_key = f"topk_csv_index:{file_hash}"
+    index = cache.get(cache_key)
+    if index is None:
+        index = build_csv_index(csv_file)
+        cache.set(cache_key, index, CSV_INDEX_CACHE_SECONDS)
+    return index
+
+
+def get_matched_characters(request, csv_file, limit, offset):
+    offsets = get_csv_index(csv_file)['offsets']
+    # Seek to the indexed row at or before offset, and read on from there
+    indexed_row, skip = divmod(offset, CSV_INDEX_INTERVAL)
+    if indexed_row >= len(offsets):
+        return []
+    with open(csv_file, 'rb') as csvfile:
+        csvfile.seek(offsets[indexed_row])
+        rows = [parse_topk_row(line.decode()) for line in islice(csvfile, skip, skip + limit)]
+    characters = serialize_characters(
+        request, chain.from_iterable([query, *matches] for query, matches, _ in rows)
+    )
+    return [
+        {
+            'target': characters.get(query),
+            'matches': [characters.get(match) for match in matches],
+            'distances': distances,
+        }
+        for query, matches, distances in rows
+    ]
+
+
+IMPORTED_MATCH_ORDERINGS = {
+    'row': ['row'],
+    'distance': ['distance', 'row'],
+    '-distance': ['-distance', 'row'],
+}
+
+
+def matched_characters_options(params):
+    """
+    (ordering, max_distance) from matched_characters query parameters, raising ValueError if they are invalid
+    """
+    ordering = params.get('ordering', 'row')
+    if ordering not in IMPORTED_MATCH_ORDERINGS:
+        raise ValueError(f"ordering must be one of {', '.join(IMPORTED_MATCH_ORDERINGS)}")
+    max_distance = params.get('max_distance')
+    if max_distance is not None:
+        try:
+            max_distance = float(max_distance)
+        except ValueError:
+            raise ValueError("max_distance must be a number")
+    return ordering, max_distance
+
+
+def get_imported_match_set(book_id, matches_dir, character_class):
+    """
+    The TopKMatchSet imported from a match directory's CSV for a character class, or None if it hasn't been imported or the CSV has changed since
+    """
+    match_set = models.TopKMatchSet.objects.filter(
+        book_id=book_id, directory=matches_dir, character_class=character_class
+    ).first()
+    if match_set is None:
+        return None
     try:
-        obj = models.Character.objects.get(id=character_id)
-    except models.Character.DoesNotExist as err:
-        logging.error({"Error in finding matched character ": character_id})
-        logging.error(err)
-    if obj is None:
+        mtime = os.path.getmtime(match_set.source)
+    except OSError:
+        # The imported rows are all that is left of the CSV
+        return match_set
+    if mtime != match_set.source_mtime:
+        logging.warning({"CSV changed since import_topk_matches, reading it instead": match_set.source})
         return None
-    serializer = serializers.CharacterMatchSerializer(obj, context={'request': request})
-    return json.loads(json.dumps(serializer.data))
+    return match_set
 
 
-def get_matched_characters(request, csv_file, limit, offset):
-    result = []
-    limit_count = 0
-    with open(csv_file, 'r') as csvfile:
-        idx = 0
-        for line in csvfile:
-            # continue till offset
-            if idx < offset:
-                idx += 1
-                continue
-            row = line.split(',')
-            # rows have [query_uuids] + topk_uuid + dists
-            # e.g., for top 10:
-            # 11 + 10 = 21 -> 11
-            # for top 20:
-            # 21 + 20 = 41 -> 21
-            # for top 5:
-            # 6 + 5 = 11 -> 5
-            last_char_index = len(row) // 2 + 1
-            last_distance_index = len(row)
-            limit_count += 1
-            result.append({})
-            result[limit_count - 1]['target'] = _serialize_char(request, row[0])
-            result[limit_count - 1]['matches'] = [_serialize_char(request, match) for match in row[1:last_char_index]]
-            result[limit_count - 1]['distances'] = row[last_char_index:last_distance_index]
-            # have we got all the rows we wanted ?
-            if limit_count == limit:
-                break
-            idx += 1
-    return result
+def get_imported_matched_characters(request, match_set, limit, offset, ordering='row', max_distance=None):
+    """
+    (matched characters, total count) for one page of an imported TopKMatchSet, in the same shape as get_matched_characters. Queries are in CSV order, or ordered by the distance to their closest match. With `max_distance`, only matches at most that far from their query are returned, and only queries that have one.
+    """
+    # The rank 0 match of each query stands for the query
+    queries = match_set.matches.filter(rank=0)
+    matches = match_set.matches.all()
+    if max_distance is None:
+        total_count = match_set.n_queries
+    else:
+        queries = queries.filter(distance__lte=max_distance)
+        matches = matches.filter(distance__lte=max_distance)
+        total_count = queries.count()
+    page = list(
+        queries.order_by(*IMPORTED_MATCH_ORDERINGS[ordering]).values_list('row', 'query')[offset:offset + limit]
+    )
+    rows = {row: {'target': query, 'matches': [], 'distances': []} for row, query in page}
+    for row, match, distance in matches.filter(row__in=rows).order_by('row', 'rank').values_list(
+            'row', 'match', 'distance'):
+        rows[row]['matches'].append(match)
+        rows[row]['distances'].append(distance)
+    characters = serialize_characters(
+        request, chain.from_iterable([row['target'], *row['matches']] for row in rows.values())
+    )
+    for row in rows.values():
+        row['target'] = characters.get(str(row['target']))
+        row['matches'] = [characters.get(str(match)) for match in row['matches']]
+    return [rows[row] for row, _ in page], total_count
 
 
 def existing_matched_characters(book, queries):
-    result = []
-    for query in queries:
-        existing = models.CharacterMatch.objects.filter(book=book, query=query).first()
-        if existing is not None:
-            result.append(existing)
-    return result
+    """
+    Saved CharacterMatches of a book for each of `queries` that has one, in the order of `queries`
+    """
+    saved = {str(match.query_id): match
+             for match in models.CharacterMatch.objects.filter(book=book, query__in=queries)}
+    return [saved[str(query)] for query in queries if str(query) in saved]
@@ -0,0 +1,81 @@
+"""
+Import the top-k CSVs written by character matching into TopKMatchSet and TopKMatch, so that `matched_characters` pages through indexed rows instead of reading the CSV up to the requested offset.
+"""
+import logging
+import os
+from glob import glob
+from itertools import islice
+
+from django.db import transaction
+
+from .. import models
+from .find_matching_chars import get_match_directories, parse_topk_row
+
+IMPORT_BATCH_SIZE = 5000
+
+
+def find_topk_csvs(matches_path, csv_suffix):
+    """
+    Yield (match directory, character class, CSV path) for each top-k CSV under a book's matches path
+    """
+    for match in get_match_directories(matches_path):
+        for character_class in match.get("character_classes", []):
+            csv_path = os.path.join(
+                matches_path, match["dir"], character_class, csv_suffix
+            )
+            csv_files = glob(csv_path)
+            if len(csv_files) > 1:
+                logging.error({"More than one CSV matching:": csv_path})
+                continue
+            for csv_file in csv_files:
+                yield match["dir"], character_class, csv_file
+
+
+def _topk_matches(match_set, csv_file):
+    with open(csv_file) as f:
+        for row, line in enumerate(f):
+            query, matches, distances = parse_topk_row(line)
+            for rank, (match, distance) in enumerate(zip(matches, distances)):
+                yield models.TopKMatch(
+                    match_set=match_set,
+                    row=row,
+                    query=query,
+                    rank=rank,
+                    match=match,
+                    distance=distance,
+                )
+
+
+def count_rows(csv_file):
+    with open(csv_file) as f:
+        return sum(1 for _ in f)
+
+
+@transaction.atomic
+def import_topk_csv(book, matches_dir, character_class, csv_file, force=False):
+    """
+    (match set, imported) for a top-k CSV, replacing the set's rows unless the file is unchanged since it was last imported
+    """
+    mtime = os.path.getmtime(csv_file)
+    match_set, created = models.TopKMatchSet.objects.select_for_update().get_or_create(
+        book=book,
+        directory=matches_dir,
+        character_class=character_class,
+        defaults={"source": csv_file, "source_mtime": mtime},
+    )
+    if (
+        not created
+        and not force
+        and match_set.source == csv_file
+        and match_set.source_mtime == mtime
+    ):
+        return match_set, False
+    match_set.matches.all().delete()
+    rows = _topk_matches(match_set, csv_file)
+    while batch := list(islice(rows, IMPORT_BATCH_SIZE)):
+        models.TopKMatch.objects.bulk_create(batch)
+    match_set.source = csv_file
+    match_set.source_mtime = mtime
+    match_set.n_queries = count_rows(csv_file)
+    match_set.save()
+    return match_set, True
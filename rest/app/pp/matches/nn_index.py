@@ -0,0 +1,270 @@
+"""
+Find the characters most similar to a given one, across books, from the feature vectors stored in CharacterFeatures.
+
+Each process keeps one index per character class in memory, built on the first search for that class and rebuilt once it is older than SIMILARITY_INDEX_MAX_AGE (or straight away in the process that stored new vectors). Similarity is cosine, and distances are 1 - cosine similarity. Small classes are searched exhaustively. Classes with at least SIMILARITY_IVF_MIN_SIZE characters get an IVF index: the vectors are clustered by spherical k-means, and only the SIMILARITY_IVF_PROBES clusters closest to the query are searched. Book filters are applied before searching: if fewer than SIMILARITY_IVF_MIN_SIZE characters pass them, those are searched exhaustively, and otherwise more clusters are probed until enough of them are found.
+"""
+import logging
+import math
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.db.models import F, Q
+
+from .. import models
+
+KMEANS_ITERATIONS = 10
+# Vectors sampled per cluster to train the k-means centroids
+KMEANS_SAMPLES_PER_LIST = 64
+# Rows scored at once while assigning vectors to clusters
+ASSIGN_CHUNK_SIZE = 65536
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _kmeans(vectors, n_lists, seed=0):
+    """
+    (centroids, assignments) of unit vectors clustered into n_lists by spherical k-means
+    """
+    rng = np.random.default_rng(seed)
+    n_samples = min(len(vectors), n_lists * KMEANS_SAMPLES_PER_LIST)
+    sample = vectors[rng.choice(len(vectors), n_samples, replace=False)]
+    centroids = sample[rng.choice(n_samples, n_lists, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        for i in range(n_lists):
+            members = sample[assignments == i]
+            if len(members) > 0:
+                centroids[i] = _normalize(members.sum(axis=0))
+    assignments = np.concatenate(
+        [
+            np.argmax(vectors[start : start + ASSIGN_CHUNK_SIZE] @ centroids.T, axis=1)
+            for start in range(0, len(vectors), ASSIGN_CHUNK_SIZE)
+        ]
+    )
+    return centroids, assignments
+
+
+class ClassIndex:
+    """
+    Feature vectors of the characters of one class, with the book of each
+    """
+
+    def __init__(self, character_ids, vectors, book_codes, books):
+        self.character_ids = character_ids
+        self.vectors = _normalize(vectors)
+        self.book_codes = book_codes
+        # (id, printer, date_early, date_late) of each book, by book code
+        self.books = books
+        self.built = time.monotonic()
+        self.lists = None
+        if len(character_ids) >= settings.SIMILARITY_IVF_MIN_SIZE:
+            self.centroids, assignments = _kmeans(
+                self.vectors, int(math.sqrt(len(character_ids)))
+            )
+            order = np.argsort(assignments, kind="stable")
+            bounds = np.searchsorted(
+                assignments[order], np.arange(len(self.centroids) + 1)
+            )
+            self.lists = [
+                order[bounds[i] : bounds[i + 1]] for i in range(len(self.centroids))
+            ]
+
+    def __len__(self):
+        return len(self.character_ids)
+
+    @classmethod
+    def build(cls, character_class):
+        """
+        Index of the stored vectors of a class's characters, taking only each book's current character run where it has one
+        """
+        features = (
+            models.CharacterFeatures.objects.filter(
+                character__character_class=character_class
+            )
+            .filter(
+                Q(character__created_by_run__book__current_character_run__isnull=True)
+                | Q(
+                    character__created_by_run=F(
+                        "character__created_by_run__book__current_character_run"
+                    )
+                )
+            )
+            .values_list(
+                "character_id",
+                "vector",
+                "character__created_by_run__book_id",
+                "character__created_by_run__book__pp_printer",
+                "character__created_by_run__book__date_early",
+                "character__created_by_run__book__date_late",
+            )
+        )
+        character_ids, vectors, book_codes = [], [], []
+        book_code_by_id, books = {}, []
+        dimensions = None
+        for (
+            character_id,
+            vector,
+            book_id,
+            printer,
+            date_early,
+            date_late,
+        ) in features.iterator():
+            vector = np.frombuffer(vector, dtype=np.float32)
+            if dimensions is None:
+                dimensions = len(vector)
+            if len(vector) != dimensions:
+                message = f"{len(vector)} dimensions, expected {dimensions}"
+                logging.error({f"Skipping feature vector of {character_id}": message})
+                continue
+            if book_id not in book_code_by_id:
+                book_code_by_id[book_id] = len(books)
+                books.append((book_id, printer, date_early, date_late))
+            character_ids.append(character_id)
+            vectors.append(vector)
+            book_codes.append(book_code_by_id[book_id])
+        return cls(
+            character_ids,
+            np.array(vectors, dtype=np.float32).reshape(len(vectors), dimensions or 0),
+            np.array(book_codes, dtype=np.int32),
+            books,
+        )
+
+    def book_mask(self, books=None, printer=None, date_from=None, date_to=None):
+        """
+        Which characters are in books matching all the given filters, or None if there are none: books in `books`, printed by a printer whose name contains `printer`, and possibly printed between date_from and date_to
+        """
+        if books is None and printer is None and date_from is None and date_to is None:
+            return None
+        books = None if books is None else set(books)
+        allowed = [
+            code
+            for code, (book_id, book_printer, date_early, date_late) in enumerate(
+                self.books
+            )
+            if (books is None or book_id in books)
+            and (printer is None or printer.lower() in (book_printer or "").lower())
+            and (date_from is None or date_late >= date_from)
+            and (date_to is None or date_early <= date_to)
+        ]
+        return np.isin(self.book_codes, allowed)
+
+    def candidates(self, query, k, mask=None):
+        """
+        Positions of the vectors to score against a unit query vector, all in `mask` if given, or None for every vector. Probes more clusters than SIMILARITY_IVF_PROBES when that finds fewer than `k` candidates.
+        """
+        if mask is not None:
+            masked = np.flatnonzero(mask)
+            if self.lists is None or len(masked) < settings.SIMILARITY_IVF_MIN_SIZE:
+                return masked
+        elif self.lists is None:
+            return None
+        ranked = np.argsort(-(self.centroids @ query))
+        n_probes = min(settings.SIMILARITY_IVF_PROBES, len(ranked))
+        while True:
+            positions = np.concatenate([self.lists[i] for i in ranked[:n_probes]])
+            if mask is not None:
+                positions = positions[mask[positions]]
+            if len(positions) >= k or n_probes == len(ranked):
+                return positions
+            n_probes = min(n_probes * 2, len(ranked))
+
+    def search(self, vector, k, mask=None, exclude=None):
+        """
+        [(character ID, distance)] of the k characters closest to `vector`, among those in `mask` and other than `exclude`
+        """
+        if len(self) == 0 or len(vector) != self.vectors.shape[1]:
+            return []
+        query = _normalize(np.asarray(vector, dtype=np.float32))
+        # One spare in case `exclude` is among the closest
+        positions = self.candidates(query, k + 1, mask)
+        if positions is None:
+            positions = np.arange(len(self))
+            scores = self.vectors @ query
+        else:
+            scores = self.vectors[positions] @ query
+        n = min(k + 1, len(scores))
+        if n == 0:
+            return []
+        top = np.argpartition(-scores, n - 1)[:n]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        results = [
+            (self.character_ids[positions[i]], float(1 - scores[i])) for i in top
+        ]
+        return [result for result in results if result[0] != exclude][:k]
+
+
+class SimilarityIndex:
+    """
+    ClassIndexes by character class, built as they are needed
+    """
+
+    def __init__(self):
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def get(self, character_class):
+        index = self.indexes.get(character_class)
+        if (
+            index is None
+            or time.monotonic() - index.built > settings.SIMILARITY_INDEX_MAX_AGE
+        ):
+            # Only one thread builds a class's index at a time
+            with self.lock:
+                index = self.indexes.get(character_class)
+                if (
+                    index is None
+                    or time.monotonic() - index.built
+                    > settings.SIMILARITY_INDEX_MAX_AGE
+                ):
+                    index = ClassIndex.build(character_class)
+                    self.indexes[character_class] = index
+        return index
+
+    def invalidate(self, character_classes=None):
+        """
+        Rebuild the indexes of the given classes, or all of them, on their next search
+        """
+        with self.lock:
+            if character_classes is None:
+                self.indexes.clear()
+            for character_class in character_classes or []:
+                self.indexes.pop(character_class, None)
+
+
+similarity_index = SimilarityIndex()
+
+
+def store_features(vectors):
+    """
+    Save feature vectors given as {character ID: [floats]}, and drop this process's indexes of their classes
+    """
+    if len(vectors) == 0:
+        return
+    models.CharacterFeatures.store(vectors)
+    similarity_index.invalidate(
+        set(
+            models.Character.objects.filter(id__in=list(vectors)).values_list(
+                "character_class", flat=True
+            )
+        )
+    )
+
+
+def similar_characters(character, k, **filters):
+    """
+    [(character ID, distance)] of the k characters of the same class as `character` with the most similar feature vectors, in books matching `filters` (see ClassIndex.book_mask). Raises CharacterFeatures.DoesNotExist if `character` has no feature vector.
+    """
+    features = models.CharacterFeatures.objects.get(character=character)
+    index = similarity_index.get(character.character_class_id)
+    return index.search(
+        np.frombuffer(features.vector, dtype=np.float32),
+        k,
+        mask=index.book_mask(**filters),
+        exclude=character.pk,
+    )
@@ -1,27 +1,48 @@
-import logging
+from django.db import connections, router
 
 from .. import models
 
+UPSERT_SQL = """
+INSERT INTO {table} ({book}, {query}, {matches})
+VALUES {values}
+ON CONFLICT ({book}, {query}) DO UPDATE SET {matches} = EXCLUDED.{matches}
+"""
+
+
+def _upsert_matches(book, matches_by_query):
+    meta = models.CharacterMatch._meta
+    sql = UPSERT_SQL.format(
+        table=meta.db_table,
+        book=meta.get_field('book').column,
+        query=meta.get_field('query').column,
+        matches=meta.get_field('matches').column,
+        values=', '.join(['(%s, %s, %s::uuid[])'] * len(matches_by_query)),
+    )
+    params = []
+    for query, matches in matches_by_query.items():
+        params += [book.pk, query, matches]
+    with connections[router.db_for_write(models.CharacterMatch)].cursor() as cursor:
+        cursor.execute(sql, params)
+
 
 def save_matched_characters_in_db(book, matched_chars):
+    """
+    Save the reviewed matches of each query character for a book, replacing any saved before, and delete those of queries submitted with no matches. Raises Character.DoesNotExist, before saving anything, if any query isn't a character.
+    """
+    # Later submissions for the same query win
+    submitted = {}
     for matched_char in matched_chars:
         if matched_char is not None and matched_char['query'] is not None:
-            try:
-                query = models.Character.objects.get(id=matched_char['query'])
-                existing = models.CharacterMatch.objects.filter(book=book, query=query).first()
-                if existing is None:
-                    if matched_char['matches'] is None or len(matched_char['matches']) == 0:  # nothing to save
-                        continue
-                    logging.info("Saving new match")
-                    models.CharacterMatch.objects.create(book=book, query=query, matches=list(matched_char['matches']))
-                else:
-                    logging.info({"Existing:": existing})
-                    if matched_char['matches'] is None or len(matched_char['matches']) == 0:
-                        logging.info("Deleting existing match")
-                        existing.delete()
-                    else:
-                        logging.info("Updating existing match")
-                        existing.matches = list(matched_char['matches'])
-                        existing.save()
-            except Exception as err:
-                raise err
+            submitted[str(matched_char['query'])] = [str(match) for match in matched_char['matches'] or []]
+    if len(submitted) == 0:
+        return
+    found = set(str(pk) for pk in models.Character.objects.filter(id__in=submitted).values_list('id', flat=True))
+    missing = submitted.keys() - found
+    if missing:
+        raise models.Character.DoesNotExist(f"No characters with IDs {', '.join(sorted(missing))}")
+    to_save = {query: matches for query, matches in submitted.items() if len(matches) > 0}
+    to_delete = [query for query, matches in submitted.items() if len(matches) == 0]
+    if to_save:
+        _upsert_matches(book, to_save)
+    if to_delete:
+        models.CharacterMatch.objects.filter(book=book, query__in=to_delete).delete()
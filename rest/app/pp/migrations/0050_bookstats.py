@@ -0,0 +1,36 @@
+# Generated by Django 3.2.16 on 2026-10-19 13:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pp', '0049_auto_20230307_2209'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('n_pages', models.PositiveIntegerField(default=0)),
+                ('n_lines', models.PositiveIntegerField(default=0)),
+                ('n_characters', models.PositiveIntegerField(default=0)),
+                ('character_class_counts', models.JSONField(default=dict, help_text='Number of characters assigned to each character class')),
+                ('n_damage_scores', models.PositiveIntegerField(default=0, help_text='Number of characters that have a damage score')),
+                ('damage_score_mean', models.FloatField(blank=True, null=True)),
+                ('damage_score_p50', models.FloatField(blank=True, null=True)),
+                ('damage_score_p90', models.FloatField(blank=True, null=True)),
+                ('date_updated', models.DateTimeField(auto_now=True)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='pp.book')),
+                ('character_run', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='pp.characterrun')),
+                ('line_run', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='pp.linerun')),
+                ('page_run', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='pp.pagerun')),
+            ],
+            options={
+                'ordering': ['book', 'date_updated'],
+            },
+        ),
+    ]
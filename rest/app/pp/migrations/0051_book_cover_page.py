@@ -0,0 +1,31 @@
+# Generated by Django 3.2.16 on 2026-10-19 13:01
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+def set_cover_pages(apps, schema_editor):
+    # Point every book at the first page of its most recent page run
+    Book = apps.get_model("pp", "Book")
+    Page = apps.get_model("pp", "Page")
+    first_pages = Page.objects.filter(created_by_run__book=OuterRef("pk")).order_by(
+        "-created_by_run__date_started", "sequence"
+    )
+    Book.objects.all().update(cover_page=Subquery(first_pages.values("pk")[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pp', '0050_bookstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='cover_page',
+            field=models.ForeignKey(blank=True, editable=False, help_text='First page of the most recent page run, set when pages are ingested', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='pp.page'),
+        ),
+        migrations.RunPython(set_cover_pages, migrations.RunPython.noop),
+    ]
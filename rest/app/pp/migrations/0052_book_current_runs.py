@@ -0,0 +1,47 @@
+# Generated by Django 3.2.16 on 2026-10-19 13:03
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+def set_current_runs(apps, schema_editor):
+    # The most recently started run of each type becomes the current one
+    Book = apps.get_model("pp", "Book")
+    updates = {}
+    for run_type in ["page", "line", "character"]:
+        Run = apps.get_model("pp", f"{run_type}run")
+        newest = Run.objects.filter(book=OuterRef("pk")).order_by("-date_started")
+        updates[f"current_{run_type}_run"] = Subquery(newest.values("pk")[:1])
+    Book.objects.all().update(**updates)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pp', '0051_book_cover_page'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='current_character_run',
+            field=models.ForeignKey(blank=True, editable=False, help_text='Character run currently used for this book', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='pp.characterrun'),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='current_line_run',
+            field=models.ForeignKey(blank=True, editable=False, help_text='Line run currently used for this book', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='pp.linerun'),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='current_page_run',
+            field=models.ForeignKey(blank=True, editable=False, help_text='Page run currently used for this book', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='pp.pagerun'),
+        ),
+        migrations.AlterField(
+            model_name='book',
+            name='cover_page',
+            field=models.ForeignKey(blank=True, editable=False, help_text='First page of the current page run, set when pages are ingested', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='pp.page'),
+        ),
+        migrations.RunPython(set_current_runs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 3.2.16 on 2026-10-19 13:04
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_characters(apps, schema_editor):
+    Book = apps.get_model("pp", "Book")
+    Character = apps.get_model("pp", "Character")
+    characters = (
+        Character.objects.filter(created_by_run__book=OuterRef("pk"))
+        .order_by()
+        .values("created_by_run__book")
+    )
+    grouped_characters = characters.filter(charactergroupings__isnull=False)
+    Book.objects.all().update(
+        n_characters=Coalesce(
+            Subquery(characters.annotate(n=Count("pk")).values("n")), 0
+        ),
+        n_grouped_characters=Coalesce(
+            Subquery(
+                grouped_characters.annotate(n=Count("pk", distinct=True)).values("n")
+            ),
+            0,
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pp', '0052_book_current_runs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='n_characters',
+            field=models.PositiveIntegerField(db_index=True, default=0, help_text='Number of characters extracted from this book, across all runs'),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='n_grouped_characters',
+            field=models.PositiveIntegerField(db_index=True, default=0, help_text='Number of characters from this book that belong to at least one grouping'),
+        ),
+        migrations.RunPython(count_characters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.2.16 on 2026-10-19 13:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pp', '0053_book_character_counts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClassConfusion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('character_class', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='pp.characterclass')),
+                ('character_run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='class_confusions', to='pp.characterrun')),
+                ('human_character_class', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='pp.characterclass')),
+            ],
+            options={
+                'ordering': ['character_run', 'character_class', 'human_character_class'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='classconfusion',
+            constraint=models.UniqueConstraint(fields=('character_run', 'character_class', 'human_character_class'), name='unique_class_confusion'),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 3.2.16 on 2026-10-19 13:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pp', '0054_classconfusion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TopKMatchSet',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('directory', models.CharField(help_text='matching_output_* directory the file came from', max_length=200)),
+                ('character_class', models.CharField(help_text='Character class subdirectory of the match directory the file came from', max_length=200)),
+                ('source', models.CharField(help_text='Path of the imported CSV', max_length=2000)),
+                ('source_mtime', models.FloatField(help_text='Modification time of the CSV when it was imported, used to skip unchanged files')),
+                ('n_queries', models.PositiveIntegerField(default=0, help_text='Number of query characters (CSV rows) in the set')),
+                ('date_imported', models.DateTimeField(auto_now=True)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='topk_match_sets', to='pp.book')),
+            ],
+            options={
+                'ordering': ['book', 'directory', 'character_class'],
+            },
+        ),
+        migrations.CreateModel(
+            name='TopKMatch',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('row', models.PositiveIntegerField(help_text='Row of the query in the CSV')),
+                ('query', models.UUIDField()),
+                ('rank', models.PositiveSmallIntegerField(help_text='0 for the closest match')),
+                ('match', models.UUIDField()),
+                ('distance', models.FloatField()),
+                ('match_set', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='matches', to='pp.topkmatchset')),
+            ],
+            options={
+                'ordering': ['match_set', 'row', 'rank'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='topkmatchset',
+            constraint=models.UniqueConstraint(fields=('book', 'directory', 'character_class'), name='unique_topk_match_set'),
+        ),
+        migrations.AddIndex(
+            model_name='topkmatch',
+            index=models.Index(fields=['match_set', 'rank', 'distance'], name='pp_topkmatc_match_s_31a536_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='topkmatch',
+            index=models.Index(fields=['match_set', 'query'], name='pp_topkmatc_match_s_10a0fb_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='topkmatch',
+            constraint=models.UniqueConstraint(fields=('match_set', 'row', 'rank'), name='unique_topk_match'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.16 on 2026-10-19 13:30
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def remove_duplicate_matches(apps, schema_editor):
+    """
+    Keep only the most recently created match for each book and query
+    """
+    CharacterMatch = apps.get_model("pp", "CharacterMatch")
+    latest = (
+        CharacterMatch.objects.order_by()
+        .values("book", "query")
+        .annotate(latest=Max("id"))
+        .values("latest")
+    )
+    CharacterMatch.objects.exclude(id__in=latest).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pp', '0055_topkmatch'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_matches, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='charactermatch',
+            constraint=models.UniqueConstraint(fields=('book', 'query'), name='unique_character_match'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.16 on 2026-10-19 13:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pp', '0056_charactermatch_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CharacterFeatures',
+            fields=[
+                ('character', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='features', serialize=False, to='pp.character')),
+                ('vector', models.BinaryField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 3.2.16 on 2026-10-19 13:34
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def summarize_matches(apps, schema_editor):
+    schema_editor.execute(
+        """
+        INSERT INTO pp_bookmatchsummary (book_id, matched_book_id, n_queries, n_matches)
+        SELECT m.book_id, r.book_id, COUNT(DISTINCT m.query_id), COUNT(*)
+        FROM pp_charactermatch m
+        CROSS JOIN LATERAL unnest(m.matches) AS matched(character_id)
+        JOIN pp_character c ON c.id = matched.character_id
+        JOIN pp_characterrun r ON r.id = c.created_by_run_id
+        GROUP BY m.book_id, r.book_id
+        """
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pp', '0057_characterfeatures'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookMatchSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('n_queries', models.PositiveIntegerField(default=0, help_text='Query characters of `book` with a match in `matched_book`')),
+                ('n_matches', models.PositiveIntegerField(default=0, help_text='Matches of those queries that are in `matched_book`')),
+            ],
+            options={
+                'ordering': ['book', '-n_matches'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='charactermatch',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['matches'], name='charactermatch_matches_gin'),
+        ),
+        migrations.AddField(
+            model_name='bookmatchsummary',
+            name='book',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='match_summaries', to='pp.book'),
+        ),
+        migrations.AddField(
+            model_name='bookmatchsummary',
+            name='matched_book',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='matched_by_summaries', to='pp.book'),
+        ),
+        migrations.AddConstraint(
+            model_name='bookmatchsummary',
+            constraint=models.UniqueConstraint(fields=('book', 'matched_book'), name='unique_book_match_summary'),
+        ),
+        migrations.RunPython(summarize_matches, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.16 on 2026-10-19 13:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pp", "0058_charactermatch_reverse_lookup"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Manifest",
+            fields=[
+                (
+                    "page_run",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="manifest",
+                        serialize=False,
+                        to="pp.pagerun",
+                    ),
+                ),
+                ("content", models.TextField(help_text="Manifest JSON")),
+                (
+                    "etag",
+                    models.CharField(
+                        help_text="SHA-1 of the manifest JSON", max_length=40
+                    ),
+                ),
+                ("date_generated", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.2.16 on 2026-10-19 13:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pp", "0059_manifest"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="page",
+            name="height",
+            field=models.PositiveIntegerField(
+                blank=True,
+                editable=False,
+                help_text="Height of the image in pixels, read from the TIFF when it is saved",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="page",
+            name="width",
+            field=models.PositiveIntegerField(
+                blank=True,
+                editable=False,
+                help_text="Width of the image in pixels, read from the TIFF when it is saved",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="spread",
+            name="height",
+            field=models.PositiveIntegerField(
+                blank=True,
+                editable=False,
+                help_text="Height of the image in pixels, read from the TIFF when it is saved",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="spread",
+            name="width",
+            field=models.PositiveIntegerField(
+                blank=True,
+                editable=False,
+                help_text="Width of the image in pixels, read from the TIFF when it is saved",
+                null=True,
+            ),
+        ),
+    ]
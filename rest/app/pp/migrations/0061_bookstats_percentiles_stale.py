@@ -0,0 +1,21 @@
+# Generated by Django 3.2.16 on 2026-10-19 14:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pp", "0060_image_sizes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="bookstats",
+            name="percentiles_stale",
+            field=models.BooleanField(
+                default=False,
+                help_text="Damage scores changed since the percentiles were computed",
+            ),
+        ),
+    ]
@@ -1,11 +1,22 @@
+import hashlib
 import uuid
 from abc import abstractmethod
+from array import array
+from collections import Counter
 from datetime import date
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.postgres.fields import ArrayField
-from django.db import models
+from django.contrib.postgres.indexes import GinIndex
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import connections, models, router, transaction
+from django.db.models import OuterRef, Subquery
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce, Greatest
+
+from .aggregates import PercentileCont
+from .crops.image_sizes import read_image_size
 
 
 class uuidModel(models.Model):
@@ -42,32 +53,57 @@ class Run(uuidModel):
     def labeller(self):
         return f"{str(self.id)} - {self.date_started}"
 
+    def save(self, *args, **kwargs):
+        """
+        Newly-created runs become the current run of their type for the book
+        """
+        adding = self._state.adding
+        response = super().save(*args, **kwargs)
+        if adding:
+            self.book.promote_runs(**{self.run_type: self})
+        return response
+
 
 class PageRun(Run):
+    run_type = "page"
+
     @abstractmethod
     def pages(self):
         raise NotImplementedError
 
     def component_count(self):
-        return self.pages.count()
+        try:
+            return self.stats.n_pages
+        except ObjectDoesNotExist:
+            return self.pages.count()
 
 
 class LineRun(Run):
+    run_type = "line"
+
     @abstractmethod
     def lines(self):
         raise NotImplementedError
 
     def component_count(self):
-        return self.lines.count()
+        try:
+            return self.stats.n_lines
+        except ObjectDoesNotExist:
+            return self.lines.count()
 
 
 class CharacterRun(Run):
+    run_type = "character"
+
     @abstractmethod
     def characters(self):
         raise NotImplementedError
 
     def component_count(self):
-        return self.characters.count()
+        try:
+            return self.stats.n_characters
+        except ObjectDoesNotExist:
+            return self.characters.count()
 
 
 class Book(uuidModel):
@@ -221,6 +257,52 @@ class Book(uuidModel):
     pp_notes = models.TextField(
         blank=True, help_text="Free notes by the P&P team", default=""
     )
+    n_characters = models.PositiveIntegerField(
+        default=0,
+        db_index=True,
+        help_text="Number of characters extracted from this book, across all runs",
+    )
+    n_grouped_characters = models.PositiveIntegerField(
+        default=0,
+        db_index=True,
+        help_text="Number of characters from this book that belong to at least one grouping",
+    )
+    current_page_run = models.ForeignKey(
+        "PageRun",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        editable=False,
+        related_name="+",
+        help_text="Page run currently used for this book",
+    )
+    current_line_run = models.ForeignKey(
+        "LineRun",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        editable=False,
+        related_name="+",
+        help_text="Line run currently used for this book",
+    )
+    current_character_run = models.ForeignKey(
+        "CharacterRun",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        editable=False,
+        related_name="+",
+        help_text="Character run currently used for this book",
+    )
+    cover_page = models.ForeignKey(
+        "Page",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        editable=False,
+        related_name="+",
+        help_text="First page of the current page run, set when pages are ingested",
+    )
 
     class Meta:
         ordering = ["pq_title"]
@@ -235,24 +317,103 @@ class Book(uuidModel):
             "characters": self.characterruns.all(),
         }
 
+    def current_run_id(self, run_type):
+        """
+        ID of the current run of the given type ("page", "line", or "character"), falling back to the most recently started run if none has been promoted
+        """
+        run_id = getattr(self, f"current_{run_type}_run_id")
+        if run_id is None:
+            run_id = (
+                getattr(self, f"{run_type}runs").values_list("id", flat=True).first()
+            )
+        return run_id
+
+    @transaction.atomic
+    def promote_runs(self, page=None, line=None, character=None):
+        """
+        Make the given runs the current ones for this book in a single update
+        """
+        updates = {}
+        for run_type, run in (("page", page), ("line", line), ("character", character)):
+            if run is None:
+                continue
+            if run.book_id != self.pk:
+                raise ValueError(f"Run {run.pk} does not belong to book {self.pk}")
+            updates[f"current_{run_type}_run"] = run
+        if page is not None:
+            updates["cover_page"] = page.pages.order_by("sequence").first()
+        for field, value in updates.items():
+            setattr(self, field, value)
+        Book.objects.filter(pk=self.pk).update(**updates)
+
     def most_recent_runs(self):
         return {
-            "page": self.pageruns.first(),
-            "line": self.lineruns.first(),
-            "character": self.characterruns.first(),
+            "page": self.current_page_run or self.pageruns.first(),
+            "line": self.current_line_run or self.lineruns.first(),
+            "character": self.current_character_run or self.characterruns.first(),
         }
 
     def most_recent_pages(self):
         """
-        Get all pages for this book based on the most recent run in the database
+        Get all pages for this book based on the current page run
+        """
+        return Page.objects.filter(created_by_run_id=self.current_run_id("page"))
+
+    @staticmethod
+    def _book_characters():
+        return (
+            Character.objects.filter(created_by_run__book=OuterRef("pk"))
+            .order_by()
+            .values("created_by_run__book")
+        )
+
+    @classmethod
+    def _grouped_count(cls):
+        grouped_characters = cls._book_characters().filter(
+            charactergroupings__isnull=False
+        )
+        return Coalesce(
+            Subquery(
+                grouped_characters.annotate(n=models.Count("pk", distinct=True)).values(
+                    "n"
+                )
+            ),
+            0,
+        )
+
+    @classmethod
+    def refresh_character_counts(cls, book_ids):
+        """
+        Recompute n_characters and n_grouped_characters for the given books
         """
-        return self.pageruns.first().pages.all()
+        cls.objects.filter(pk__in=book_ids).update(
+            n_characters=Coalesce(
+                Subquery(
+                    cls._book_characters().annotate(n=models.Count("pk")).values("n")
+                ),
+                0,
+            ),
+            n_grouped_characters=cls._grouped_count(),
+        )
+
+    @classmethod
+    def refresh_grouped_character_counts(cls, book_ids):
+        """
+        Recompute only n_grouped_characters for the given books, for when groupings change but characters don't
+        """
+        cls.objects.filter(pk__in=book_ids).update(
+            n_grouped_characters=cls._grouped_count()
+        )
 
     def cover_spread(self):
         return self.spreads.first()
 
-    def cover_page(self):
-        return Page.objects.filter(created_by_run__book=self).first()
+    def refresh_cover_page(self):
+        """
+        Point cover_page at the first page of the current page run
+        """
+        self.cover_page = self.most_recent_pages().order_by("sequence").first()
+        Book.objects.filter(pk=self.pk).update(cover_page=self.cover_page)
 
     @property
     def zip_path(self):
@@ -278,6 +439,40 @@ class ImagedModel(uuidModel):
         help_text="relative file path to root directory containing all images",
         blank=True,
     )
+    width = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="Width of the image in pixels, read from the TIFF when it is saved",
+    )
+    height = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="Height of the image in pixels, read from the TIFF when it is saved",
+    )
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # tif as loaded, to tell on save whether it changed (absent if deferred)
+        instance._loaded_tif = instance.__dict__.get("tif")
+        return instance
+
+    def save(self, *args, **kwargs):
+        """
+        Read width and height from the TIFF when tif has changed or no size is stored yet. If a changed tif can't be read, the stored size belonged to the old image, so it is cleared and manifests ask the IIIF server instead. Bulk ingest sets them itself, a whole run's TIFFs at a time.
+        """
+        tif_changed = self.tif != getattr(self, "_loaded_tif", None)
+        if tif_changed or self.width is None or self.height is None:
+            size = read_image_size(self.tif)
+            if size is not None:
+                self.width, self.height = size
+            elif tif_changed and not self._state.adding:
+                self.width = self.height = None
+        response = super().save(*args, **kwargs)
+        self._loaded_tif = self.tif
+        return response
 
     @property
     def iiif_base(self):
@@ -371,17 +566,24 @@ class Spread(ImagedModel):
         return f"{self.book} spread {self.sequence}"
 
     def most_recent_pages(self):
-        return self.book.pageruns.first().pages.filter(spread=self)
+        return Page.objects.filter(
+            created_by_run_id=self.book.current_run_id("page"), spread=self
+        )
 
     def save(self, *args, **kwargs):
         """
-        Update book spread count on save
+        Update book spread count on save, and drop the book's stored manifests, which may take image sizes from this spread
         """
         response = super().save(*args, **kwargs)
         self.book.n_spreads = self.book.spreads.count()
         self.book.save()
+        Manifest.objects.filter(page_run__book=self.book_id).delete()
         return response
 
+    def delete(self, *args, **kwargs):
+        Manifest.objects.filter(page_run__book=self.book_id).delete()
+        return super().delete(*args, **kwargs)
+
 
 class Page(ImagedModel):
     """
@@ -414,11 +616,38 @@ class Page(ImagedModel):
     def labeller(self):
         return f"{self.created_by_run.book} p. {self.sequence}-{self.side}"
 
+    def could_be_cover(self, book):
+        """
+        Whether saving this page may change the book's cover page: it is the cover, or it belongs to the current page run and doesn't come after the cover
+        """
+        if book.cover_page_id is None or book.cover_page_id == self.pk:
+            return True
+        if self.created_by_run_id != book.current_run_id("page"):
+            return False
+        return self.sequence <= book.cover_page.sequence
+
+    def save(self, *args, **kwargs):
+        """
+        Update book cover page on save if this page could be it, and drop the stored manifest of the page's run, to be generated again on its next request
+        """
+        response = super().save(*args, **kwargs)
+        book = self.created_by_run.book
+        if self.could_be_cover(book):
+            book.refresh_cover_page()
+        Manifest.objects.filter(page_run_id=self.created_by_run_id).delete()
+        return response
+
+    def delete(self, *args, **kwargs):
+        Manifest.objects.filter(page_run_id=self.created_by_run_id).delete()
+        return super().delete(*args, **kwargs)
+
     def n_lines(self):
         return self.lines.count()
 
     def most_recent_lines(self):
-        return self.created_by_run.book.lineruns.first().lines.filter(page=self)
+        return Line.objects.filter(
+            created_by_run_id=self.created_by_run.book.current_run_id("line"), page=self
+        )
 
     def book(self):
         return self.created_by_run.book
@@ -461,8 +690,9 @@ class Line(CroppedModel):
         return self.characters.count()
 
     def most_recent_characters(self):
-        return self.page.created_by_run.book.characterruns.first().characters.filter(
-            line=self
+        return Character.objects.filter(
+            created_by_run_id=self.page.created_by_run.book.current_run_id("character"),
+            line=self,
         )
 
     @property
@@ -652,3 +882,494 @@ class CharacterMatch(models.Model):
                               help_text="Query character corresponding to this character match")
     matches = ArrayField(models.UUIDField(help_text="Matched characters corresponding to a character query"),
                          blank=True, size=20, default=list)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["book", "query"], name="unique_character_match"
+            )
+        ]
+        indexes = [
+            # Which saved matches include a character
+            GinIndex(fields=["matches"], name="charactermatch_matches_gin"),
+        ]
+
+    @classmethod
+    def linking_books(cls, book, matched_book):
+        """
+        Saved matches of `book` that include at least one character from `matched_book`
+        """
+        return cls.objects.filter(
+            book=book,
+            id__in=RawSQL(
+                f"""
+                SELECT m.id
+                FROM {cls._meta.db_table} m
+                CROSS JOIN LATERAL unnest(m.matches) AS matched(character_id)
+                JOIN {Character._meta.db_table} c ON c.id = matched.character_id
+                JOIN {CharacterRun._meta.db_table} r ON r.id = c.created_by_run_id
+                WHERE m.book_id = %s AND r.book_id = %s
+                """,
+                [book.pk, matched_book.pk],
+            ),
+        )
+
+
+class BookMatchSummary(models.Model):
+    """
+    Number of saved CharacterMatches of one book that matched characters of another book (or of the same book). Maintained by `BookViewSet.save_matched_characters` and rebuilt with `manage.py refresh_book_stats`.
+    """
+
+    book = models.ForeignKey(
+        Book, on_delete=models.CASCADE, related_name="match_summaries"
+    )
+    matched_book = models.ForeignKey(
+        Book, on_delete=models.CASCADE, related_name="matched_by_summaries"
+    )
+    n_queries = models.PositiveIntegerField(
+        default=0, help_text="Query characters of `book` with a match in `matched_book`"
+    )
+    n_matches = models.PositiveIntegerField(
+        default=0, help_text="Matches of those queries that are in `matched_book`"
+    )
+
+    class Meta:
+        ordering = ["book", "-n_matches"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["book", "matched_book"], name="unique_book_match_summary"
+            )
+        ]
+
+    @classmethod
+    @transaction.atomic
+    def refresh(cls, book_ids=None):
+        """
+        Recount the matches of the given books, or of every book
+        """
+        summaries = cls.objects.all()
+        where = ""
+        params = []
+        if book_ids is not None:
+            book_ids = list(book_ids)
+            summaries = summaries.filter(book__in=book_ids)
+            where = "WHERE m.book_id = ANY(%s::uuid[])"
+            params = [[str(book_id) for book_id in book_ids]]
+        summaries.delete()
+        sql = f"""
+            INSERT INTO {cls._meta.db_table} (book_id, matched_book_id, n_queries, n_matches)
+            SELECT m.book_id, r.book_id, COUNT(DISTINCT m.query_id), COUNT(*)
+            FROM {CharacterMatch._meta.db_table} m
+            CROSS JOIN LATERAL unnest(m.matches) AS matched(character_id)
+            JOIN {Character._meta.db_table} c ON c.id = matched.character_id
+            JOIN {CharacterRun._meta.db_table} r ON r.id = c.created_by_run_id
+            {where}
+            GROUP BY m.book_id, r.book_id
+        """
+        with connections[router.db_for_write(cls)].cursor() as cursor:
+            cursor.execute(sql, params)
+
+
+class CharacterFeatures(models.Model):
+    """
+    A character's feature vector from the matching model, uploaded with its character run and searched in memory by pp/matches/nn_index.py. Stored as packed float32s.
+    """
+
+    character = models.OneToOneField(
+        Character, on_delete=models.CASCADE, primary_key=True, related_name="features"
+    )
+    vector = models.BinaryField()
+
+    @classmethod
+    def store(cls, vectors):
+        """
+        Save feature vectors given as {character ID: [floats]}, replacing any stored before
+        """
+        cls.objects.filter(character_id__in=list(vectors)).delete()
+        cls.objects.bulk_create(
+            [
+                cls(character_id=character_id, vector=array("f", vector).tobytes())
+                for character_id, vector in vectors.items()
+            ],
+            batch_size=500,
+        )
+
+
+class TopKMatchSet(models.Model):
+    """
+    One `*_topk_uuid.csv` file of character matching output for a book, identified by its match directory and character class subdirectory. Its rows are imported into TopKMatch by `manage.py import_topk_matches`.
+    """
+
+    book = models.ForeignKey(
+        Book, on_delete=models.CASCADE, related_name="topk_match_sets"
+    )
+    directory = models.CharField(
+        max_length=200, help_text="matching_output_* directory the file came from"
+    )
+    character_class = models.CharField(
+        max_length=200,
+        help_text="Character class subdirectory of the match directory the file came from",
+    )
+    source = models.CharField(max_length=2000, help_text="Path of the imported CSV")
+    source_mtime = models.FloatField(
+        help_text="Modification time of the CSV when it was imported, used to skip unchanged files"
+    )
+    n_queries = models.PositiveIntegerField(
+        default=0, help_text="Number of query characters (CSV rows) in the set"
+    )
+    date_imported = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ["book", "directory", "character_class"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["book", "directory", "character_class"],
+                name="unique_topk_match_set",
+            )
+        ]
+
+
+class TopKMatch(models.Model):
+    """
+    The `rank`th closest character to a query character, from row `row` of a TopKMatchSet's CSV. Characters are stored as bare UUIDs, like CharacterMatch.matches, since matching output may refer to characters that are no longer in the database.
+    """
+
+    id = models.BigAutoField(primary_key=True)
+    match_set = models.ForeignKey(
+        TopKMatchSet, on_delete=models.CASCADE, related_name="matches"
+    )
+    row = models.PositiveIntegerField(help_text="Row of the query in the CSV")
+    query = models.UUIDField()
+    rank = models.PositiveSmallIntegerField(help_text="0 for the closest match")
+    match = models.UUIDField()
+    distance = models.FloatField()
+
+    class Meta:
+        ordering = ["match_set", "row", "rank"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["match_set", "row", "rank"], name="unique_topk_match"
+            )
+        ]
+        indexes = [
+            # Queries ordered or filtered by their closest match
+            models.Index(fields=["match_set", "rank", "distance"]),
+            models.Index(fields=["match_set", "query"]),
+        ]
+
+
+class Manifest(models.Model):
+    """
+    The IIIF manifest of a page run's images, generated when the run's pages are ingested (or by `manage.py build_manifests`) and served as stored. `etag` is a hash of the content.
+    """
+
+    page_run = models.OneToOneField(
+        PageRun, on_delete=models.CASCADE, primary_key=True, related_name="manifest"
+    )
+    content = models.TextField(help_text="Manifest JSON")
+    etag = models.CharField(max_length=40, help_text="SHA-1 of the manifest JSON")
+    date_generated = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def store(cls, page_run, content):
+        """
+        Save the manifest JSON of a page run, replacing any stored before
+        """
+        manifest, _ = cls.objects.update_or_create(
+            page_run=page_run,
+            defaults={
+                "content": content,
+                "etag": hashlib.sha1(content.encode()).hexdigest(),
+            },
+        )
+        return manifest
+
+
+class BookStats(models.Model):
+    """
+    Component counts and damage score summaries for a single run of a book, updated incrementally from the rows inserted or changed by the bulk ingest/update paths, so that serializers never need to aggregate over Pages, Lines, or Characters. Damage score percentiles are recomputed once a run is loaded by the bulk commands, or when the stats endpoint finds them stale after API batches. Rebuild with `manage.py refresh_book_stats`.
+    """
+
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name="stats")
+    page_run = models.OneToOneField(
+        PageRun, on_delete=models.CASCADE, null=True, blank=True, related_name="stats"
+    )
+    line_run = models.OneToOneField(
+        LineRun, on_delete=models.CASCADE, null=True, blank=True, related_name="stats"
+    )
+    character_run = models.OneToOneField(
+        CharacterRun,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name="stats",
+    )
+    n_pages = models.PositiveIntegerField(default=0)
+    n_lines = models.PositiveIntegerField(default=0)
+    n_characters = models.PositiveIntegerField(default=0)
+    character_class_counts = models.JSONField(
+        default=dict, help_text="Number of characters assigned to each character class"
+    )
+    n_damage_scores = models.PositiveIntegerField(
+        default=0, help_text="Number of characters that have a damage score"
+    )
+    damage_score_mean = models.FloatField(null=True, blank=True)
+    damage_score_p50 = models.FloatField(null=True, blank=True)
+    damage_score_p90 = models.FloatField(null=True, blank=True)
+    percentiles_stale = models.BooleanField(
+        default=False,
+        help_text="Damage scores changed since the percentiles were computed",
+    )
+    date_updated = models.DateTimeField(auto_now=True)
+
+    RUN_FIELDS = {PageRun: "page_run", LineRun: "line_run", CharacterRun: "character_run"}
+
+    class Meta:
+        ordering = ["book", "date_updated"]
+
+    @classmethod
+    def for_run(cls, run):
+        """
+        Get (and lock) the stats row for a run, creating it if needed. Must be called inside a transaction.
+        """
+        stats, _ = cls.objects.select_for_update().get_or_create(
+            book_id=run.book_id, **{cls.RUN_FIELDS[type(run)]: run}
+        )
+        return stats
+
+    @classmethod
+    @transaction.atomic
+    def add_pages(cls, page_run, n_pages):
+        stats = cls.for_run(page_run)
+        stats.n_pages += n_pages
+        stats.save()
+        return stats
+
+    @classmethod
+    @transaction.atomic
+    def add_lines(cls, line_run, n_lines):
+        stats = cls.for_run(line_run)
+        stats.n_lines += n_lines
+        stats.save()
+        return stats
+
+    @classmethod
+    @transaction.atomic
+    def add_characters(cls, character_run, characters, removed=()):
+        """
+        Count newly inserted characters into a run's stats, given as (character_class_id, damage_score) pairs, after taking out the `removed` ones. Percentiles can't be updated this way, so they are only marked stale, to be recomputed by `refresh_percentiles` once the run is complete.
+        """
+        stats = cls.for_run(character_run)
+        stats.count_characters(removed, -1)
+        stats.count_characters(characters, 1)
+        stats.save()
+        return stats
+
+    @classmethod
+    @transaction.atomic
+    def refresh_run(cls, run):
+        stats = cls.for_run(run)
+        stats.refresh()
+        return stats
+
+    @classmethod
+    def refresh_stale_percentiles(cls, stats):
+        """
+        Recompute the percentiles of those of `stats` that are stale
+        """
+        for row in stats:
+            if row.percentiles_stale:
+                with transaction.atomic():
+                    cls.for_run(row.character_run).refresh_percentiles()
+                row.refresh_from_db()
+
+    def count_characters(self, characters, sign):
+        characters = list(characters)
+        if not characters:
+            return
+        class_counts = Counter(self.character_class_counts)
+        for class_id, _ in characters:
+            class_counts[class_id] += sign
+        self.character_class_counts = {c: n for c, n in class_counts.items() if n > 0}
+        self.n_characters = max(self.n_characters + sign * len(characters), 0)
+        scores = [score for _, score in characters if score is not None]
+        if scores:
+            total = (self.damage_score_mean or 0) * self.n_damage_scores
+            self.n_damage_scores = max(self.n_damage_scores + sign * len(scores), 0)
+            self.damage_score_mean = (
+                (total + sign * sum(scores)) / self.n_damage_scores
+                if self.n_damage_scores
+                else None
+            )
+            self.percentiles_stale = True
+
+    def damage_scores(self):
+        return Character.objects.filter(
+            created_by_run_id=self.character_run_id, damage_score__isnull=False
+        )
+
+    def refresh_percentiles(self):
+        self.__dict__.update(
+            self.damage_scores().aggregate(
+                damage_score_p50=PercentileCont("damage_score", 0.5),
+                damage_score_p90=PercentileCont("damage_score", 0.9),
+            )
+        )
+        self.percentiles_stale = False
+        self.save()
+
+    def refresh_damage_scores(self):
+        self.__dict__.update(
+            self.damage_scores().aggregate(
+                n_damage_scores=models.Count("id"),
+                damage_score_mean=models.Avg("damage_score"),
+                damage_score_p50=PercentileCont("damage_score", 0.5),
+                damage_score_p90=PercentileCont("damage_score", 0.9),
+            )
+        )
+        self.percentiles_stale = False
+
+    def refresh(self):
+        """
+        Recompute every statistic for this run from scratch
+        """
+        if self.page_run_id is not None:
+            self.n_pages = Page.objects.filter(created_by_run_id=self.page_run_id).count()
+        if self.line_run_id is not None:
+            self.n_lines = Line.objects.filter(created_by_run_id=self.line_run_id).count()
+        if self.character_run_id is not None:
+            class_counts = dict(
+                Character.objects.filter(created_by_run_id=self.character_run_id)
+                .order_by()
+                .values_list("character_class")
+                .annotate(n=models.Count("id"))
+            )
+            self.n_characters = sum(class_counts.values())
+            self.character_class_counts = class_counts
+            self.refresh_damage_scores()
+        self.save()
+
+
+class ClassConfusion(models.Model):
+    """
+    Number of characters in a run that the machine assigned to one character class and a human annotated as another (or the same) class. Kept current by the Character API (`annotate`, updates and deletes) and by `bulk_update`, and rebuilt with `manage.py refresh_book_stats`. A run with no rows is built from its characters before any change is counted into it, so counts are never added to a run whose summary is incomplete.
+    """
+
+    character_run = models.ForeignKey(
+        CharacterRun, on_delete=models.CASCADE, related_name="class_confusions"
+    )
+    character_class = models.ForeignKey(
+        CharacterClass, on_delete=models.CASCADE, related_name="+"
+    )
+    human_character_class = models.ForeignKey(
+        CharacterClass, on_delete=models.CASCADE, related_name="+"
+    )
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ["character_run", "character_class", "human_character_class"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["character_run", "character_class", "human_character_class"],
+                name="unique_class_confusion",
+            )
+        ]
+
+    @staticmethod
+    def run_class_counts(characters):
+        return (
+            characters.filter(human_character_class__isnull=False)
+            .order_by()
+            .values("created_by_run", "character_class", "human_character_class")
+            .annotate(n=models.Count("id"))
+        )
+
+    @classmethod
+    def add_counts(cls, counts):
+        for row in counts:
+            confusion, _ = cls.objects.get_or_create(
+                character_run_id=row["created_by_run"],
+                character_class_id=row["character_class"],
+                human_character_class_id=row["human_character_class"],
+            )
+            cls.objects.filter(pk=confusion.pk).update(
+                count=models.F("count") + row["n"]
+            )
+
+    @classmethod
+    def subtract_counts(cls, counts):
+        for row in counts:
+            cls.objects.filter(
+                character_run_id=row["created_by_run"],
+                character_class_id=row["character_class"],
+                human_character_class_id=row["human_character_class"],
+            ).update(count=Greatest(models.F("count") - row["n"], 0))
+        cls.objects.filter(count=0).delete()
+
+    @classmethod
+    def build_missing_runs(cls, characters):
+        """
+        Build the summary of the characters' runs that have no rows yet
+        """
+        run_ids = set(characters.order_by().values_list("created_by_run", flat=True))
+        built = set(
+            cls.objects.filter(character_run_id__in=run_ids).values_list(
+                "character_run_id", flat=True
+            )
+        )
+        for character_run in CharacterRun.objects.filter(id__in=run_ids - built):
+            cls.refresh_run(character_run)
+
+    @classmethod
+    @transaction.atomic
+    def forget_characters(cls, character_ids):
+        """
+        Take the given characters out of the counts. Call before they are changed or deleted, and count them again with `count_characters` after a change.
+        """
+        characters = Character.objects.filter(id__in=character_ids)
+        cls.build_missing_runs(characters)
+        cls.subtract_counts(cls.run_class_counts(characters))
+
+    @classmethod
+    @transaction.atomic
+    def count_characters(cls, character_ids):
+        characters = Character.objects.filter(id__in=character_ids)
+        cls.build_missing_runs(characters)
+        cls.add_counts(cls.run_class_counts(characters))
+
+    @classmethod
+    @transaction.atomic
+    def record_annotation(cls, character_ids, human_character_class):
+        """
+        Move the given characters' confusion counts to a new human class. Call before the characters themselves are updated.
+        """
+        characters = Character.objects.filter(id__in=character_ids)
+        cls.forget_characters(character_ids)
+        if human_character_class is not None:
+            new_counts = (
+                characters.order_by()
+                .values("created_by_run", "character_class")
+                .annotate(n=models.Count("id"))
+            )
+            cls.add_counts(
+                [
+                    {**row, "human_character_class": human_character_class.pk}
+                    for row in new_counts
+                ]
+            )
+
+    @classmethod
+    @transaction.atomic
+    def refresh_run(cls, character_run):
+        cls.objects.filter(character_run=character_run).delete()
+        cls.objects.bulk_create(
+            [
+                cls(
+                    character_run_id=row["created_by_run"],
+                    character_class_id=row["character_class"],
+                    human_character_class_id=row["human_character_class"],
+                    count=row["n"],
+                )
+                for row in cls.run_class_counts(character_run.characters.all())
+            ]
+        )
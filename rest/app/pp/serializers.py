@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.contrib.auth.models import User
 from rest_framework import serializers
 
@@ -85,6 +86,8 @@ class BookListSerializer(serializers.ModelSerializer):
     cover_spread = SpreadFlatSerializer(many=False, read_only=True)
     cover_page = PageFlatSerializer(many=False, read_only=True)
     n_spreads = serializers.IntegerField(read_only=True)
+    n_characters = serializers.IntegerField(read_only=True)
+    n_grouped_characters = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = models.Book
@@ -113,6 +116,8 @@ class BookListSerializer(serializers.ModelSerializer):
             "date_late",
             "pdf",
             "n_spreads",
+            "n_characters",
+            "n_grouped_characters",
             "cover_spread",
             "cover_page",
             "starred",
@@ -147,6 +152,26 @@ class CharacterRunSerializer(serializers.ModelSerializer):
         read_only_fields = ["component_count", "label", "date_started", "id"]
 
 
+class BookStatsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = models.BookStats
+        fields = [
+            "book",
+            "page_run",
+            "line_run",
+            "character_run",
+            "n_pages",
+            "n_lines",
+            "n_characters",
+            "character_class_counts",
+            "n_damage_scores",
+            "damage_score_mean",
+            "damage_score_p50",
+            "damage_score_p90",
+            "date_updated",
+        ]
+
+
 class LineDetailSerializer(serializers.ModelSerializer):
     class Meta:
         model = models.Line
@@ -215,6 +240,8 @@ class PageListSerializer(serializers.ModelSerializer):
             "rot1",
             "rot2",
             "image",
+            "width",
+            "height",
         ]
 
 
@@ -246,6 +273,8 @@ class PageDetailSerializer(serializers.ModelSerializer):
             "rot1",
             "rot2",
             "image",
+            "width",
+            "height",
             "most_recent_lines",
             "lines",
         ]
@@ -274,7 +303,16 @@ class PageCreateSerializer(serializers.ModelSerializer):
 class SpreadListSerializer(serializers.ModelSerializer):
     class Meta:
         model = models.Spread
-        fields = ["url", "id", "label", "book", "sequence", "image"]
+        fields = [
+            "url",
+            "id",
+            "label",
+            "book",
+            "sequence",
+            "image",
+            "width",
+            "height",
+        ]
 
 
 class SpreadDetailSerializer(serializers.ModelSerializer):
@@ -282,7 +320,16 @@ class SpreadDetailSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = models.Spread
-        fields = ["url", "id", "label", "book", "sequence", "image"]
+        fields = [
+            "url",
+            "id",
+            "label",
+            "book",
+            "sequence",
+            "image",
+            "width",
+            "height",
+        ]
 
 
 class SpreadCreateSeralizer(serializers.ModelSerializer):
@@ -297,6 +344,18 @@ class BookAllRunsSerializer(serializers.Serializer):
     characters = CharacterRunSerializer(many=True)
 
 
+class BookPromoteRunsSerializer(serializers.Serializer):
+    page_run = serializers.PrimaryKeyRelatedField(
+        queryset=models.PageRun.objects.all(), required=False
+    )
+    line_run = serializers.PrimaryKeyRelatedField(
+        queryset=models.LineRun.objects.all(), required=False
+    )
+    character_run = serializers.PrimaryKeyRelatedField(
+        queryset=models.CharacterRun.objects.all(), required=False
+    )
+
+
 class BookDetailSerializer(serializers.ModelSerializer):
     spreads = SpreadListSerializer(many=True)
     cover_spread = SpreadListSerializer(many=False)
@@ -331,6 +390,9 @@ class BookDetailSerializer(serializers.ModelSerializer):
             "pdf",
             "spreads",
             "all_runs",
+            "current_page_run",
+            "current_line_run",
+            "current_character_run",
             "cover_spread",
             "cover_page",
             "starred",
@@ -543,6 +605,44 @@ class CharacterAnnotateSerializer(serializers.Serializer):
     )
 
 
+class ConfusionMatrixQuerySerializer(serializers.Serializer):
+    book = serializers.PrimaryKeyRelatedField(
+        queryset=models.Book.objects.all(), required=False
+    )
+    created_by_run = serializers.PrimaryKeyRelatedField(
+        queryset=models.CharacterRun.objects.all(), required=False
+    )
+    summary = serializers.BooleanField(default=False)
+
+
+class CharacterBatchSerializer(serializers.Serializer):
+    characters = serializers.ListField(
+        child=serializers.UUIDField(), allow_empty=False, max_length=5000
+    )
+
+
+class CharacterSimilarSerializer(serializers.Serializer):
+    k = serializers.IntegerField(
+        min_value=1, max_value=settings.SIMILARITY_MAX_K, default=20
+    )
+    books = serializers.ListField(child=serializers.UUIDField(), required=False)
+    printer = serializers.CharField(required=False)
+    date_from = serializers.DateField(required=False)
+    date_to = serializers.DateField(required=False)
+
+
+class ManifestWindowSerializer(serializers.Serializer):
+    start = serializers.IntegerField(
+        min_value=0, default=0, help_text="Index of the first page, from 0"
+    )
+    count = serializers.IntegerField(
+        min_value=1,
+        max_value=settings.MANIFEST_MAX_WINDOW,
+        default=settings.MANIFEST_MAX_WINDOW,
+        help_text="Number of pages",
+    )
+
+
 class CharacterMatchSerializer(serializers.ModelSerializer):
     character_class = serializers.PrimaryKeyRelatedField(
         queryset=models.CharacterClass.objects.all()
@@ -558,6 +658,18 @@ class CharacterMatchSerializer(serializers.ModelSerializer):
         ]
 
 
+class SavedCharacterMatchSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = models.CharacterMatch
+        fields = ["id", "book", "query", "matches"]
+
+
+class BookMatchSummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = models.BookMatchSummary
+        fields = ["book", "matched_book", "n_queries", "n_matches"]
+
+
 class ExistingCharacterMatchSerializer(serializers.Serializer):
     query = serializers.PrimaryKeyRelatedField(
         queryset=models.Character.objects.all(), many=False
@@ -1,8 +1,13 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.core.management import call_command
 from pp import models
 import tempfile
 import json
+import os
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
+from PIL import Image
 
 # Create your tests here.
 
@@ -133,3 +138,118 @@ class RootViewTest(TestCase):
                 ).sequence,
                 8,
             )
+
+    def test_refresh_book_stats(self):
+        call_command("refresh_book_stats")
+        for run in models.CharacterRun.objects.all():
+            stats = models.BookStats.objects.get(character_run=run)
+            self.assertEqual(stats.book_id, run.book_id)
+            self.assertEqual(stats.n_characters, run.characters.count())
+            self.assertEqual(
+                sum(stats.character_class_counts.values()), stats.n_characters
+            )
+            self.assertEqual(run.component_count(), stats.n_characters)
+        for run in models.PageRun.objects.all():
+            self.assertEqual(run.stats.n_pages, run.pages.count())
+
+
+class BenchmarkConnectionsTest(TransactionTestCase):
+    fixtures = ["test.json"]
+
+    def test_benchmark_connections(self):
+        out = StringIO()
+        call_command("benchmark_connections", requests=5, stdout=out)
+        self.assertIn("unpooled: mean", out.getvalue())
+        self.assertIn("pooled: mean", out.getvalue())
+        # The original connection is restored afterwards
+        self.assertTrue(models.Book.objects.exists())
+
+
+class ImportTopKMatchesTest(TestCase):
+    fixtures = ["test.json"]
+
+    def test_import_topk_matches(self):
+        page = models.Page.objects.select_related("created_by_run__book").filter(
+            tif__isnull=False
+        )[0]
+        book = page.created_by_run.book
+        characters = [
+            str(pk) for pk in models.Character.objects.values_list("pk", flat=True)[:3]
+        ]
+        with tempfile.TemporaryDirectory() as base_path:
+            class_dir = os.path.join(
+                base_path, *page.tif.split("/")[0:4], "matching_output_a", "e"
+            )
+            os.makedirs(class_dir)
+            csv_file = os.path.join(class_dir, "e_topk_uuid.csv")
+            with open(csv_file, "w") as f:
+                f.write(",".join(characters + ["0.5", "0.75"]) + "\n")
+                f.write(",".join(characters[::-1] + ["0.25", "1.5"]) + "\n")
+            with mock.patch(
+                "pp.management.commands.import_topk_matches.BASE_PATH", base_path
+            ):
+                call_command("import_topk_matches", book_id=book.pk, stdout=StringIO())
+                match_set = models.TopKMatchSet.objects.get(book=book)
+                self.assertEqual(match_set.directory, "matching_output_a")
+                self.assertEqual(match_set.character_class, "e")
+                self.assertEqual(match_set.n_queries, 2)
+                self.assertEqual(
+                    list(match_set.matches.values_list("row", "rank", "distance")),
+                    [(0, 0, 0.5), (0, 1, 0.75), (1, 0, 0.25), (1, 1, 1.5)],
+                )
+                # Unchanged files are skipped
+                out = StringIO()
+                call_command("import_topk_matches", book_id=book.pk, stdout=out)
+                self.assertEqual(out.getvalue(), "")
+
+
+class BuildManifestsTest(TransactionTestCase):
+    fixtures = ["test.json"]
+
+    def test_build_manifests(self):
+        books = models.Book.objects.filter(pageruns__pages__isnull=False).distinct()
+        with mock.patch(
+            "pp.manifest.stored_manifests.prepare_manifest",
+            side_effect=lambda page_run: SimpleNamespace(
+                page_run=page_run, chunks=lambda: [json.dumps({"label": "manifest"})]
+            ),
+        ) as generate:
+            out = StringIO()
+            call_command("build_manifests", workers=2, stdout=out)
+            self.assertEqual(
+                out.getvalue().strip(),
+                f"Built {books.count()} of {books.count()} manifests",
+            )
+            for book in books:
+                manifest = models.Manifest.objects.get(
+                    page_run_id=book.current_run_id("page")
+                )
+                self.assertEqual(json.loads(manifest.content), {"label": "manifest"})
+            # Stored manifests are only rebuilt with --force
+            call_command("build_manifests", stdout=StringIO())
+            self.assertEqual(generate.call_count, books.count())
+            call_command("build_manifests", force=True, stdout=StringIO())
+            self.assertEqual(generate.call_count, 2 * books.count())
+
+
+class RefreshImageSizesTest(TestCase):
+    fixtures = ["test.json"]
+
+    def test_refresh_image_sizes(self):
+        page = models.Page.objects.exclude(tif="")[0]
+        spread = models.Spread.objects.exclude(tif="")[0]
+        with tempfile.TemporaryDirectory() as image_dir:
+            for tif, size in [(page.tif, (30, 20)), (spread.tif, (60, 20))]:
+                path = os.path.join(image_dir, tif.lstrip("/"))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                Image.new("L", size).save(path, format="TIFF")
+            with self.settings(REAL_IMAGE_BASEDIR=image_dir):
+                call_command("refresh_image_sizes")
+        page.refresh_from_db()
+        spread.refresh_from_db()
+        self.assertEqual((page.width, page.height), (30, 20))
+        self.assertEqual((spread.width, spread.height), (60, 20))
+        # Images that couldn't be read are left without a size
+        self.assertFalse(
+            models.Page.objects.exclude(pk=page.pk).filter(width__isnull=False).exists()
+        )
@@ -1,8 +1,33 @@
-from django.test import TestCase
+import io
+import json
+import os
+import tarfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from unittest import mock
+
+import httpx
+from PIL import Image
+from asgiref.sync import sync_to_async
+from django.core import signals
+from django.core.cache import caches
+from django.db import close_old_connections, connection
+from django.db.models import Count
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from rest_framework.reverse import reverse
 from rest_framework.test import APIClient
 from rest_framework.authtoken.models import Token
 from pp import models
+from pp.crops.crop_engine import CropEngine
+from pp.crops.crop_scheduler import CropScheduler
+from pp.matches import find_matching_chars
+from pp.matches.import_topk_matches import import_topk_csv
+from pp.matches.nn_index import similarity_index, store_features
+from web import db_router
+from web.streaming import ASGIHandler
 
 # Create your tests here.
 
@@ -14,6 +39,17 @@ def noaccess(self):
     self.assertEqual(self.client.delete(self.ENDPOINT).status_code, 403)
 
 
+def fake_prepare_manifest(label):
+    """Stand-in for prepare_manifest, writing a manifest with only a label"""
+
+    def prepare_manifest(page_run, start=0, stop=None):
+        return SimpleNamespace(
+            page_run=page_run, chunks=lambda: [json.dumps({"label": label})]
+        )
+
+    return prepare_manifest
+
+
 def as_auth(username="root"):
     def as_auth_name(func):
         """
@@ -323,10 +359,572 @@ class BookViewTest(TestCase):
         self.assertEqual(res2.status_code, 200)
         self.assertEqual(res2.data["eebo"], 500)
 
+    @as_auth()
+    def test_stats(self):
+        run = models.CharacterRun.objects.filter(book=self.OBJ1).first()
+        models.BookStats.refresh_run(run)
+        res = self.client.get(self.ENDPOINT + self.STR1 + "/stats/")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.data), 1)
+        for k in [
+            "character_run",
+            "n_characters",
+            "character_class_counts",
+            "damage_score_mean",
+            "damage_score_p50",
+        ]:
+            self.assertIn(k, res.data[0])
+        self.assertEqual(res.data[0]["n_characters"], run.characters.count())
+
+    @as_auth()
+    def test_promote_runs(self):
+        book = models.Book.objects.get(pk=self.OBJ1)
+        older_run = book.pageruns.first()
+        # Newly-created runs are promoted automatically
+        new_run = models.PageRun.objects.create(book=book)
+        book.refresh_from_db()
+        self.assertEqual(book.current_page_run, new_run)
+        self.assertFalse(book.most_recent_pages().exists())
+        res = self.client.post(
+            self.ENDPOINT + self.STR1 + "/promote_runs/",
+            data={"page_run": str(older_run.pk)},
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data["current_page_run"], older_run.pk)
+        book.refresh_from_db()
+        self.assertEqual(book.current_page_run, older_run)
+        self.assertEqual(set(book.most_recent_pages()), set(older_run.pages.all()))
+        self.assertEqual(book.cover_page, older_run.pages.order_by("sequence").first())
+        other_run = models.PageRun.objects.exclude(book=book).first()
+        bad_res = self.client.post(
+            self.ENDPOINT + self.STR1 + "/promote_runs/",
+            data={"page_run": str(other_run.pk)},
+        )
+        self.assertEqual(bad_res.status_code, 400)
+
+    @as_auth()
+    def test_character_filters(self):
+        models.Book.refresh_character_counts(models.Book.objects.values("id"))
+        with_characters = models.Book.objects.filter(
+            characterruns__characters__isnull=False
+        ).distinct()
+        grouped = models.Book.objects.filter(
+            characterruns__characters__charactergroupings__isnull=False
+        ).distinct()
+        res = self.client.get(self.ENDPOINT, {"characters": True})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data["count"], with_characters.count())
+        res = self.client.get(self.ENDPOINT, {"characters": False})
+        self.assertEqual(res.data["count"], self.OBJCOUNT - with_characters.count())
+        res = self.client.get(self.ENDPOINT, {"has_grouping": True})
+        self.assertEqual(res.data["count"], grouped.count())
+
+    @as_auth()
+    def test_list_cover_page(self):
+        for book in models.Book.objects.all():
+            book.refresh_cover_page()
+        # Warm up per-client bookkeeping (e.g. IP logging) before counting queries
+        self.client.get(self.ENDPOINT, {"limit": 1})
+        with CaptureQueriesContext(connection) as one_book:
+            self.client.get(self.ENDPOINT, {"limit": 1})
+        with CaptureQueriesContext(connection) as all_books:
+            res = self.client.get(self.ENDPOINT, {"limit": self.OBJCOUNT})
+        self.assertEqual(len(one_book), len(all_books))
+        covered = [b for b in res.data["results"] if b["cover_page"] is not None]
+        self.assertTrue(covered)
+        self.assertIn("web_url", covered[0]["cover_page"]["image"])
+
+    @as_auth()
+    def test_bulk_characters_batches(self):
+        character_run = models.CharacterRun.objects.first()
+        book = character_run.book
+        models.Book.refresh_character_counts([book.pk])
+        models.BookStats.refresh_run(character_run)
+        line = models.Line.objects.filter(page__created_by_run__book=book).first()
+        character_class = models.CharacterClass.objects.first().pk
+
+        def batch(ids):
+            return {
+                "character_run_id": str(character_run.pk),
+                "characters": [
+                    {
+                        "id": str(uuid.UUID(int=i)),
+                        "line_id": str(line.pk),
+                        "sequence": i,
+                        "y_start": 0,
+                        "y_end": 10,
+                        "x_start": 0,
+                        "x_end": 10,
+                        "offset": 0,
+                        "exposure": 0,
+                        "logprob": -0.5,
+                        "damage_score": 0.1 * i,
+                        "character_class": character_class,
+                    }
+                    for i in ids
+                ],
+            }
+
+        endpoint = self.ENDPOINT + str(book.pk) + "/bulk_characters/"
+        for ids in [range(1, 4), range(4, 6), range(3, 7)]:
+            res = self.client.post(endpoint, data=batch(ids), format="json")
+            self.assertEqual(res.status_code, 201)
+        book.refresh_from_db()
+        self.assertEqual(
+            book.n_characters,
+            models.Character.objects.filter(created_by_run__book=book).count(),
+        )
+        # Counted incrementally, with the percentiles computed when the stats are read
+        stats = self.client.get(self.ENDPOINT + str(book.pk) + "/stats/").data
+        stats = next(s for s in stats if s["character_run"] == character_run.pk)
+        expected = models.BookStats.refresh_run(character_run)
+        for field in ["n_characters", "character_class_counts", "n_damage_scores"]:
+            self.assertEqual(stats[field], getattr(expected, field))
+        for field in ["damage_score_mean", "damage_score_p50", "damage_score_p90"]:
+            self.assertAlmostEqual(stats[field], getattr(expected, field))
+
+    @as_auth()
+    def test_bulk_pages_cover_page(self):
+        book = models.Book.objects.filter(pageruns__pages__isnull=False)[0]
+        stored = models.Page.objects.filter(created_by_run__book=book)[0]
+        res = self.client.post(
+            self.ENDPOINT + str(book.pk) + "/bulk_pages/",
+            data={
+                "pages": [
+                    # Already stored, so not part of the new run
+                    {
+                        "id": str(stored.pk),
+                        "sequence": 0,
+                        "side": "s",
+                        "filename": "/root/" + stored.tif,
+                    },
+                    {
+                        "id": str(uuid.UUID(int=1)),
+                        "sequence": 1,
+                        "side": "s",
+                        "filename": "/root/" + stored.tif,
+                    },
+                ],
+                "tif_root": "/root/",
+            },
+            format="json",
+        )
+        self.assertEqual(res.status_code, 201)
+        book.refresh_from_db()
+        self.assertEqual(book.cover_page_id, uuid.UUID(int=1))
+        self.assertEqual(book.cover_page.created_by_run, book.current_page_run)
+
+    def test_page_save_cover(self):
+        book = (
+            models.Book.objects.annotate(n_pages=Count("pageruns__pages"))
+            .filter(n_pages__gt=1)
+            .first()
+        )
+        book.refresh_cover_page()
+        cover = book.cover_page
+        later = book.most_recent_pages().exclude(pk=cover.pk).last()
+        with mock.patch.object(models.Book, "refresh_cover_page") as refresh:
+            later.save()
+        refresh.assert_not_called()
+        cover.sequence = later.sequence + 1
+        cover.save()
+        book.refresh_from_db()
+        self.assertNotEqual(book.cover_page, cover)
+        cover.sequence = 0
+        cover.save()
+        book.refresh_from_db()
+        self.assertEqual(book.cover_page, cover)
+
     def test_noaccess(self):
         noaccess(self)
 
 
+    @as_auth()
+    def test_save_matched_characters(self):
+        characters = [
+            str(pk) for pk in models.Character.objects.values_list("pk", flat=True)[:4]
+        ]
+        endpoint = self.ENDPOINT + self.STR1
+        matches = [
+            {"query": characters[0], "matches": characters[1:3]},
+            {"query": characters[1], "matches": characters[2:4]},
+            {"query": characters[2], "matches": []},
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.post(
+                endpoint + "/save_matched_characters/", data={"matches": matches}
+            )
+        self.assertEqual(res.status_code, 200)
+        # One lookup of the query characters, one upsert and one delete, besides
+        # refreshing the book's match summary
+        self.assertEqual(
+            len(
+                [
+                    q
+                    for q in queries.captured_queries
+                    if (
+                        "pp_charactermatch" in q["sql"]
+                        or 'FROM "pp_character"' in q["sql"]
+                    )
+                    and "pp_bookmatchsummary" not in q["sql"]
+                ]
+            ),
+            3,
+        )
+        res = self.client.post(
+            endpoint + "/save_matched_characters/",
+            data={
+                "matches": [
+                    {"query": characters[0], "matches": characters[3:4]},
+                    {"query": characters[1], "matches": []},
+                ]
+            },
+        )
+        self.assertEqual(res.status_code, 200)
+        res = self.client.post(
+            endpoint + "/existing_matched_characters/",
+            data={"queries": characters[::-1]},
+        )
+        self.assertEqual(
+            [
+                (str(m["query"]), [str(c) for c in m["matches"]])
+                for m in res.data["existing_matches"]
+            ],
+            [(characters[0], characters[3:4])],
+        )
+        self.assertEqual(
+            models.CharacterMatch.objects.filter(book=self.OBJ1).count(), 1
+        )
+        # Nothing is saved if any query isn't a character
+        res = self.client.post(
+            endpoint + "/save_matched_characters/",
+            data={
+                "matches": [
+                    {"query": characters[1], "matches": characters[2:3]},
+                    {
+                        "query": "00000000-0000-0000-0000-000000000000",
+                        "matches": characters[2:3],
+                    },
+                ]
+            },
+        )
+        self.assertEqual(res.status_code, 500)
+        self.assertEqual(
+            models.CharacterMatch.objects.filter(book=self.OBJ1).count(), 1
+        )
+
+    @as_auth()
+    def test_match_summary(self):
+        book = models.Book.objects.get(pk=self.OBJ1)
+        queries = list(models.Character.objects.filter(created_by_run__book=book)[:2])
+        other_book = models.Book.objects.exclude(pk=book.pk).filter(
+            characterruns__characters__isnull=False
+        )[0]
+        others = list(
+            models.Character.objects.filter(created_by_run__book=other_book)[:2]
+        )
+        res = self.client.post(
+            self.ENDPOINT + self.STR1 + "/save_matched_characters/",
+            data={
+                "matches": [
+                    {"query": str(queries[0].pk), "matches": [str(others[0].pk)]},
+                    {
+                        "query": str(queries[1].pk),
+                        "matches": [str(c.pk) for c in others + queries[:1]],
+                    },
+                ]
+            },
+        )
+        self.assertEqual(res.status_code, 200)
+        res = self.client.get(self.ENDPOINT + self.STR1 + "/match_summary/")
+        self.assertEqual(
+            [
+                (m["matched_book"], m["n_queries"], m["n_matches"])
+                for m in res.data["matches"]
+            ],
+            [(other_book.pk, 2, 3), (book.pk, 1, 1)],
+        )
+        res = self.client.get(self.ENDPOINT + str(other_book.pk) + "/match_summary/")
+        self.assertEqual(
+            [(m["book"], m["n_matches"]) for m in res.data["matched_by"]],
+            [(book.pk, 3)],
+        )
+        res = self.client.get(
+            self.ENDPOINT + self.STR1 + "/matches_with/", {"book": self.STR1}
+        )
+        self.assertEqual([m["query"] for m in res.data["results"]], [queries[1].pk])
+        res = self.client.get(
+            self.ENDPOINT + self.STR1 + "/matches_with/", {"book": "nonsense"}
+        )
+        self.assertEqual(res.status_code, 400)
+        res = self.client.get(reverse("character-matched-by", args=[others[0].pk]))
+        self.assertEqual(res.data["count"], 2)
+        res = self.client.get(reverse("character-matched-by", args=[others[1].pk]))
+        self.assertEqual([m["query"] for m in res.data["results"]], [queries[1].pk])
+
+    @as_auth()
+    def test_generate_manifest(self):
+        book = models.Book.objects.filter(pageruns__pages__isnull=False)[0]
+        endpoint = self.ENDPOINT + str(book.pk) + "/generate_manifest/"
+        with mock.patch(
+            "pp.manifest.stored_manifests.prepare_manifest",
+            side_effect=fake_prepare_manifest("first"),
+        ) as generate:
+            res = self.client.get(endpoint)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.json(), {"label": "first"})
+            etag = res["ETag"]
+            # The stored manifest is served without regenerating it
+            res = self.client.get(endpoint, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(res.status_code, 304)
+            self.assertEqual(generate.call_count, 1)
+            # Ingesting a new page run regenerates the manifest
+            generate.side_effect = fake_prepare_manifest("second")
+            page = models.Page.objects.filter(created_by_run__book=book)[0]
+            with self.captureOnCommitCallbacks(execute=True):
+                res = self.client.post(
+                    self.ENDPOINT + str(book.pk) + "/bulk_pages/",
+                    data={
+                        "pages": [
+                            {
+                                "id": "6f8e3f1c-3f0e-4f69-9c39-6f0bd7ed8a37",
+                                "sequence": 0,
+                                "side": "s",
+                                "filename": "/root/" + page.tif,
+                            }
+                        ],
+                        "tif_root": "/root/",
+                    },
+                )
+            self.assertEqual(res.status_code, 201)
+            self.assertEqual(generate.call_count, 2)
+            res = self.client.get(endpoint, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.json(), {"label": "second"})
+            self.assertNotEqual(res["ETag"], etag)
+            # Editing a page or a spread drops the stored manifest
+            book.refresh_from_db()
+            for obj, endpoint_name in [
+                (book.most_recent_pages()[0], "page-detail"),
+                (book.spreads.first(), "spread-detail"),
+            ]:
+                res = self.client.patch(
+                    reverse(endpoint_name, args=[obj.pk]), data={"sequence": 7}
+                )
+                self.assertEqual(res.status_code, 200)
+                self.assertFalse(
+                    models.Manifest.objects.filter(
+                        page_run=book.current_page_run_id
+                    ).exists()
+                )
+                self.client.get(endpoint)
+            self.assertEqual(generate.call_count, 4)
+
+    @as_auth()
+    def test_generate_manifest_from_stored_sizes(self):
+        book = models.Book.objects.get(pk=self.OBJ1)
+        page_run = models.PageRun.objects.create(book=book)
+        for sequence, tif in enumerate(["s1_page1", "s1_page2", "s2_page1"]):
+            models.Page.objects.create(
+                created_by_run=page_run,
+                sequence=sequence,
+                tif=f"/a/b/c/lines_color/{tif}.tif",
+            )
+        spread = models.Spread.objects.create(
+            book=book, sequence=99, tif="/a/b/c/originals/s1.tif"
+        )
+        models.Spread.objects.filter(pk=spread.pk).update(width=300, height=200)
+        endpoint = self.ENDPOINT + self.STR1 + "/generate_manifest/"
+        with TemporaryDirectory() as base_path:
+            os.makedirs(os.path.join(base_path, "a/b/c/originals"))
+            with mock.patch(
+                "pp.manifest.generate_iiif_manifest.BASE_PATH", base_path + "/"
+            ), mock.patch(
+                "pp.manifest.stored_manifests.afetch_sizes",
+                return_value={"a/b/c/originals/s2.tif": (210, 310)},
+            ) as fetch:
+                res = self.client.get(endpoint)
+                # Only the size that isn't stored is fetched
+                fetch.assert_called_once_with("a/b/c/originals", ["s2.tif"])
+                self.assertEqual(res.status_code, 200)
+                full_manifest = res.json()
+                canvases = full_manifest["sequences"][0]["canvases"]
+                self.assertEqual(
+                    [(c["height"], c["width"]) for c in canvases],
+                    [(200, 300), (200, 300), (210, 310)],
+                )
+                self.assertIn(
+                    "/a/b/c/originals/s1.tif/",
+                    canvases[0]["images"][0]["resource"]["@id"],
+                )
+                # A window of pages keeps their canvas IDs, listed in a range
+                res = self.client.get(endpoint, {"start": 1, "count": 5})
+                self.assertEqual(res.status_code, 200)
+                manifest = json.loads(b"".join(res.streaming_content))
+                self.assertEqual(
+                    [c["@id"] for c in manifest["sequences"][0]["canvases"]],
+                    [c["@id"] for c in canvases[1:]],
+                )
+                self.assertEqual(
+                    manifest["structures"][0]["canvases"],
+                    [c["@id"] for c in canvases[1:]],
+                )
+                self.assertEqual(manifest["within"], full_manifest["@id"])
+                res = self.client.get(endpoint, {"start": 3})
+                self.assertEqual(res.status_code, 400)
+                res = self.client.get(endpoint, {"count": 0})
+                self.assertEqual(res.status_code, 400)
+
+    @as_auth()
+    def test_matched_directories(self):
+        page = models.Page.objects.filter(
+            created_by_run__book=self.OBJ1, tif__isnull=False
+        ).first()
+        endpoint = self.ENDPOINT + self.STR1 + "/matched_directories/"
+        with TemporaryDirectory() as base_path:
+            matches_path = os.path.join(base_path, *page.tif.split("/")[0:4])
+            os.makedirs(os.path.join(matches_path, "matching_output_a", "e"))
+            os.makedirs(os.path.join(matches_path, "unrelated"))
+            with mock.patch("pp.views.BASE_PATH", base_path), mock.patch(
+                "pp.matches.find_matching_chars._get_immediate_subdirectories",
+                wraps=find_matching_chars._get_immediate_subdirectories,
+            ) as list_directory:
+                res = self.client.get(endpoint)
+                self.assertEqual(
+                    res.data["match_directories"],
+                    [{"dir": "matching_output_a", "character_classes": ["e"]}],
+                )
+                # Unchanged directories aren't listed again
+                list_directory.reset_mock()
+                self.assertEqual(self.client.get(endpoint).data, res.data)
+                list_directory.assert_not_called()
+                os.makedirs(os.path.join(matches_path, "matching_output_a", "f"))
+                os.makedirs(os.path.join(matches_path, "matching_output_b"))
+                res = self.client.get(endpoint)
+                self.assertCountEqual(
+                    res.data["match_directories"],
+                    [
+                        {"dir": "matching_output_a", "character_classes": ["f", "e"]},
+                        {"dir": "matching_output_b"},
+                    ],
+                )
+
+    @as_auth()
+    def test_matched_characters(self):
+        page = models.Page.objects.filter(
+            created_by_run__book=self.OBJ1, tif__isnull=False
+        ).first()
+        characters = [
+            str(pk) for pk in models.Character.objects.values_list("pk", flat=True)[:3]
+        ]
+        endpoint = self.ENDPOINT + self.STR1 + "/matched_characters/"
+        body = {"dir": "matching_output_a", "character_class": "e"}
+        with TemporaryDirectory() as base_path:
+            class_dir = os.path.join(
+                base_path, *page.tif.split("/")[0:4], "matching_output_a", "e"
+            )
+            os.makedirs(class_dir)
+            with open(os.path.join(class_dir, "e_topk_uuid.csv"), "w") as f:
+                for i in range(7):
+                    f.write(",".join(characters + [str(i), "9"]) + "\n")
+            with mock.patch("pp.views.BASE_PATH", base_path), mock.patch(
+                "pp.matches.find_matching_chars.CSV_INDEX_INTERVAL", 3
+            ):
+                for offset in range(8):
+                    res = self.client.post(
+                        endpoint + f"?limit=2&offset={offset}", data=body
+                    )
+                    self.assertEqual(res.status_code, 200)
+                    self.assertEqual(res.data["total_count"], 7)
+                    self.assertEqual(
+                        [row["distances"] for row in res.data["matched_characters"]],
+                        [[float(i), 9.0] for i in range(offset, min(offset + 2, 7))],
+                    )
+                caches["character_matches"].clear()
+                # All the characters on a page are fetched in one query, and then cached
+                for n_queries in [1, 0]:
+                    with CaptureQueriesContext(connection) as queries:
+                        res = self.client.post(endpoint + "?limit=5", data=body)
+                    self.assertEqual(
+                        len(
+                            [
+                                q
+                                for q in queries.captured_queries
+                                if q["sql"].startswith('SELECT "pp_character"')
+                            ]
+                        ),
+                        n_queries,
+                    )
+                    self.assertEqual(
+                        [c["id"] for c in res.data["matched_characters"][4]["matches"]],
+                        characters[1:],
+                    )
+
+    @as_auth()
+    def test_imported_matched_characters(self):
+        characters = [
+            str(pk) for pk in models.Character.objects.values_list("pk", flat=True)[:3]
+        ]
+        with TemporaryDirectory() as tdir:
+            csv_file = os.path.join(tdir, "e_topk_uuid.csv")
+            with open(csv_file, "w") as f:
+                for distances in [["0.5", "0.75"], ["0.25", "1.5"], ["2.0", "3.0"]]:
+                    f.write(",".join(characters + distances) + "\n")
+            import_topk_csv(
+                models.Book.objects.get(pk=self.OBJ1),
+                "matching_output_a",
+                "e",
+                csv_file,
+            )
+        endpoint = self.ENDPOINT + self.STR1 + "/matched_characters/"
+        body = {"dir": "matching_output_a", "character_class": "e"}
+        res = self.client.post(endpoint + "?limit=2&offset=1", data=body)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data["total_count"], 3)
+        self.assertEqual(
+            [row["distances"] for row in res.data["matched_characters"]],
+            [[0.25, 1.5], [2.0, 3.0]],
+        )
+        first = res.data["matched_characters"][0]
+        self.assertEqual(first["target"]["id"], characters[0])
+        self.assertEqual([c["id"] for c in first["matches"]], characters[1:])
+        res = self.client.post(
+            endpoint + "?ordering=distance&max_distance=1", data=body
+        )
+        self.assertEqual(res.data["total_count"], 2)
+        self.assertEqual(
+            [row["distances"] for row in res.data["matched_characters"]],
+            [[0.25], [0.5, 0.75]],
+        )
+        res = self.client.post(endpoint + "?ordering=size", data=body)
+        self.assertEqual(res.status_code, 400)
+
+    @as_auth()
+    def test_imported_matches_changed_csv(self):
+        characters = [
+            str(pk) for pk in models.Character.objects.values_list("pk", flat=True)[:2]
+        ]
+        endpoint = self.ENDPOINT + self.STR1 + "/matched_characters/"
+        body = {"dir": "matching_output_a", "character_class": "e"}
+        with TemporaryDirectory() as tdir:
+            csv_file = os.path.join(tdir, "e_topk_uuid.csv")
+            with open(csv_file, "w") as f:
+                f.write(",".join(characters + ["0.5"]) + "\n")
+            import_topk_csv(
+                models.Book.objects.get(pk=self.OBJ1),
+                "matching_output_a",
+                "e",
+                csv_file,
+            )
+            res = self.client.post(endpoint + "?ordering=distance", data=body)
+            self.assertEqual(res.status_code, 200)
+            # Rewritten after the import, so its rows are no longer served
+            os.utime(csv_file, (0, 0))
+            with self.assertLogs(level="WARNING"):
+                res = self.client.post(endpoint + "?ordering=distance", data=body)
+            self.assertEqual(res.status_code, 400)
+
+
 class SpreadViewTest(TestCase):
     fixtures = ["test.json"]
 
@@ -482,6 +1080,24 @@ class PageViewTest(TestCase):
         ]:
             self.assertIn(k, res.data)
 
+    @as_auth()
+    def test_patch_keeps_image_size(self):
+        models.Page.objects.filter(pk=self.OBJ1).update(width=30, height=20)
+        with mock.patch("pp.models.read_image_size") as read:
+            res = self.client.patch(self.ENDPOINT + self.STR1 + "/", data={"x": 5})
+            self.assertEqual(res.status_code, 200)
+            # The TIFF is only read again when tif changes
+            read.assert_not_called()
+            read.return_value = None
+            res = self.client.patch(
+                self.ENDPOINT + self.STR1 + "/", data={"tif": "/foo/bat.tiff"}
+            )
+            self.assertEqual(res.status_code, 200)
+            read.assert_called_once_with("/foo/bat.tiff")
+        # The stored size was the old image's, so it isn't kept for one that can't be read
+        page = models.Page.objects.get(pk=self.OBJ1)
+        self.assertEqual((page.width, page.height), (None, None))
+
     def test_noaccess(self):
         noaccess(self)
 
@@ -691,10 +1307,217 @@ class CharacterViewTest(TestCase):
             res = self.client.get(f"{self.ENDPOINT}{i}/")
             self.assertEqual(res.data["human_character_class"], "a")
 
+    @as_auth()
+    def test_distribution(self):
+        res = self.client.get(f"{self.ENDPOINT}distribution/", {"bins": 5})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.data["results"]), 1)
+        overall = res.data["results"][0]
+        self.assertEqual(overall["count"], models.Character.objects.count())
+        for metric in ["damage_score", "class_probability"]:
+            for k in ["count", "mean", "percentiles", "histogram"]:
+                self.assertIn(k, overall[metric])
+            self.assertIn("p50", overall[metric]["percentiles"])
+            self.assertEqual(len(overall[metric]["histogram"]), 5)
+            self.assertEqual(
+                sum(b["count"] for b in overall[metric]["histogram"]),
+                overall[metric]["count"],
+            )
+        grouped = self.client.get(
+            f"{self.ENDPOINT}distribution/", {"group_by": "book"}
+        )
+        self.assertEqual(grouped.status_code, 200)
+        self.assertEqual(
+            sum(g["count"] for g in grouped.data["results"]), overall["count"]
+        )
+        bad_res = self.client.get(f"{self.ENDPOINT}distribution/", {"group_by": "foo"})
+        self.assertEqual(bad_res.status_code, 400)
+
+    @as_auth()
+    def test_confusion_matrix(self):
+        for run in models.CharacterRun.objects.all():
+            models.ClassConfusion.refresh_run(run)
+        char_ids = [str(c.id) for c in self.CHARS1]
+        self.client.post(
+            f"{self.ENDPOINT}annotate/",
+            data={"characters": char_ids, "human_character_class": "a"},
+        )
+        res = self.client.get(f"{self.ENDPOINT}confusion_matrix/")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            res.data["n_annotated"],
+            models.Character.objects.filter(human_character_class__isnull=False).count(),
+        )
+        self.assertIn("human_character_class", res.data["cells"][0])
+        summary_res = self.client.get(
+            f"{self.ENDPOINT}confusion_matrix/", {"summary": True}
+        )
+        self.assertEqual(summary_res.data, res.data)
+        book = models.Character.objects.get(pk=char_ids[0]).created_by_run.book
+        book_res = self.client.get(
+            f"{self.ENDPOINT}confusion_matrix/", {"book": str(book.pk), "summary": True}
+        )
+        self.assertEqual(
+            book_res.data["n_annotated"],
+            models.Character.objects.filter(
+                created_by_run__book=book, human_character_class__isnull=False
+            ).count(),
+        )
+
+    @as_auth()
+    def test_confusion_summary_follows_edits(self):
+        # No summary has been built: the first change must build it, not start from zero
+        char_ids = [str(c.id) for c in self.CHARS1]
+        self.client.post(
+            f"{self.ENDPOINT}annotate/",
+            data={"characters": char_ids[1:], "human_character_class": "a"},
+        )
+        res = self.client.patch(
+            f"{self.ENDPOINT}{char_ids[0]}/", data={"human_character_class": "a"}
+        )
+        self.assertEqual(res.status_code, 200)
+        res = self.client.delete(f"{self.ENDPOINT}{char_ids[1]}/")
+        self.assertEqual(res.status_code, 204)
+        full = self.client.get(f"{self.ENDPOINT}confusion_matrix/")
+        summary = self.client.get(
+            f"{self.ENDPOINT}confusion_matrix/", {"summary": True}
+        )
+        self.assertEqual(summary.data, full.data)
+
+    @as_auth()
+    def test_delete_updates_book_counts(self):
+        models.Book.refresh_character_counts(models.Book.objects.values("id"))
+        char = models.Character.objects.get(pk=self.CHARS1[0].id)
+        book = char.created_by_run.book
+        book.refresh_from_db()
+        n_characters = book.n_characters
+        res = self.client.delete(f"{self.ENDPOINT}{char.pk}/")
+        self.assertEqual(res.status_code, 204)
+        book.refresh_from_db()
+        self.assertEqual(book.n_characters, n_characters - 1)
+        self.assertEqual(
+            book.n_grouped_characters,
+            models.Character.objects.filter(
+                created_by_run__book=book, charactergroupings__isnull=False
+            )
+            .distinct()
+            .count(),
+        )
+
+    @as_auth()
+    def test_batch(self):
+        char_ids = [str(c.id) for c in self.CHARS1]
+        missing_id = "00000000-0000-0000-0000-000000000000"
+        res = self.client.post(
+            f"{self.ENDPOINT}batch/",
+            data={"characters": char_ids + [missing_id]},
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([c["id"] for c in res.data["characters"]], char_ids)
+        self.assertEqual([str(i) for i in res.data["missing"]], [missing_id])
+        for k in ["url", "id", "label", "book", "character_class", "image"]:
+            self.assertIn(k, res.data["characters"][0])
+        bad_res = self.client.post(f"{self.ENDPOINT}batch/", data={"characters": []})
+        self.assertEqual(bad_res.status_code, 400)
+
+    @as_auth()
+    def test_export(self):
+        book = models.Book.objects.filter(characterruns__characters__isnull=False).first()
+        book_count = models.Character.objects.filter(created_by_run__book=book).count()
+        res = self.client.get(f"{self.ENDPOINT}export/", {"book": str(book.pk)})
+        self.assertEqual(res.status_code, 200)
+        rows = [
+            json.loads(line)
+            for line in b"".join(res.streaming_content).decode().splitlines()
+        ]
+        self.assertEqual(len(rows), book_count)
+        for k in ["id", "book", "page_sequence", "character_class", "damage_score"]:
+            self.assertIn(k, rows[0])
+        self.assertEqual(rows[0]["book"], str(book.pk))
+        csv_res = self.client.get(
+            f"{self.ENDPOINT}export/", {"book": str(book.pk), "export_format": "csv"}
+        )
+        self.assertEqual(csv_res.status_code, 200)
+        csv_lines = b"".join(csv_res.streaming_content).decode().splitlines()
+        self.assertEqual(len(csv_lines), book_count + 1)
+        self.assertTrue(csv_lines[0].startswith("id,label,book"))
+
+    @as_auth()
+    def test_export_matches_list(self):
+        character_run = models.CharacterRun.objects.filter(
+            characters__isnull=False
+        ).first()
+        params = {
+            "character_run": str(character_run.pk),
+            "ordering": "-pageseq,-lineseq,-sequence",
+            "limit": 1000,
+        }
+        listed = self.client.get(self.ENDPOINT, params).data["results"]
+        res = self.client.get(f"{self.ENDPOINT}export/", params)
+        self.assertEqual(res.status_code, 200)
+        rows = [
+            json.loads(line)
+            for line in b"".join(res.streaming_content).decode().splitlines()
+        ]
+        self.assertEqual([row["id"] for row in rows], [c["id"] for c in listed])
+        self.assertEqual(len(rows), character_run.characters.count())
+
     def test_noaccess(self):
         noaccess(self)
 
 
+    @as_auth()
+    def test_similar(self):
+        characters = list(
+            models.Character.objects.select_related("created_by_run__book")[:12]
+        )
+        character_class = characters[0].character_class_id
+        models.Character.objects.filter(pk__in=[c.pk for c in characters]).update(
+            character_class=character_class
+        )
+        models.Book.objects.update(current_character_run=None)
+        # Each character is a little further from the first than the one before
+        store_features(
+            {str(c.pk): [1.0, 0.1 * i, 0.0] for i, c in enumerate(characters[:-1])}
+        )
+        endpoint = self.ENDPOINT + str(characters[0].pk) + "/similar/"
+        for ivf_min_size in [1000, 1]:
+            similarity_index.invalidate()
+            with self.settings(
+                SIMILARITY_IVF_MIN_SIZE=ivf_min_size, SIMILARITY_IVF_PROBES=100
+            ):
+                res = self.client.get(endpoint, {"k": 3})
+                self.assertEqual(res.status_code, 200)
+                self.assertEqual(
+                    [r["character"]["id"] for r in res.data["results"]],
+                    [str(c.pk) for c in characters[1:4]],
+                )
+                distances = [r["distance"] for r in res.data["results"]]
+                self.assertEqual(distances, sorted(distances))
+        book = characters[5].created_by_run.book
+        # Filtered characters are found even when the probed clusters hold none of them
+        for ivf_min_size in [1000, 5, 1]:
+            similarity_index.invalidate()
+            with self.settings(
+                SIMILARITY_IVF_MIN_SIZE=ivf_min_size, SIMILARITY_IVF_PROBES=1
+            ):
+                res = self.client.get(endpoint, {"k": 20, "books": [str(book.pk)]})
+            self.assertEqual(
+                [r["character"]["id"] for r in res.data["results"]],
+                [
+                    str(c.pk)
+                    for c in characters[1:-1]
+                    if c.created_by_run.book_id == book.pk
+                ],
+            )
+        res = self.client.get(endpoint, {"date_from": "1900-01-01"})
+        self.assertEqual(res.data["results"], [])
+        self.assertEqual(self.client.get(endpoint, {"k": 0}).status_code, 400)
+        # No feature vector
+        res = self.client.get(self.ENDPOINT + str(characters[-1].pk) + "/similar/")
+        self.assertEqual(res.status_code, 404)
+
+
 class CharacterClassViewTest(TestCase):
 
     fixtures = ["test.json"]
@@ -839,6 +1662,128 @@ class CharacterGroupingViewTest(TestCase):
         for char_id in all_ids:
             self.assertIn(char_id, target_ids)
 
+    @as_auth()
+    def test_grouped_character_counts(self):
+        models.CharacterGrouping.objects.all().delete()
+        char = models.Character.objects.get(pk=self.CHARS_2[0])
+        book = char.created_by_run.book
+        self.client.post(
+            self.ENDPOINT,
+            data={"label": "foo", "notes": "bar", "characters": [char.pk]},
+        )
+        book.refresh_from_db()
+        self.assertEqual(book.n_grouped_characters, 1)
+        grouping = models.CharacterGrouping.objects.get(label="foo")
+        self.client.patch(
+            f"{self.ENDPOINT}{grouping.pk}/delete_characters/",
+            data={"characters": [char.pk]},
+        )
+        book.refresh_from_db()
+        self.assertEqual(book.n_grouped_characters, 0)
+
+    @as_auth()
+    def test_download(self):
+        characters = list(self.OBJ1.characters.all())
+        unavailable = characters[0]
+
+        def fetch(client, character, url_attr):
+            if character == unavailable:
+                raise httpx.HTTPError("unavailable")
+            return character.label.encode()
+
+        with mock.patch("pp.downloads.character_tar._fetch", side_effect=fetch):
+            res = self.client.get(self.ENDPOINT + self.STR1 + "/download/")
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(res.streaming)
+            archive = b"".join(res.streaming_content)
+        with tarfile.open(fileobj=io.BytesIO(archive), mode="r:gz") as tar:
+            names = tar.getnames()
+            self.assertCountEqual(
+                names,
+                [f"{c.label}.tif" for c in characters[1:]] + ["MISSING.txt"],
+            )
+            self.assertEqual(
+                tar.extractfile(f"{characters[1].label}.tif").read(),
+                characters[1].label.encode(),
+            )
+            self.assertIn(
+                unavailable.label, tar.extractfile("MISSING.txt").read().decode()
+            )
+
+    @as_auth()
+    def test_download_local_crops(self):
+        characters = self.OBJ1.characters.select_related("line__page")
+        characters.update(x_min=10, x_max=30, y_min=5, y_max=45)
+        with TemporaryDirectory() as basedir:
+            for c in characters:
+                path = os.path.join(basedir, c.line.page.tif.lstrip("/"))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                Image.new("L", (100, 100)).save(path, format="TIFF")
+            with self.settings(CROP_ENGINE="local", REAL_IMAGE_BASEDIR=basedir):
+                with mock.patch("pp.downloads.character_tar._fetch") as fetch, mock.patch(
+                    "pp.crops.image_sizes.Image.open", wraps=Image.open
+                ) as image_open:
+                    res = self.client.get(self.ENDPOINT + self.STR1 + "/download/")
+                    archive = b"".join(res.streaming_content)
+                    fetch.assert_not_called()
+                    # Each page TIFF is decoded once
+                    self.assertEqual(
+                        image_open.call_count,
+                        len({c.line.page.tif for c in characters}),
+                    )
+                # Requests share the process's engine
+                self.assertIs(CropEngine.from_settings(), CropEngine.from_settings())
+        with tarfile.open(fileobj=io.BytesIO(archive), mode="r:gz") as tar:
+            # In the grouping's order
+            self.assertEqual(tar.getnames(), [f"{c.label}.tif" for c in characters])
+            for member in tar.getmembers():
+                self.assertEqual(Image.open(tar.extractfile(member)).size, (20, 40))
+
+    @as_auth()
+    def test_sprite(self):
+        characters = list(self.OBJ1.characters.select_related("line__page"))
+        models.Character.objects.filter(pk__in=[c.pk for c in characters]).update(
+            x_min=10, x_max=30, y_min=5, y_max=45
+        )
+        with TemporaryDirectory() as basedir, TemporaryDirectory() as sprite_dir:
+            for c in characters:
+                path = os.path.join(basedir, c.line.page.tif.lstrip("/"))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                Image.new("L", (100, 100)).save(path, format="TIFF")
+            with self.settings(
+                CROP_ENGINE="local", REAL_IMAGE_BASEDIR=basedir, SPRITE_DIR=sprite_dir
+            ):
+                res = self.client.get(self.ENDPOINT + self.STR1 + "/sprite/?size=20")
+                self.assertEqual(res.status_code, 200)
+                self.assertEqual(
+                    [c["id"] for c in res.data["characters"]],
+                    [str(c.id) for c in characters],
+                )
+                for c in res.data["characters"]:
+                    self.assertEqual(c["frame"]["w"], 10)
+                    self.assertEqual(c["frame"]["h"], 20)
+                image = self.client.get(res.data["sprite"])
+                self.assertEqual(image.status_code, 200)
+                self.assertIn("immutable", image["Cache-Control"])
+                sprite = Image.open(io.BytesIO(b"".join(image.streaming_content)))
+                self.assertEqual(sprite.size, (res.data["width"], res.data["height"]))
+                # Unchanged characters are served from disk
+                with mock.patch("pp.crops.sprites.pack") as pack:
+                    cached = self.client.get(
+                        self.ENDPOINT + self.STR1 + "/sprite/?size=20"
+                    )
+                    pack.assert_not_called()
+                self.assertEqual(cached.data, res.data)
+                # Any change to the characters gives a new sprite
+                models.Character.objects.filter(pk=characters[0].pk).update(x_max=40)
+                changed = self.client.get(
+                    self.ENDPOINT + self.STR1 + "/sprite/?size=20"
+                )
+                self.assertNotEqual(changed.data["sprite"], res.data["sprite"])
+                self.assertEqual(changed.data["characters"][0]["frame"]["w"], 15)
+                invalid = self.client.get(self.ENDPOINT + self.STR1 + "/sprite/?size=0")
+                self.assertEqual(invalid.status_code, 400)
+
     @as_auth()
     def test_delete_chars(self):
         chars_to_delete = self.CHARS_ORIG[:2]
@@ -855,3 +1800,165 @@ class CharacterGroupingViewTest(TestCase):
 
     def test_noaccess(self):
         noaccess(self)
+
+
+class ReplicaRouterTest(TestCase):
+    fixtures = ["test.json"]
+    ENDPOINT = reverse("book-list")
+
+    def setUp(self):
+        self.router = db_router.ReplicaRouter()
+
+    @override_settings(REPLICA_DATABASES=["replica1"], REPLICA_MAX_LAG_SECONDS=10)
+    def test_routing(self):
+        with mock.patch("web.db_router.replica_lag", return_value=1):
+            self.assertEqual(self.router.db_for_read(models.Book), "default")
+            with db_router.replica_reads():
+                self.assertEqual(self.router.db_for_read(models.Book), "replica1")
+                self.assertEqual(self.router.db_for_write(models.Book), "default")
+        # Lagging or unreachable replicas fall back to the primary
+        for lag in [30, None]:
+            with mock.patch("web.db_router.replica_lag", return_value=lag):
+                with db_router.replica_reads():
+                    self.assertEqual(self.router.db_for_read(models.Book), "default")
+        self.assertTrue(self.router.allow_migrate("default", "pp"))
+        self.assertFalse(self.router.allow_migrate("replica1", "pp"))
+
+    @as_auth()
+    def test_sticky_primary(self):
+        res = self.client.get(self.ENDPOINT)
+        self.assertNotIn(db_router.PRIMARY_COOKIE, res.cookies)
+        book = models.Book.objects.first()
+        res = self.client.patch(
+            reverse("book-detail", args=[book.id]), data={"pp_notes": "replicated"}
+        )
+        self.assertIn(db_router.PRIMARY_COOKIE, res.cookies)
+
+
+class AsyncEndpointTest(TestCase):
+    """
+    Requests made with the async client are served by pp.async_views
+    """
+
+    fixtures = ["test.json"]
+
+    async def test_matched_directories(self):
+        token = await sync_to_async(Token.objects.get)(user__username="root")
+        page = await sync_to_async(
+            models.Page.objects.select_related("created_by_run")
+            .filter(tif__isnull=False)
+            .first
+        )()
+        book_id = page.created_by_run.book_id
+        endpoint = f"/api/books/{book_id}/matched_directories/"
+        res = await self.async_client.get(endpoint)
+        self.assertEqual(res.status_code, 403)
+        with TemporaryDirectory() as base_path:
+            matches_path = os.path.join(base_path, *page.tif.split("/")[0:4])
+            os.makedirs(os.path.join(matches_path, "matching_output_a", "e"))
+            os.makedirs(os.path.join(matches_path, "matching_output_b"))
+            os.makedirs(os.path.join(matches_path, "unrelated"))
+            with mock.patch("pp.async_views.BASE_PATH", base_path):
+                res = await self.async_client.get(
+                    endpoint, authorization=f"Token {token.key}"
+                )
+        self.assertEqual(res.status_code, 200)
+        self.assertCountEqual(
+            res.json()["match_directories"],
+            [
+                {"dir": "matching_output_a", "character_classes": ["e"]},
+                {"dir": "matching_output_b"},
+            ],
+        )
+
+    async def test_matched_characters_requires_post(self):
+        token = await sync_to_async(Token.objects.get)(user__username="root")
+        book = await sync_to_async(models.Book.objects.first)()
+        res = await self.async_client.get(
+            f"/api/books/{book.id}/matched_characters/",
+            authorization=f"Token {token.key}",
+        )
+        self.assertEqual(res.status_code, 405)
+        self.assertEqual(res["Allow"], "POST")
+
+    async def test_export_streams_under_asgi(self):
+        token = await sync_to_async(Token.objects.get)(user__username="root")
+        n_characters = await sync_to_async(models.Character.objects.count)()
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": "/api/characters/export/",
+            "query_string": b"",
+            "headers": [(b"authorization", f"Token {token.key}".encode())],
+            "client": ("127.0.0.1", 50000),
+            "server": ("testserver", 80),
+        }
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        # Like the test client, keep the test's connection open across the request
+        signals.request_started.disconnect(close_old_connections)
+        signals.request_finished.disconnect(close_old_connections)
+        try:
+            await ASGIHandler()(scope, receive, send)
+        finally:
+            signals.request_started.connect(close_old_connections)
+            signals.request_finished.connect(close_old_connections)
+        self.assertEqual(messages[0]["status"], 200)
+        body = b"".join(m.get("body", b"") for m in messages[1:])
+        self.assertEqual(len(body.decode().splitlines()), n_characters)
+
+
+class CropSchedulerTest(TestCase):
+    def test_pages_in_flight(self):
+        submitted = []
+
+        class Executor(ThreadPoolExecutor):
+            def submit(self, fn, page, *args):
+                submitted.append(page)
+                return super().submit(fn, page, *args)
+
+        class Engine:
+            def by_page(self, objects):
+                return [(obj, [obj]) for obj in objects]
+
+            def crop_page(self, page, objects, image_format, size):
+                return [(obj, b"") for obj in objects]
+
+        objects = [SimpleNamespace(id=i) for i in range(10)]
+        with mock.patch("pp.crops.crop_scheduler.ThreadPoolExecutor", Executor):
+            crops = CropScheduler(Engine(), max_workers=2).crops(objects)
+            self.assertIs(next(crops)[0], objects[0])
+            # The first page was consumed, so one more was submitted
+            self.assertEqual(submitted, objects[:3])
+            self.assertEqual([obj for obj, _ in crops], objects[1:])
+
+
+class CropEngineTest(TestCase):
+    def test_crop_page_decodes_regions(self):
+        scan = Image.effect_noise((100, 300), 50).convert("RGB")
+        page = SimpleNamespace(tif="/page.tif")
+        objects = [
+            SimpleNamespace(id=i, absolute_coords=dict(x=10, y=y, w=20, h=30))
+            for i, y in enumerate([40, 100])
+        ]
+        limit = Image.MAX_IMAGE_PIXELS
+        with TemporaryDirectory() as basedir:
+            scan.save(os.path.join(basedir, "page.tif"))
+            engine = CropEngine(basedir)
+            crops = engine.crop_page(page, objects, image_format=None)
+            img, box = engine.pages.popitem()[1]
+        self.assertEqual(box, (10, 40, 30, 130))
+        # Only the rows of the regions were read
+        self.assertEqual(img.getpixel((0, 0)), (0, 0, 0))
+        for obj, crop in crops:
+            ac = obj.absolute_coords
+            region = (ac["x"], ac["y"], ac["x"] + ac["w"], ac["y"] + ac["h"])
+            self.assertEqual(crop.tobytes(), scan.crop(region).tobytes())
+        # The decompression bomb check is still on for other images
+        self.assertEqual(Image.MAX_IMAGE_PIXELS, limit)
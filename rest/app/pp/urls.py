@@ -1,4 +1,4 @@
-from django.urls import path, include
+from django.urls import path, include, re_path
 from django.views.generic import TemplateView
 import django.contrib.auth.views as auth_views
 from rest_framework import routers, permissions
@@ -33,5 +33,8 @@ schema_view = get_schema_view(
 
 urlpatterns = [
     path("", include(router.urls)),
+    re_path(
+        r"^sprites/(?P<key>[0-9a-f]{40})\.jpg$", views.sprite_image, name="sprite"
+    ),
     path("docs/", schema_view.with_ui("redoc", cache_timeout=0), name="schema-redoc"),
 ]
@@ -1,21 +1,22 @@
+import hashlib
 import json
-import tarfile
-from tempfile import TemporaryDirectory
 from uuid import UUID
 import logging
 import os
 
-import requests
 from django import forms
 from django.conf import settings
-from django.db import transaction, DatabaseError
-from django.db.models import F, Q, Exists, OuterRef, Prefetch
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import router, transaction, DatabaseError
+from django.db.models import Count, F, Q, Exists, OuterRef, Prefetch, Sum
+from django.db.models.functions import Greatest
 from django.db.models.query import EmptyQuerySet
-from django.http import FileResponse
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.urls import reverse
 from django.utils.text import slugify
 from django_filters import rest_framework as filters
-from django.utils.decorators import method_decorator
-from django.views.decorators.cache import cache_page
+from django.utils.cache import get_conditional_response
 from drf_tweaks.pagination import NoCountsLimitOffsetPagination
 from rest_framework import (
     viewsets,
@@ -24,24 +25,40 @@ from rest_framework import (
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from glob import glob
+from itertools import chain
 import csv
 
 from . import models, serializers
 from .management.commands.bulk_update import BookLoader as BookUpdater
 from .management.commands.bulk_load import BookLoader as BookCreator
 from .management.commands.refresh_labels import Command as LabelRefresher
-from .manifest.generate_iiif_manifest import generate_iiif_manifest
-from .matches.find_matching_chars import get_matched_characters, get_match_directories, existing_matched_characters
+from .crops.sprites import build_sprite, sprite_paths
+from .downloads.character_tar import stream_character_tar
+from .analytics.character_distributions import GROUP_FIELDS, character_distributions
+from .manifest.stored_manifests import get_manifest, manifest_window
+from .matches.find_matching_chars import (
+    get_matched_characters,
+    get_match_directories,
+    existing_matched_characters,
+    get_imported_match_set,
+    get_imported_matched_characters,
+    get_csv_index,
+    matched_characters_options,
+    serialize_characters,
+)
+from .matches.nn_index import similar_characters
 from .matches.save_matching_chars import save_matched_characters_in_db
 
 BASE_PATH = '/ocean/projects/hum160002p/shared/'
 TOP_K_CSV_SUFFIX = '*_topk_uuid.csv'
+# Sprites never change once built, as their name is a hash of their content
+SPRITE_CACHE_SECONDS = 60 * 60 * 24 * 365
 
 
 class GetSerializerClassMixin(object):
     def get_queryset(self):
         try:
-            return self.queryset_action_classes[self.action]
+            return self.queryset_action_classes[self.action].all()
         except (KeyError, AttributeError):
             return super().get_queryset()
 
@@ -52,6 +69,48 @@ class GetSerializerClassMixin(object):
             return super().get_serializer_class()
 
 
+def sprite_response(request, characters):
+    """
+    Atlas of the sprite packing the thumbnails of `characters`, at the `size` in the query parameters. A sprite that isn't stored yet is built within this request, cutting or fetching every thumbnail, which is why the number of characters is capped.
+    """
+    try:
+        size = int(request.query_params.get("size", settings.SPRITE_THUMBNAIL_SIZE))
+    except ValueError:
+        size = 0
+    if not 1 <= size <= settings.SPRITE_MAX_THUMBNAIL_SIZE:
+        return Response(
+            {"error": f"size must be an integer between 1 and {settings.SPRITE_MAX_THUMBNAIL_SIZE}"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    if len(characters) < 1:
+        return Response(
+            {"error": "There are no characters to pack into a sprite"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    if len(characters) > settings.SPRITE_MAX_CHARACTERS:
+        return Response(
+            {"error": f"Sprites can hold at most {settings.SPRITE_MAX_CHARACTERS} characters"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    key, atlas = build_sprite(characters, size)
+    return Response(
+        {**atlas, "sprite": request.build_absolute_uri(reverse("sprite", args=[key]))}
+    )
+
+
+def sprite_image(request, key):
+    """
+    A sprite built by sprite_response. Sprite names are keyed with SECRET_KEY, so only clients that were handed one by the API can ask for it, and like the IIIF images sprites are served without authentication and can be cached indefinitely.
+    """
+    image_path, _ = sprite_paths(key)
+    try:
+        response = FileResponse(open(image_path, "rb"), content_type="image/jpeg")
+    except FileNotFoundError:
+        raise Http404
+    response["Cache-Control"] = f"public, max-age={SPRITE_CACHE_SECONDS}, immutable"
+    return response
+
+
 class CRUDViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=["get"])
     def count(self, request):
@@ -67,6 +126,23 @@ class CRUDViewSet(viewsets.ModelViewSet):
         return Response({"count": ocount})
 
 
+NO_MANIFEST = "Could not find pages or original images for book to create manifest"
+
+
+def manifest_response(request, manifest):
+    """
+    A stored manifest's JSON, or 304 Not Modified if the client already has this version of it
+    """
+    etag = f'"{manifest.etag}"'
+    response = get_conditional_response(request, etag=etag) or HttpResponse(
+        manifest.content, content_type="application/json"
+    )
+    response["ETag"] = etag
+    # Clients revalidate every time, since the manifest changes when pages are re-ingested
+    response["Cache-Control"] = "no-cache"
+    return response
+
+
 class BookFilter(filters.FilterSet):
     eebo = filters.NumberFilter(help_text="Numeric EEBO ID")
     vid = filters.NumberFilter(help_text="Numeric VID")
@@ -127,14 +203,7 @@ class BookFilter(filters.FilterSet):
 
     def has_any_grouping(self, queryset, name, value):
         if value:
-            groupings = models.CharacterGrouping.objects.filter(
-                characters__created_by_run__book=OuterRef("pk")
-            )
-            return (
-                queryset.annotate(has_groupings=Exists(groupings))
-                .filter(has_groupings=True)
-                .all()
-            )
+            return queryset.filter(n_grouped_characters__gt=0)
         return queryset
 
     def has_images(self, queryset, name, value):
@@ -160,14 +229,10 @@ class BookFilter(filters.FilterSet):
         return queryset
 
     def has_characters(self, queryset, name, value):
-        characters = models.Character.objects.filter(
-            created_by_run__book=OuterRef("pk")
-        )
-
         if value:
-            return queryset.filter(Exists(characters)).distinct()
+            return queryset.filter(n_characters__gt=0)
         else:
-            return queryset.filter(~Exists(characters)).distinct()
+            return queryset.filter(n_characters=0)
 
     def after_early(self, queryset, name, value):
         return queryset.filter(date_early__gte=value)
@@ -190,19 +255,29 @@ class BookFilter(filters.FilterSet):
         return queryset.filter(qs_filter)
 
 
-class BookViewSet(CRUDViewSet, GetSerializerClassMixin):
+class BookViewSet(GetSerializerClassMixin, CRUDViewSet):
     """
     list: Lists all books.
     """
 
-    detail_queryset = models.Book.objects.prefetch_related("spreads").all()
+    detail_queryset = (
+        models.Book.objects.select_related("cover_page")
+        .prefetch_related(
+            "spreads", "pageruns__stats", "lineruns__stats", "characterruns__stats"
+        )
+        .all()
+    )
 
-    list_queryset = models.Book.objects.prefetch_related(
-        Prefetch("spreads", queryset=models.Spread.objects.filter(sequence=1))
-    ).all()
+    list_queryset = (
+        models.Book.objects.select_related("cover_page")
+        .prefetch_related(
+            Prefetch("spreads", queryset=models.Spread.objects.filter(sequence=1))
+        )
+        .all()
+    )
 
     queryset = detail_queryset
-    serializer_action_classes = {"list": list_queryset, "detail": detail_queryset}
+    queryset_action_classes = {"list": list_queryset, "retrieve": detail_queryset}
     filterset_class = BookFilter
     ordering_fields = ["pq_title", "pq_author", "pq_publisher", "date_early"]
 
@@ -217,6 +292,44 @@ class BookViewSet(CRUDViewSet, GetSerializerClassMixin):
         res = obj.spreads.all().delete()
         return Response(res)
 
+    @action(detail=True, methods=["get"])
+    def stats(self, request, pk=None):
+        """
+        Precomputed page, line, and character statistics for every run of this book. Damage score percentiles left stale by batches of characters posted through the API are recomputed first.
+        """
+        book = self.get_object()
+        stats = list(book.stats.all())
+        models.BookStats.refresh_stale_percentiles(stats)
+        serializer = serializers.BookStatsSerializer(
+            stats, many=True, context={"request": request}
+        )
+        return Response(serializer.data)
+
+    @action(detail=True, methods=["post"])
+    def promote_runs(self, request, pk=None):
+        """
+        Atomically set which page, line, and/or character runs are current for this book
+        """
+        book = self.get_object()
+        serializer = serializers.BookPromoteRunsSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            book.promote_runs(
+                page=serializer.validated_data.get("page_run"),
+                line=serializer.validated_data.get("line_run"),
+                character=serializer.validated_data.get("character_run"),
+            )
+        except ValueError as err:
+            return Response({"error": str(err)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(
+            {
+                "current_page_run": book.current_page_run_id,
+                "current_line_run": book.current_line_run_id,
+                "current_character_run": book.current_character_run_id,
+            }
+        )
+
     @action(detail=True, methods=["post"])
     @transaction.atomic
     def bulk_pages(self, request, pk=None):
@@ -351,13 +464,27 @@ class BookViewSet(CRUDViewSet, GetSerializerClassMixin):
     def matched_characters(self, request, pk=None):
         limit = int(request.GET.get("limit", 5))
         offset = int(request.GET.get("offset", 0))
+        try:
+            ordering, max_distance = matched_characters_options(request.GET)
+        except ValueError as err:
+            return Response({"error": str(err)}, status=status.HTTP_400_BAD_REQUEST)
+        matches_dir = request.data["dir"]
+        character_class = request.data['character_class']
+        match_set = get_imported_match_set(pk, matches_dir, character_class)
+        if match_set is not None:
+            matched_characters, total_count = get_imported_matched_characters(
+                request, match_set, limit, offset, ordering, max_distance
+            )
+            return Response({"matched_characters": matched_characters, "total_count": total_count},
+                            status=status.HTTP_200_OK)
+        if ordering != "row" or max_distance is not None:
+            return Response({"error": "Matches must be imported with import_topk_matches to be sorted or filtered"},
+                            status=status.HTTP_400_BAD_REQUEST)
         one_page = models.Page.objects.filter(
             created_by_run__book=pk, tif__isnull=False
         )[0]
         split_parts = (one_page.tif.split('/')[0:4])
         matches_path = os.path.join(BASE_PATH, *split_parts)
-        matches_dir = request.data["dir"]
-        character_class = request.data['character_class']
         character_class_dir = os.path.join(matches_path, matches_dir, character_class)
         logging.info({"Character class folder: ", character_class_dir})
         csv_path = os.path.join(character_class_dir, TOP_K_CSV_SUFFIX)
@@ -368,8 +495,7 @@ class BookViewSet(CRUDViewSet, GetSerializerClassMixin):
         if len(topk_csv_files) > 1:
             return Response({"More than one CSV matching:", csv_path})
         topk_csv_file = topk_csv_files[0]
-        with open(topk_csv_file) as csv_file:
-            number_of_lines = sum(1 for _ in csv_file)
+        number_of_lines = get_csv_index(topk_csv_file)["n_rows"]
         matched_characters = get_matched_characters(request, topk_csv_file, limit, offset)
         return Response({"matched_characters": matched_characters, "total_count": number_of_lines},
                         status=status.HTTP_200_OK)
@@ -386,33 +512,82 @@ class BookViewSet(CRUDViewSet, GetSerializerClassMixin):
         try:
             book = self.get_object()
             save_matched_characters_in_db(book, matches)
+            models.BookMatchSummary.refresh([book.pk])
         except Exception as err:
             logging.error({'Error saving match: ': err})
             return Response("Error saving matches", status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         return Response("Saved matches successfully!", status=status.HTTP_200_OK)
 
+    @action(detail=True, methods=["get"])
+    def match_summary(self, request, pk=None):
+        """
+        Numbers of saved matches between this book's query characters and the characters of each other book (`matches`), and the other way round (`matched_by`)
+        """
+        book = self.get_object()
+        return Response(
+            {
+                "matches": serializers.BookMatchSummarySerializer(
+                    book.match_summaries.all(), many=True
+                ).data,
+                "matched_by": serializers.BookMatchSummarySerializer(
+                    book.matched_by_summaries.order_by("-n_matches"), many=True
+                ).data,
+            }
+        )
+
+    @action(detail=True, methods=["get"])
+    def matches_with(self, request, pk=None):
+        """
+        Saved matches of this book that include a character from the book given as `book`
+        """
+        book = self.get_object()
+        try:
+            matched_book = models.Book.objects.get(pk=request.query_params.get("book"))
+        except (models.Book.DoesNotExist, ValidationError):
+            return Response(
+                {"error": "book must be the ID of a book"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        page = self.paginate_queryset(
+            models.CharacterMatch.linking_books(book, matched_book).order_by("query")
+        )
+        serializer = serializers.SavedCharacterMatchSerializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
     @action(detail=True, methods=["get"], permission_classes=[], authentication_classes=[])
-    # cache requested url for each user for 2 hours
-    @method_decorator(cache_page(60 * 60 * 2))
-    @transaction.atomic
     def generate_manifest(self, request, pk=None):
-        pages = models.Page.objects.filter(
-            created_by_run__book=pk, tif__isnull=False
-        )
-        if len(pages) == 0:
-            return Response("No pages in book", status=status.HTTP_200_OK)
-        split_parts = (pages[0].tif.split('/')[0:5])
-        images_dir_path = os.path.join(BASE_PATH, *split_parts)
+        """
+        IIIF manifest of the book's current page run, stored when its pages were ingested and served with an ETag. Given `start` and/or `count`, a partial manifest of that window of pages is streamed instead.
+        """
+        book = self.get_object()
+        if "start" in request.query_params or "count" in request.query_params:
+            return self.partial_manifest(request, book)
         try:
-            book = self.get_object()
-            manifest = generate_iiif_manifest(book, pages, images_dir_path)
-            if manifest is None:
-                return Response("Could not find original images for book to create manifest", status=status.HTTP_200_OK)
-            result = json.loads(manifest)
-            return Response(result, status=status.HTTP_200_OK)
+            manifest = get_manifest(book)
+        except Exception as err:
+            logging.error({'Error generating manifest: ': err})
+            return Response("Error generating manifest", status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        if manifest is None:
+            return Response(NO_MANIFEST, status=status.HTTP_200_OK)
+        return manifest_response(request, manifest)
+
+    def partial_manifest(self, request, book):
+        params = serializers.ManifestWindowSerializer(data=request.query_params)
+        if not params.is_valid():
+            return Response(params.errors, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            pages = manifest_window(book, **params.validated_data)
         except Exception as err:
             logging.error({'Error generating manifest: ': err})
             return Response("Error generating manifest", status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        if pages is None:
+            return Response(NO_MANIFEST, status=status.HTTP_200_OK)
+        if pages.start >= pages.n_pages:
+            return Response(
+                {"error": f"start must be less than the number of pages, {pages.n_pages}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        return StreamingHttpResponse(pages.chunks(), content_type="application/json")
 
 
 class SpreadFilter(filters.FilterSet):
@@ -454,22 +629,28 @@ class RunFilter(filters.FilterSet):
 
 
 class PageRunViewSet(CRUDViewSet):
-    queryset = models.PageRun.objects.all()
+    queryset = models.PageRun.objects.select_related("stats").all()
     filterset_class = RunFilter
     serializer_class = serializers.PageRunSerializer
 
 
 class LineRunViewSet(CRUDViewSet):
-    queryset = models.LineRun.objects.all()
+    queryset = models.LineRun.objects.select_related("stats").all()
     filterset_class = RunFilter
     serializer_class = serializers.LineRunSerializer
 
 
 class CharacterRunViewSet(CRUDViewSet):
-    queryset = models.CharacterRun.objects.all()
+    queryset = models.CharacterRun.objects.select_related("stats").all()
     filterset_class = RunFilter
     serializer_class = serializers.CharacterRunSerializer
 
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        book_id = instance.book_id
+        super().perform_destroy(instance)
+        models.Book.refresh_character_counts([book_id])
+
 
 class PageFilter(filters.FilterSet):
     book = filters.ModelChoiceFilter(
@@ -496,9 +677,7 @@ class PageViewSet(CRUDViewSet):
     list: Pages belong to a single `Spread` instance, and are either marked as on the left (`l`) or right (`r`) side. Because the exact split of pages may differ run to run, they are also tied to a `Run` ID.
     """
 
-    queryset = models.Page.objects.prefetch_related(
-        "created_by_run__book__lineruns", "created_by_run"
-    ).all()
+    queryset = models.Page.objects.select_related("created_by_run__book").all()
     filterset_class = PageFilter
 
     def get_serializer_class(self):
@@ -643,7 +822,22 @@ class CharacterFilter(filters.FilterSet):
             return queryset
 
 
+class Echo:
+    """
+    Pseudo-buffer for csv.writer that hands each written row straight back, so rows can be streamed out without accumulating in memory
+    """
+
+    def write(self, value):
+        return value
+
+
 class CharacterViewSet(viewsets.ModelViewSet):
+    # Sort keys among the ordering_fields
+    SEQUENCE_ANNOTATIONS = {
+        "lineseq": F("line__sequence"),
+        "pageseq": F("line__page__sequence"),
+        "bookseq": F("created_by_run__book__id"),
+    }
     queryset = (
         models.Character.objects.select_related(
             "line",
@@ -652,11 +846,7 @@ class CharacterViewSet(viewsets.ModelViewSet):
             "character_class",
             "human_character_class",
         )
-        .annotate(
-            lineseq=F("line__sequence"),
-            pageseq=F("line__page__sequence"),
-            bookseq=F("created_by_run__book__id"),
-        )
+        .annotate(**SEQUENCE_ANNOTATIONS)
         .distinct()
         .all()
     )
@@ -670,6 +860,34 @@ class CharacterViewSet(viewsets.ModelViewSet):
     ]
     filterset_class = CharacterFilter
 
+    EXPORT_FIELDS = {
+        "id": "id",
+        "label": "label",
+        "book": "created_by_run__book_id",
+        "created_by_run": "created_by_run_id",
+        "page": "line__page_id",
+        "page_sequence": "line__page__sequence",
+        "page_side": "line__page__side",
+        "page_tif": "line__page__tif",
+        "line": "line_id",
+        "line_sequence": "line__sequence",
+        "sequence": "sequence",
+        "x_min": "x_min",
+        "x_max": "x_max",
+        "y_min": "y_min",
+        "y_max": "y_max",
+        "character_class": "character_class_id",
+        "human_character_class": "human_character_class_id",
+        "class_probability": "class_probability",
+        "damage_score": "damage_score",
+        "exposure": "exposure",
+        "offset": "offset",
+    }
+    EXPORT_CHUNK_SIZE = 5000
+    DISTRIBUTION_MAX_BINS = 200
+    # cache distributions for 1 hour
+    DISTRIBUTION_CACHE_SECONDS = 60 * 60
+
     def get_queryset(self):
         if self.action == "create":
             return models.Character.objects.all()
@@ -693,6 +911,33 @@ class CharacterViewSet(viewsets.ModelViewSet):
             return serializers.CharacterListSerializer
         return serializers.CharacterCreateSerializer
 
+    @transaction.atomic
+    def perform_update(self, serializer):
+        # Changing either class, or the run, moves the character between ClassConfusion cells
+        counted = ("character_class", "human_character_class", "created_by_run")
+        changed = any(
+            field in serializer.validated_data
+            and serializer.validated_data[field] != getattr(serializer.instance, field)
+            for field in counted
+        )
+        if changed:
+            models.ClassConfusion.forget_characters([serializer.instance.pk])
+        super().perform_update(serializer)
+        if changed:
+            models.ClassConfusion.count_characters([serializer.instance.pk])
+
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        book_id = instance.created_by_run.book_id
+        grouped = instance.charactergroupings.exists()
+        models.ClassConfusion.forget_characters([instance.pk])
+        super().perform_destroy(instance)
+        models.Book.objects.filter(pk=book_id).update(
+            n_characters=Greatest(F("n_characters") - 1, 0)
+        )
+        if grouped:
+            models.Book.refresh_grouped_character_counts([book_id])
+
     @action(detail=False, methods=["post"])
     @transaction.atomic
     def annotate(self, request):
@@ -702,6 +947,9 @@ class CharacterViewSet(viewsets.ModelViewSet):
                 char.id for char in serializer.validated_data["characters"]
             ]
 
+            models.ClassConfusion.record_annotation(
+                target_characters, serializer.validated_data["human_character_class"]
+            )
             models.Character.objects.filter(id__in=target_characters).update(
                 human_character_class=serializer.validated_data["human_character_class"]
             )
@@ -709,6 +957,209 @@ class CharacterViewSet(viewsets.ModelViewSet):
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=False, methods=["get"])
+    def confusion_matrix(self, request):
+        """
+        Counts of every machine `character_class` × `human_character_class` pair among annotated characters, for a `book`, a `created_by_run`, or the whole corpus. Pass `summary=true` to read from the maintained ClassConfusion table instead of grouping over Characters.
+        """
+        serializer = serializers.ConfusionMatrixQuerySerializer(
+            data=request.query_params
+        )
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        book = serializer.validated_data.get("book")
+        character_run = serializer.validated_data.get("created_by_run")
+        if serializer.validated_data["summary"]:
+            cells = models.ClassConfusion.objects.all()
+            if book is not None:
+                cells = cells.filter(character_run__book=book)
+            if character_run is not None:
+                cells = cells.filter(character_run=character_run)
+            cells = cells.values("character_class", "human_character_class").annotate(
+                count=Sum("count")
+            )
+        else:
+            cells = models.Character.objects.filter(human_character_class__isnull=False)
+            if book is not None:
+                cells = cells.filter(created_by_run__book=book)
+            if character_run is not None:
+                cells = cells.filter(created_by_run=character_run)
+            cells = cells.values("character_class", "human_character_class").annotate(
+                count=Count("id")
+            )
+        cells = list(cells.order_by("character_class", "human_character_class"))
+        return Response(
+            {
+                "n_annotated": sum(c["count"] for c in cells),
+                "n_agreement": sum(
+                    c["count"]
+                    for c in cells
+                    if c["character_class"] == c["human_character_class"]
+                ),
+                "cells": cells,
+            }
+        )
+
+    @action(detail=False, methods=["get"])
+    def export(self, request):
+        """
+        Stream every character the list endpoint would return for the same `character_run`, CharacterFilter and `ordering` parameters, as NDJSON (default) or CSV (`export_format=csv`). Rows are read through a server-side cursor, so the whole export is a single query.
+        """
+        export_format = request.query_params.get("export_format", "ndjson")
+        if export_format not in ("ndjson", "csv"):
+            return Response(
+                {"error": "export_format must be one of 'ndjson' or 'csv'"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        queryset = models.Character.objects.annotate(
+            **self.SEQUENCE_ANNOTATIONS
+        ).order_by(
+            "created_by_run_id",
+            "line__page__sequence",
+            "line__sequence",
+            "sequence",
+        )
+        character_run = request.query_params.get("character_run")
+        if character_run:
+            queryset = queryset.filter(created_by_run_id=character_run)
+        # The filter backends of the list endpoint, with `ordering` taking precedence over the order above
+        queryset = self.filter_queryset(queryset)
+        # Rows are streamed after the request has left the replica-routing middleware, so pin the database now
+        queryset = queryset.using(router.db_for_read(models.Character))
+        fieldnames = list(self.EXPORT_FIELDS.keys())
+        rows = queryset.values_list(*self.EXPORT_FIELDS.values()).iterator(
+            chunk_size=self.EXPORT_CHUNK_SIZE
+        )
+        if export_format == "csv":
+            writer = csv.writer(Echo())
+            stream = chain(
+                [writer.writerow(fieldnames)], (writer.writerow(row) for row in rows)
+            )
+            content_type = "text/csv"
+        else:
+            stream = (
+                json.dumps(dict(zip(fieldnames, row)), default=str) + "\n"
+                for row in rows
+            )
+            content_type = "application/x-ndjson"
+        response = StreamingHttpResponse(stream, content_type=content_type)
+        response["Content-Disposition"] = f"attachment; filename=characters.{export_format}"
+        return response
+
+    @action(detail=False, methods=["get"])
+    def distribution(self, request):
+        """
+        Histograms and percentiles of damage_score and class_probability for characters matching the CharacterFilter parameters, optionally split by `group_by` (book, character_class, or printer) into `bins` histogram buckets. Results are cached per set of query parameters.
+        """
+        group_by = request.query_params.get("group_by")
+        if group_by is not None and group_by not in GROUP_FIELDS:
+            return Response(
+                {"error": f"group_by must be one of {', '.join(GROUP_FIELDS)}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        try:
+            bins = int(request.query_params.get("bins", 20))
+        except ValueError:
+            bins = 0
+        if not 1 <= bins <= self.DISTRIBUTION_MAX_BINS:
+            return Response(
+                {"error": f"bins must be an integer between 1 and {self.DISTRIBUTION_MAX_BINS}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        params_hash = hashlib.sha1(
+            json.dumps(sorted(request.query_params.lists())).encode()
+        ).hexdigest()
+        cache_key = f"character_distribution:{params_hash}"
+        result = cache.get(cache_key)
+        if result is None:
+            filterset = self.filterset_class(
+                request.query_params,
+                queryset=models.Character.objects.all(),
+                request=request,
+            )
+            if not filterset.is_valid():
+                return Response(filterset.errors, status=status.HTTP_400_BAD_REQUEST)
+            result = {
+                "group_by": group_by,
+                "bins": bins,
+                "results": character_distributions(filterset.qs, group_by, bins),
+            }
+            cache.set(cache_key, result, self.DISTRIBUTION_CACHE_SECONDS)
+        return Response(result)
+
+    @action(detail=False, methods=["get"])
+    def sprite(self, request):
+        """
+        Sprite of the thumbnails on one page of the character list, with the same filters, ordering, limit and offset
+        """
+        characters = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+        return sprite_response(request, characters)
+
+    @action(detail=True, methods=["get"])
+    def similar(self, request, pk=None):
+        """
+        The `k` characters of the same class whose feature vectors are closest to this one's, by cosine distance. Results can be limited to `books`, to books whose printer contains `printer`, or to books that may have been printed between `date_from` and `date_to`.
+        """
+        character = self.get_object()
+        params = serializers.CharacterSimilarSerializer(data=request.query_params)
+        if not params.is_valid():
+            return Response(params.errors, status=status.HTTP_400_BAD_REQUEST)
+        filters = dict(params.validated_data)
+        k = filters.pop("k")
+        try:
+            results = similar_characters(character, k, **filters)
+        except models.CharacterFeatures.DoesNotExist:
+            return Response(
+                {"error": "This character has no feature vector"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        characters = serialize_characters(request, [pk for pk, _ in results])
+        return Response(
+            {
+                "results": [
+                    {"character": characters.get(str(pk)), "distance": distance}
+                    for pk, distance in results
+                ]
+            }
+        )
+
+    @action(detail=True, methods=["get"])
+    def matched_by(self, request, pk=None):
+        """
+        Saved matches that include this character
+        """
+        character = self.get_object()
+        page = self.paginate_queryset(
+            models.CharacterMatch.objects.filter(
+                matches__contains=[character.pk]
+            ).order_by("book", "query")
+        )
+        serializer = serializers.SavedCharacterMatchSerializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @action(detail=False, methods=["post"])
+    def batch(self, request):
+        """
+        Retrieve many characters by ID in a single query. Results are returned in the requested order, and any IDs not found in the database are listed under `missing`.
+        """
+        serializer = serializers.CharacterBatchSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        requested_ids = list(dict.fromkeys(serializer.validated_data["characters"]))
+        characters = models.Character.objects.select_related(
+            "line__page__created_by_run__book"
+        ).in_bulk(requested_ids)
+        found = [characters[i] for i in requested_ids if i in characters]
+        missing = [i for i in requested_ids if i not in characters]
+        return Response(
+            {
+                "characters": serializers.CharacterListSerializer(
+                    found, many=True, context={"request": request}
+                ).data,
+                "missing": missing,
+            }
+        )
+
 
 class CharacterClassFilter(filters.FilterSet):
     character_class = filters.CharFilter(
@@ -727,6 +1178,19 @@ class CharacterClassViewset(CRUDViewSet):
     filterset_class = CharacterClassFilter
 
 
+def refresh_grouped_character_counts(character_ids):
+    """
+    Recompute the grouped character count of every book the given characters belong to
+    """
+    book_ids = (
+        models.Character.objects.filter(id__in=character_ids)
+        .order_by()
+        .values("created_by_run__book")
+        .distinct()
+    )
+    models.Book.refresh_grouped_character_counts(book_ids)
+
+
 class CharacterGroupingFilter(filters.FilterSet):
     created_by = filters.CharFilter(field_name="created_by__username")
     book = filters.ModelChoiceFilter(
@@ -762,6 +1226,30 @@ class CharacterGroupingViewSet(CRUDViewSet, GetSerializerClassMixin):
     serializer_action_classes = {"list": list_queryset, "detail": detail_queryset}
     filterset_class = CharacterGroupingFilter
 
+    @transaction.atomic
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        refresh_grouped_character_counts(
+            [char.pk for char in serializer.validated_data.get("characters", [])]
+        )
+
+    @transaction.atomic
+    def perform_update(self, serializer):
+        previous_characters = list(
+            serializer.instance.characters.values_list("pk", flat=True)
+        )
+        super().perform_update(serializer)
+        refresh_grouped_character_counts(
+            previous_characters
+            + [char.pk for char in serializer.validated_data.get("characters", [])]
+        )
+
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        previous_characters = list(instance.characters.values_list("pk", flat=True))
+        super().perform_destroy(instance)
+        refresh_grouped_character_counts(previous_characters)
+
     def get_serializer_class(self):
         if self.action == "retrieve":
             return serializers.CharacterGroupingDetailSerializer
@@ -777,8 +1265,8 @@ class CharacterGroupingViewSet(CRUDViewSet, GetSerializerClassMixin):
             data=request.data
         )
         if serializer.is_valid():
-            for char in serializer.data["characters"]:
-                obj.characters.add(char)
+            obj.characters.add(*serializer.data["characters"])
+            refresh_grouped_character_counts(serializer.data["characters"])
             return Response({"status": "characters added"})
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -791,8 +1279,8 @@ class CharacterGroupingViewSet(CRUDViewSet, GetSerializerClassMixin):
             data=request.data
         )
         if serializer.is_valid():
-            for char in serializer.data["characters"]:
-                obj.characters.remove(char)
+            obj.characters.remove(*serializer.data["characters"])
+            refresh_grouped_character_counts(serializer.data["characters"])
             return Response({"status": "characters removed"})
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -812,9 +1300,9 @@ class CharacterGroupingViewSet(CRUDViewSet, GetSerializerClassMixin):
             data=request.data
         )
         if serializer.is_valid():
-            for char in serializer.data["characters"]:
-                current_character_group.characters.remove(char)
-                target_group.characters.add(char)
+            current_character_group.characters.remove(*serializer.data["characters"])
+            target_group.characters.add(*serializer.data["characters"])
+            refresh_grouped_character_counts(serializer.data["characters"])
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         return Response({"status": "characters moved"})
@@ -831,26 +1319,27 @@ class CharacterGroupingViewSet(CRUDViewSet, GetSerializerClassMixin):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        image_objects = (
-            models.Character.objects.filter(charactergroupings=obj)
-            .select_related("line__page")
-            .all()
-        )
-
-        with TemporaryDirectory(dir=settings.DOWNLOAD_SCRATCH_DIR) as scratch_dir:
-            zip_file = tarfile.open(f"{scratch_dir}/cg.tar.gz", "w:gz")
-            for img in image_objects:
-                filename = f"{img.label}.tif"
-                # Make requests out to the iiif endpoint and send back the files
-                # TODO stream the zip response as we request images, rather than waiting for all the images to be done first.
-                direct_url = img.full_tif
-                download_destination = f"{scratch_dir}/{filename}"
-                tif_response = requests.get(direct_url, verify=settings.CA_CERT_ROUTE)
-                open(download_destination, "wb").write(tif_response.content)
-                zip_file.add(download_destination, arcname=filename)
-            zip_file.close()
-            response = FileResponse(
-                open(zip_file.name, "rb"), content_type="application/gzip"
+        characters = list(
+            models.Character.objects.filter(charactergroupings=obj).select_related(
+                "line__page"
+            )
+        )
+        # Crops are fetched concurrently and streamed into the archive as they arrive
+        response = StreamingHttpResponse(
+            stream_character_tar(characters), content_type="application/gzip"
+        )
+        response["Content-Disposition"] = f"attachment; filename={zip_file_name}"
+        return response
+
+    @action(detail=True, methods=["get"])
+    def sprite(self, request, pk=None):
+        """
+        Sprite of the thumbnails of the grouping's characters
+        """
+        obj = self.get_object()
+        characters = list(
+            models.Character.objects.filter(charactergroupings=obj).select_related(
+                "line__page"
             )
-            response["Content-Disposition"] = f"attachment; filename={zip_file_name}"
-            return response
+        )
+        return sprite_response(request, characters)
@@ -0,0 +1,28 @@
+"""
+ASGI config for pp project.
+
+Serve with e.g. `gunicorn web.asgi:application -k uvicorn.workers.UvicornWorker`. Requests served this way are routed through web/asgi_urls.py, so that the async endpoints in pp/async_views.py can wait on the filesystem or the IIIF server without holding up a worker.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
+"""
+
+import os
+
+import django
+from asgiref.sync import ThreadSensitiveContext
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "web.settings")
+
+django.setup(set_prefix=False)
+
+from .streaming import ASGIHandler
+
+# Like django.core.asgi.get_asgi_application(), but able to send AsyncStreamingHttpResponse
+django_application = ASGIHandler()
+
+
+async def application(scope, receive, send):
+    # Give every request its own thread for sync code (middleware, ORM calls), rather than one thread shared by the whole process
+    async with ThreadSensitiveContext():
+        return await django_application(scope, receive, send)
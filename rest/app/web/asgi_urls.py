@@ -0,0 +1,26 @@
+"""
+URLs for requests served over ASGI: the async versions of the slow endpoints take precedence over the matching viewset actions in web/urls.py.
+"""
+from django.urls import path
+
+from pp import async_views
+from .urls import urlpatterns as wsgi_urlpatterns
+
+urlpatterns = [
+    path(
+        "api/books/<uuid:pk>/matched_directories/",
+        async_views.matched_directories,
+    ),
+    path(
+        "api/books/<uuid:pk>/matched_characters/",
+        async_views.matched_characters,
+    ),
+    path(
+        "api/books/<uuid:pk>/generate_manifest/",
+        async_views.generate_manifest,
+    ),
+    path(
+        "api/character_groupings/<uuid:pk>/download/",
+        async_views.download,
+    ),
+] + wsgi_urlpatterns
@@ -0,0 +1,140 @@
+"""
+Route safe-method (read-only) traffic to Postgres read replicas.
+
+Replicas are configured with the POSTGRES_REPLICA_HOSTS envvar (see settings.py). Reads go to a randomly-chosen replica only when they are explicitly allowed: during GET/HEAD/OPTIONS requests via replica_routing_middleware, or inside the `replica_reads()` context manager for read-only management commands. Everything else, including every write, goes to "default".
+"""
+import asyncio
+import contextvars
+import logging
+import random
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+from django.utils.decorators import sync_and_async_middleware
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# Cookie marking a client that wrote recently and should keep reading from the primary
+PRIMARY_COOKIE = "pp_primary_until"
+
+_replica_reads_allowed = contextvars.ContextVar("replica_reads_allowed", default=False)
+
+# Replication lag in seconds (None when unreachable), keyed by database alias
+_lag_checks = {}
+
+REPLICA_LAG_SQL = """
+SELECT CASE
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END
+"""
+
+
+def replica_lag(alias):
+    """
+    Replication lag of a replica in seconds, or None if it could not be reached. Results are cached for REPLICA_LAG_CHECK_SECONDS.
+    """
+    checked_at, lag = _lag_checks.get(alias, (None, None))
+    if (
+        checked_at is None
+        or time.monotonic() - checked_at > settings.REPLICA_LAG_CHECK_SECONDS
+    ):
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute(REPLICA_LAG_SQL)
+                lag = float(cursor.fetchone()[0])
+        except DatabaseError as err:
+            logging.error({f"Replica {alias} unavailable": str(err)})
+            lag = None
+        _lag_checks[alias] = (time.monotonic(), lag)
+    return lag
+
+
+def available_replicas():
+    """
+    Replicas that are reachable and within REPLICA_MAX_LAG_SECONDS of the primary
+    """
+    return [
+        alias
+        for alias in settings.REPLICA_DATABASES
+        if (lag := replica_lag(alias)) is not None
+        and lag <= settings.REPLICA_MAX_LAG_SECONDS
+    ]
+
+
+@contextmanager
+def replica_reads(allowed=True):
+    """
+    Allow (or forbid) reads to be routed to replicas within this block
+    """
+    token = _replica_reads_allowed.set(allowed)
+    try:
+        yield
+    finally:
+        _replica_reads_allowed.reset(token)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if not _replica_reads_allowed.get() or not settings.REPLICA_DATABASES:
+            return "default"
+        replicas = available_replicas()
+        if not replicas:
+            return "default"
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == "default"
+
+
+def use_replicas(request):
+    """
+    Whether this request may read from replicas: only safe methods from clients that did not write within the last REPLICA_STICKY_SECONDS
+    """
+    try:
+        primary_until = float(request.COOKIES.get(PRIMARY_COOKIE, 0))
+    except ValueError:
+        primary_until = 0
+    return request.method in SAFE_METHODS and primary_until < time.time()
+
+
+def mark_write(request, response):
+    if request.method not in SAFE_METHODS:
+        response.set_cookie(
+            PRIMARY_COOKIE,
+            str(time.time() + settings.REPLICA_STICKY_SECONDS),
+            max_age=settings.REPLICA_STICKY_SECONDS,
+            httponly=True,
+        )
+    return response
+
+
+@sync_and_async_middleware
+def replica_routing_middleware(get_response):
+    """
+    Send safe-method requests to replicas, unless the client wrote within the last REPLICA_STICKY_SECONDS
+    """
+    if asyncio.iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            with replica_reads(use_replicas(request)):
+                response = await get_response(request)
+            return mark_write(request, response)
+
+    else:
+
+        def middleware(request):
+            with replica_reads(use_replicas(request)):
+                response = get_response(request)
+            return mark_write(request, response)
+
+    return middleware
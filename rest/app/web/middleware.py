@@ -0,0 +1,52 @@
+"""
+Middleware that runs natively in both WSGI and ASGI requests, so that an async view is not pushed onto a thread by a sync-only middleware wrapped around it
+"""
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.utils.decorators import sync_and_async_middleware
+from ip_logger.middleware import LogIPMiddleware
+
+
+@sync_and_async_middleware
+def log_ip_middleware(get_response):
+    """
+    ip_logger's LogIPMiddleware, which is sync-only
+    """
+    # LogIPMiddleware records the visit and then returns whatever its get_response returns
+    log_ip = LogIPMiddleware(lambda request: None)
+
+    if asyncio.iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            await sync_to_async(log_ip)(request)
+            return await get_response(request)
+
+    else:
+
+        def middleware(request):
+            log_ip(request)
+            return get_response(request)
+
+    return middleware
+
+
+@sync_and_async_middleware
+def asgi_urlconf_middleware(get_response):
+    """
+    Route requests served over ASGI with web/asgi_urls.py, which swaps in the async versions of the slow endpoints
+    """
+    if asyncio.iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            if isinstance(request, ASGIRequest):
+                request.urlconf = "web.asgi_urls"
+            return await get_response(request)
+
+    else:
+
+        def middleware(request):
+            return get_response(request)
+
+    return middleware
@@ -0,0 +1,188 @@
+"""
+PostgreSQL backend that keeps a bounded pool of open connections per process.
+
+Django still "closes" the connection at the end of every request (CONN_MAX_AGE = 0), but closing hands the psycopg2 connection back to the pool, and the next request checks it out again instead of paying for a new TCP + auth handshake.
+
+Pool settings are read from the "POOL" key of the database settings:
+
+- MAX_SIZE: most connections a single process may hold open
+- MAX_LIFETIME: seconds after which a connection is closed instead of reused
+- TIMEOUT: seconds to wait for a free connection when the pool is exhausted
+
+Every connection is checked before being handed out, and pools are never shared across a fork, so each gunicorn worker opens its own connections.
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import psycopg2
+from psycopg2 import extensions
+from django.db.backends.postgresql import base
+
+POOL_DEFAULTS = {"MAX_SIZE": 10, "MAX_LIFETIME": 1800, "TIMEOUT": 10}
+
+# Pools keyed by connection parameters, so that e.g. switching to the test database never reuses a connection to the real one
+_pools = {}
+_pools_lock = threading.Lock()
+# Pools inherited from a parent process. Their sockets belong to the parent, so they are kept referenced and never closed: closing them would end the parent's sessions.
+_inherited_pools = []
+
+
+def _forget_parent_pools():
+    _inherited_pools.extend(_pools.values())
+    _pools.clear()
+
+
+os.register_at_fork(after_in_child=_forget_parent_pools)
+
+
+class PooledConnection:
+    def __init__(self, connection, isolation_level):
+        self.connection = connection
+        self.isolation_level = isolation_level
+        self.created_at = time.monotonic()
+
+
+class ConnectionPool:
+    def __init__(self, max_size, max_lifetime, timeout):
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+        self.idle = deque()
+        # Raw connection -> PooledConnection, for every connection currently checked out
+        self.in_use = {}
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_size)
+
+    def expired(self, pooled):
+        return time.monotonic() - pooled.created_at > self.max_lifetime
+
+    @staticmethod
+    def healthy(connection):
+        if connection.closed:
+            return False
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def discard(connection):
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    def checkout(self, connect):
+        """
+        Hand out an idle connection that passes a health check, or open a new one with `connect()`
+        """
+        if not self.slots.acquire(timeout=self.timeout):
+            raise psycopg2.OperationalError(
+                f"No database connection became free within {self.timeout} seconds"
+            )
+        try:
+            while True:
+                with self.lock:
+                    pooled = self.idle.pop() if self.idle else None
+                if pooled is None:
+                    pooled = PooledConnection(*connect())
+                elif self.expired(pooled) or not self.healthy(pooled.connection):
+                    self.discard(pooled.connection)
+                    continue
+                with self.lock:
+                    self.in_use[pooled.connection] = pooled
+                return pooled
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def checkin(self, connection, reusable=True):
+        with self.lock:
+            pooled = self.in_use.pop(connection, None)
+        if pooled is None:
+            # Not one of ours, e.g. checked out before a fork
+            return
+        try:
+            if (
+                reusable
+                and not connection.closed
+                and connection.info.transaction_status
+                != extensions.TRANSACTION_STATUS_IDLE
+            ):
+                connection.rollback()
+            if reusable and not connection.closed and not self.expired(pooled):
+                with self.lock:
+                    self.idle.append(pooled)
+            else:
+                self.discard(connection)
+        except psycopg2.Error as err:
+            logging.warning({"Discarding pooled connection": str(err)})
+            self.discard(connection)
+        finally:
+            self.slots.release()
+
+    def close_idle(self):
+        with self.lock:
+            idle, self.idle = self.idle, deque()
+        for pooled in idle:
+            self.discard(pooled.connection)
+
+
+def close_idle_connections():
+    """
+    Close every idle pooled connection in this process
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close_idle()
+
+
+class DatabaseCreation(base.DatabaseCreation):
+    # Idle connections to the test database would stop it from being dropped
+    def _create_test_db(self, *args, **kwargs):
+        close_idle_connections()
+        return super()._create_test_db(*args, **kwargs)
+
+    def _destroy_test_db(self, *args, **kwargs):
+        close_idle_connections()
+        return super()._destroy_test_db(*args, **kwargs)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+    # The pool the current connection was checked out from
+    pool = None
+
+    def get_pool(self, conn_params):
+        key = repr(sorted(conn_params.items()))
+        with _pools_lock:
+            if key not in _pools:
+                options = {**POOL_DEFAULTS, **self.settings_dict.get("POOL", {})}
+                _pools[key] = ConnectionPool(
+                    max_size=options["MAX_SIZE"],
+                    max_lifetime=options["MAX_LIFETIME"],
+                    timeout=options["TIMEOUT"],
+                )
+            return _pools[key]
+
+    def connect_unpooled(self, conn_params):
+        connection = super().get_new_connection(conn_params)
+        return connection, self.isolation_level
+
+    def get_new_connection(self, conn_params):
+        self.pool = self.get_pool(conn_params)
+        pooled = self.pool.checkout(lambda: self.connect_unpooled(conn_params))
+        self.isolation_level = pooled.isolation_level
+        return pooled.connection
+
+    def _close(self):
+        if self.connection is None:
+            return
+        # A connection closed in the middle of an atomic block is in an unknown state, so don't reuse it
+        with self.wrap_database_errors:
+            self.pool.checkin(self.connection, reusable=not self.in_atomic_block)
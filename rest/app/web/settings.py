@@ -19,7 +19,31 @@ ALLOWED_HOSTS = ['*']
 #     ALLOWED_HOSTS.extend([host, f"{host}:8080"])
 
 IMAGE_BASEURL = os.environ["IMAGE_BASEURL"]
+# Most simultaneous requests a single download or manifest makes to the IIIF server
+IIIF_MAX_CONNECTIONS = int(os.environ.get("IIIF_MAX_CONNECTIONS", 16))
+IIIF_TIMEOUT = 60
 REAL_IMAGE_BASEDIR = "/vol/img"
+# "local" cuts crops for downloads from the TIFFs under REAL_IMAGE_BASEDIR when they are there, "iiif" always asks the IIIF server
+CROP_ENGINE = os.environ.get("CROP_ENGINE", "local")
+# Page TIFFs decoded at once by a local crop batch
+CROP_WORKERS = int(os.environ.get("CROP_WORKERS", 4))
+# Most pages in a partial manifest
+MANIFEST_MAX_WINDOW = 500
+# TIFF headers read at once when storing the size of ingested pages
+IMAGE_SIZE_WORKERS = int(os.environ.get("IMAGE_SIZE_WORKERS", 16))
+# Where character sprites and their atlases are stored
+SPRITE_DIR = os.environ.get("SPRITE_DIR", "/vol/sprites")
+# Default and largest edge of each thumbnail in a sprite, in pixels
+SPRITE_THUMBNAIL_SIZE = 100
+SPRITE_MAX_THUMBNAIL_SIZE = 500
+SPRITE_MAX_CHARACTERS = 1000
+# Rebuild each process's in-memory character similarity indexes this often, in seconds
+SIMILARITY_INDEX_MAX_AGE = int(os.environ.get("SIMILARITY_INDEX_MAX_AGE", 600))
+# Character classes at least this large are searched through an IVF index rather than exhaustively
+SIMILARITY_IVF_MIN_SIZE = 50000
+# IVF clusters searched per query
+SIMILARITY_IVF_PROBES = 8
+SIMILARITY_MAX_K = 100
 
 # Application definition
 
@@ -43,6 +67,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "corsheaders.middleware.CorsMiddleware",
+    "web.db_router.replica_routing_middleware",
+    "web.middleware.asgi_urlconf_middleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -51,7 +77,7 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
-    'ip_logger.middleware.LogIPMiddleware',
+    "web.middleware.log_ip_middleware",
 ]
 
 CORS_ORIGIN_ALLOW_ALL = True
@@ -126,16 +152,62 @@ SWAGGER_SETTINGS = {
 # Database
 # https://docs.djangoproject.com/en/2.1/ref/settings/#databases
 
+# POSTGRES_POOL=True keeps a bounded pool of open connections in each process (web/pooled_postgresql)
+POSTGRES_POOL = os.environ.get("POSTGRES_POOL", "False") == "True"
+
 DATABASES = {
     "default": {
-        "ENGINE": "django.db.backends.postgresql",
+        "ENGINE": "web.pooled_postgresql"
+        if POSTGRES_POOL
+        else "django.db.backends.postgresql",
         "NAME": os.environ["POSTGRES_DB"],
         "USER": os.environ["POSTGRES_USER"],
         "PASSWORD": os.environ["POSTGRES_PASSWORD"],
         "HOST": os.environ["POSTGRES_HOST"],
         "PORT": os.environ["POSTGRES_PORT"],
-        "CONN_MAX_AGE": 0, # Close connections immediately after the transaction completes
+        "CONN_MAX_AGE": 0, # Close connections immediately after the transaction completes (returning them to the pool, if pooled)
+        "POOL": {
+            "MAX_SIZE": int(os.environ.get("POSTGRES_POOL_MAX_SIZE", 10)),
+            "MAX_LIFETIME": int(os.environ.get("POSTGRES_POOL_MAX_LIFETIME", 1800)),
+            "TIMEOUT": int(os.environ.get("POSTGRES_POOL_TIMEOUT", 10)),
+        },
+    }
+}
+
+# Optional read replicas, as a comma-separated list of host[:port], e.g. "replica1:5432,replica2"
+# Safe-method requests and read-only management commands read from these, see web/db_router.py
+REPLICA_DATABASES = []
+for i, replica in enumerate(
+    r for r in os.environ.get("POSTGRES_REPLICA_HOSTS", "").split(",") if r.strip()
+):
+    replica_host, _, replica_port = replica.strip().partition(":")
+    alias = f"replica{i + 1}"
+    DATABASES[alias] = {
+        **DATABASES["default"],
+        "HOST": replica_host,
+        "PORT": replica_port or DATABASES["default"]["PORT"],
+        "TEST": {"MIRROR": "default"},
     }
+    REPLICA_DATABASES.append(alias)
+
+DATABASE_ROUTERS = ["web.db_router.ReplicaRouter"]
+# Fall back to the primary when a replica is further behind than this
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get("REPLICA_MAX_LAG_SECONDS", 10))
+# How long to cache each replica's lag measurement
+REPLICA_LAG_CHECK_SECONDS = 5
+# How long a client that just wrote keeps reading from the primary
+REPLICA_STICKY_SECONDS = int(os.environ.get("REPLICA_STICKY_SECONDS", 10))
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    # Serialized characters for match results, least recently used evicted first
+    "character_matches": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "character_matches",
+        "OPTIONS": {"MAX_ENTRIES": 20000},
+    },
 }
 
 
@@ -176,7 +248,6 @@ if (
     CA_CERT_ROUTE == "False"
 ):  # If we want to skip verification, e.g. during testing, passing false needs to convert this setting into a boolean FALSE instead
     CA_CERT_ROUTE = False
-DOWNLOAD_SCRATCH_DIR = os.environ["DOWNLOAD_SCRATCH_DIR"]
 
 EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
 EMAIL_HOST = os.environ.get("EMAIL_HOST")
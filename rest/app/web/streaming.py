@@ -0,0 +1,64 @@
+"""
+Streaming responses backed by an async iterator, for async views served over ASGI.
+
+Django 3.2's StreamingHttpResponse only accepts sync iterators, and its ASGI handler iterates them on the event loop, so a sync iterator that waits on I/O would block every other request in the worker, and one that reads from the database raises SynchronousOnlyOperation. ASGIHandler here sends AsyncStreamingHttpResponse bodies with `async for` instead, and pulls each part of any other streaming response in the thread that runs the request's sync code.
+"""
+from asgiref.sync import sync_to_async
+from django.core.handlers import asgi
+from django.http import StreamingHttpResponse
+
+
+class AsyncStreamingHttpResponse(StreamingHttpResponse):
+    def __init__(self, async_content, *args, **kwargs):
+        super().__init__([], *args, **kwargs)
+        self.async_content = async_content
+
+
+async def sync_parts(iterator):
+    """
+    Iterate a sync iterator in the thread that ran the view, where its database cursor lives
+    """
+    done = object()
+    while (
+        part := await sync_to_async(next, thread_sensitive=True)(iterator, done)
+    ) is not done:
+        yield part
+
+
+class ASGIHandler(asgi.ASGIHandler):
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+        if isinstance(response, AsyncStreamingHttpResponse):
+            content = response.async_content
+        else:
+            # Access `__iter__` and not `streaming_content`, like Django's handler
+            content = sync_parts(iter(response))
+        response_headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode("ascii")
+            if isinstance(value, str):
+                value = value.encode("latin1")
+            response_headers.append((bytes(header), bytes(value)))
+        for c in response.cookies.values():
+            response_headers.append(
+                (b"Set-Cookie", c.output(header="").encode("ascii").strip())
+            )
+        await send(
+            {
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": response_headers,
+            }
+        )
+        try:
+            async for part in content:
+                for chunk, _ in self.chunk_bytes(part):
+                    await send(
+                        {"type": "http.response.body", "body": chunk, "more_body": True}
+                    )
+        finally:
+            await content.aclose()
+        await send({"type": "http.response.body"})
+        await sync_to_async(response.close, thread_sensitive=True)()